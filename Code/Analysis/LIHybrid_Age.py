@@ -1,7 +1,26 @@
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from scipy.stats import ttest_ind, linregress
+from scipy.stats import linregress
+
+from beta_features import band_power, EMP_WINDOW, SIM_WINDOW
+from feature_cache import FeatureCache
+from laterality import empirical_laterality, simulated_laterality
+
+# -----------------------------
+# Beta Power of the Frontal ROIs
+# -----------------------------
+# per trial (empirical) and per subject (simulated); subjects computed before are read from the on-disk cache
+cache = FeatureCache()
+Aemp_v_beta = band_power(Adol_emp_verb, EMP_WINDOW, rois=idx, cache=cache)
+Aemp_n_beta = band_power(Adol_emp_noise, EMP_WINDOW, rois=idx, cache=cache)
+Asim_v_beta = band_power(Adol_sim_verb, SIM_WINDOW, rois=idx, cache=cache)
+Asim_n_beta = band_power(Adol_sim_noise, SIM_WINDOW, rois=idx, cache=cache)
+Yemp_v_beta = band_power(YC_emp_verb, EMP_WINDOW, rois=idx, cache=cache)
+Yemp_n_beta = band_power(YC_emp_noise, EMP_WINDOW, rois=idx, cache=cache)
+Ysim_v_beta = band_power(YC_sim_verb, SIM_WINDOW, rois=idx, cache=cache)
+Ysim_n_beta = band_power(YC_sim_noise, SIM_WINDOW, rois=idx, cache=cache)
+
 
 # -----------------------------
 # Function to Compute Empirical LI
@@ -10,6 +29,8 @@ def compute_empirical_LI(v_beta, n_beta, idx, subjects):
     """
     Computes empirical Laterality Index (LI) for each subject.
 
+    The Welch t-tests of all regions and subjects run as array operations (laterality.py).
+
     Args:
         v_beta (list): Beta power during verb trials.
         n_beta (list): Beta power during noise trials.
@@ -21,45 +42,15 @@ def compute_empirical_LI(v_beta, n_beta, idx, subjects):
         LI_results (dict): Computed LI values per subject.
         LI_neg_results (dict): Computed LI_neg values per subject.
     """
-    significant_regions = {}
-    LI_results = {}
-    LI_neg_results = {}
-
-    for s, subj in enumerate(subjects):
-        sig_positive_regions = []
-        sig_negative_regions = []
-        t_stats = []
-
-        # Perform t-tests per region
-        for i in range(len(idx)):
-            t_stat, p = ttest_ind(v_beta[s][i], n_beta[s][i], equal_var=False)
-            t_stats.append(t_stat)
-            if p < 0.05:
-                if t_stat > 0:
-                    sig_positive_regions.append(i)
-                else:
-                    sig_negative_regions.append(i)
-
-        significant_regions[subj] = {'positive': sig_positive_regions, 'negative': sig_negative_regions}
-
-        # Count occurrences in left and right hemispheres
-        counts = [0, 0, 0, 0]  # pos_right, neg_right, pos_left, neg_left
-        for i in sig_positive_regions + sig_negative_regions:
-            right = i < len(idx) / 2
-            if t_stats[i] > 0:
-                counts[0 if right else 2] += 1
-            else:
-                counts[1 if right else 3] += 1
-
-        # Compute LI and LI_neg
-        num = counts[0] + counts[3] - (counts[1] + counts[2])
-        den = sum(counts)
-        LI_results[subj] = num / den if den != 0 else float('nan')
-
-        num_neg = counts[3] - counts[1]
-        den_neg = counts[3] + counts[1]
-        LI_neg_results[subj] = num_neg / den_neg if den_neg != 0 else float('nan')
-
+    v_beta = [np.asarray(v)[:len(idx)] for v in v_beta[:len(subjects)]]
+    n_beta = [np.asarray(n)[:len(idx)] for n in n_beta[:len(subjects)]]
+    _, _, positive, negative, LI, LI_neg = empirical_laterality(v_beta, n_beta)
+
+    significant_regions = {subj: {'positive': np.flatnonzero(positive[s]).tolist(),
+                                  'negative': np.flatnonzero(negative[s]).tolist()}
+                           for s, subj in enumerate(subjects)}
+    LI_results = {subj: float(LI[s]) for s, subj in enumerate(subjects)}
+    LI_neg_results = {subj: float(LI_neg[s]) for s, subj in enumerate(subjects)}
     return significant_regions, LI_results, LI_neg_results
 
 
@@ -81,32 +72,18 @@ def compute_simulated_LI(v_beta, n_beta, idx, subjects, significant_regions):
         LI_results (dict): Computed simulated LI values per subject.
         LI_neg_results (dict): Computed simulated LI_neg values per subject.
     """
-    LI_results = {}
-    LI_neg_results = {}
-
+    positive = np.zeros((len(subjects), len(idx)), dtype=bool)
+    negative = np.zeros((len(subjects), len(idx)), dtype=bool)
     for s, subj in enumerate(subjects):
-        sig_regions = significant_regions[subj]
-        sig_pos_regions = sig_regions['positive']
-        sig_neg_regions = sig_regions['negative']
-        counts = [0, 0, 0, 0]  # pos_right, neg_right, pos_left, neg_left
-
-        # Evaluate simulated beta power in significant regions
-        for region in sig_pos_regions + sig_neg_regions:
-            diff = v_beta[s][region] - n_beta[s][region]
-            right = region < len(idx) / 2
-            if diff > 0:
-                counts[0 if right else 2] += 1
-            else:
-                counts[1 if right else 3] += 1
-
-        num = counts[0] + counts[3] - (counts[1] + counts[2])
-        den = sum(counts)
-        LI_results[subj] = num / den if den != 0 else float('nan')
-
-        num_neg = counts[3] - counts[1]
-        den_neg = counts[3] + counts[1]
-        LI_neg_results[subj] = num_neg / den_neg if den_neg != 0 else float('nan')
+        positive[s, significant_regions[subj]['positive']] = True
+        negative[s, significant_regions[subj]['negative']] = True
+
+    v_beta = np.stack([np.asarray(v)[:len(idx)] for v in v_beta[:len(subjects)]])
+    n_beta = np.stack([np.asarray(n)[:len(idx)] for n in n_beta[:len(subjects)]])
+    LI, LI_neg = simulated_laterality(v_beta, n_beta, positive, negative)
 
+    LI_results = {subj: float(LI[s]) for s, subj in enumerate(subjects)}
+    LI_neg_results = {subj: float(LI_neg[s]) for s, subj in enumerate(subjects)}
     return LI_results, LI_neg_results
 
 
@@ -0,0 +1,162 @@
+"""
+Mass-univariate scan of model parameters (or coupling edges) against LI and age with family-wise error control.
+
+Every feature is correlated with every target in one product of standardised arrays. The same permutations of a
+target are applied to all features, and the maximum |r| over the features of every permutation gives the null
+distribution of the max statistic: p_fwer = (1 + #(max |r_null| >= |r|)) / (1 + n_resamples) controls the
+family-wise error over all features of a target. Permutations run in chunks (bounded memory: chunk x features)
+and optionally on a thread pool (resampling.run_chunks).
+
+    python association_scan.py subject_data.pkl --targets t_LI_sim Age --control Age --out scan.csv
+
+    df = pd.read_pickle('subject_data.pkl')
+    table = scan(df.drop(columns=['Age', 't_LI_emp', 't_LI_sim']), {'Age': df['Age'], 'LI': df['t_LI_sim']},
+                 control={'LI': df['Age']})
+    X, names = edge_features(fit_files)                 # every edge of the fitted P->I, P->E, P->P couplings
+    table = scan(X, {'Age': ages}, names=names)         # targets in the order of fit_files
+"""
+import argparse
+import threading
+
+import numpy as np
+
+from resampling import complete_subjects, index_matrix, residualise, run_chunks, standardise
+
+# normalised couplings of export_numpy_model and their labels
+COUPLINGS = {'w_n_b': 'p2i', 'w_n_f': 'p2e', 'w_n_l': 'p2p'}
+
+
+# -----------------------------
+# Features
+# -----------------------------
+def edge_features(filenames, couplings=COUPLINGS, nodes=None):
+    """
+    Edge values of the fitted coupling matrices of several subjects as one feature matrix.
+
+    Args:
+        filenames (list): Fitted checkpoints ({sub}_{run}_fittingresults_stim_exp.pkl), one per subject.
+        couplings (dict): Normalised couplings of export_numpy_model to include and their labels.
+        nodes (array): Nodes whose edges are included (e.g. the frontal ROIs), all if None.
+
+    Returns:
+        X (array): subject x edge.
+        names (list): '<label>[source->target]' of every edge (coupling rows are target nodes and columns source
+            nodes, JR_Atlas), in the order of the flattened matrices.
+    """
+    import os
+    import sys
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    import JR_Model_Fitting as jr
+
+    rows, names = [], []
+    for filename in filenames:
+        values = jr.export_numpy_model(jr.load_fit(filename))
+        row = []
+        for key, label in couplings.items():
+            w = values[key] if nodes is None else values[key][np.ix_(nodes, nodes)]
+            row.append(w.reshape(-1))
+            if len(rows) == 0:
+                idx = np.arange(len(w)) if nodes is None else np.asarray(nodes)
+                names += ['%s[%d->%d]' % (label, source, target) for target in idx for source in idx]
+        rows.append(np.concatenate(row))
+    return np.array(rows), names
+
+
+# -----------------------------
+# Scan
+# -----------------------------
+def scan(features, targets, control=None, names=None, n_resamples=10000, chunk=None, workers=None, seed=0):
+    """
+    Correlation of every feature with every target, with uncorrected and max-statistic (FWER) permutation
+    p-values.
+
+    Args:
+        features (DataFrame or array): subject x feature.
+        targets (dict): Target name -> values per subject (e.g. LI, age).
+        control (dict): Target name -> variables (n or n x k) regressed out of that target first (e.g. {'LI': age});
+            the parametric p then has n - 2 - k degrees of freedom.
+        names (list): Feature names (columns of a DataFrame if None).
+        n_resamples (int): Number of permutations per target.
+        chunk (int): Permutations per batch (None: about 2e7 correlations per batch).
+        workers (int): Size of the thread pool.
+        seed (int): Random seed.
+
+    Returns:
+        table (DataFrame): target, feature, n (subjects used), r, p (parametric), p_perm (uncorrected), p_fwer,
+            ranked by p_fwer and |r|. Subjects with a NaN target (or control) are dropped for that target;
+            features that are constant or have NaN values on the remaining subjects get NaN, as do all features of
+            a constant target.
+    """
+    import pandas as pd
+    from scipy.stats import t as t_dist
+    if names is None:
+        names = list(features.columns) if hasattr(features, 'columns') else list(range(np.shape(features)[1]))
+    X_all = np.asarray(features, dtype=float).T
+    chunk = chunk or max(1, int(2e7 // len(X_all)))
+
+    tables = []
+    for t_idx, (target, y) in enumerate(targets.items()):
+        y = np.asarray(y, dtype=float)
+        ctrl = None if control is None or target not in control else np.asarray(control[target], dtype=float)
+        keep = complete_subjects(y, None if ctrl is None else ctrl.T)
+        X, y, n = X_all[:, keep], y[keep], keep.sum()
+        # degrees of freedom of the partial correlation
+        dof = n - 2 - (0 if ctrl is None else ctrl.reshape(len(ctrl), -1).shape[1])
+        if ctrl is not None:
+            y = residualise(y, ctrl[keep])
+        valid = ~np.isnan(X).any(1) & (np.nan_to_num(X.std(1)) > 0)
+        xz = np.zeros_like(X)
+        xz[valid] = standardise(X[valid])
+        yz = standardise(y)
+        r = np.where(valid, xz @ yz, np.nan)
+        valid &= ~np.isnan(r)
+        threshold = np.abs(np.nan_to_num(r)) * (1 - 1e-12)  # rounding tolerance as resampling.pvalue
+        exceed = np.zeros(len(X), dtype=np.int64)
+        lock = threading.Lock()
+
+        def fn(rng, size):
+            null = np.abs(yz[index_matrix(n, size, 'permutation', rng)] @ xz.T)
+            counts = (null >= threshold).sum(0)
+            with lock:
+                exceed[:] += counts
+            return null.max(1)
+
+        max_null = run_chunks(fn, n_resamples, chunk, workers, seed + t_idx)
+        p_fwer = (1 + (max_null[:, None] >= threshold).sum(0)) / (1 + n_resamples)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = r * np.sqrt(dof / (1 - r ** 2))
+        tables.append(pd.DataFrame({'target': target, 'feature': names, 'n': n, 'r': r,
+                                    'p': 2 * t_dist.sf(np.abs(t), dof),
+                                    'p_perm': np.where(valid, (1 + exceed) / (1 + n_resamples), np.nan),
+                                    'p_fwer': np.where(valid, p_fwer, np.nan)}))
+    table = pd.concat(tables, ignore_index=True)
+    table['abs_r'] = table['r'].abs()
+    table = table.sort_values(['p_fwer', 'abs_r'], ascending=[True, False], na_position='last')
+    return table.drop(columns='abs_r').reset_index(drop=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('data', help='subject table (subject_data.pkl)')
+    parser.add_argument('--targets', nargs='+', default=['t_LI_sim', 'Age'])
+    parser.add_argument('--control', default='Age', help="regressed out of every target but itself ('' for none)")
+    parser.add_argument('--exclude', nargs='*', default=['t_LI_emp', 't_LI_sim', 'Age'],
+                        help='columns that are not scanned as features')
+    parser.add_argument('--n', type=int, default=10000, help='permutations per target')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='association_scan.csv')
+    args = parser.parse_args(argv)
+
+    import pandas as pd
+    df = pd.read_pickle(args.data)
+    features = df.drop(columns=[c for c in args.exclude if c in df]).select_dtypes('number')
+    control = {t: df[args.control] for t in args.targets if args.control and t != args.control}
+    table = scan(features, {t: df[t] for t in args.targets}, control, n_resamples=args.n, workers=args.workers,
+                 seed=args.seed)
+    table.to_csv(args.out, index=False)
+    print(table.head(20).to_string())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+"""
+Cohort PSD and band-power features with one code path for empirical trials and simulated traces.
+
+Every subject array has the ROI on the first axis and time on the last one (empirical evoked trials:
+ROI x trial x time, simulations: ROI x time). The analysis window of all subjects is stacked into one
+(rows x samples) array, only for the ROIs that are needed, and the Welch PSD is computed in chunks of rows
+(welch_rows: all segments detrended by one projection and transformed by one rfft; method='scipy' runs
+scipy.signal.welch instead), optionally on a thread or process pool. The PSDs are split back per subject.
+With cache=FeatureCache() (feature_cache.py), PSDs and band powers are only computed for subjects not seen before.
+
+    emp_beta = band_power(Adol_emp_verb, EMP_WINDOW)     # list of ROI x trial arrays
+    sim_beta = band_power(Adol_sim_verb, SIM_WINDOW)     # ROI array per subject (stacked: subject x ROI)
+    df = band_power_table(sim_beta, Adol_subs, condition='verb', kind='simulated')
+"""
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import scipy.signal
+
+from feature_cache import cached_per_subject
+
+# Welch parameters of the paper (fs 1000 Hz, 512-sample segments with 50% overlap, linear detrend)
+WELCH = {'fs': 1000, 'nperseg': 512, 'noverlap': 256, 'detrend': 'linear'}
+
+# 700-1200 ms analysis windows (empirical trials span -500 to 1500 ms, simulations start at stimulus onset - 100 ms)
+EMP_WINDOW = (1200, 1700)
+SIM_WINDOW = (800, 1300)
+
+# Frequency bins of the beta band (13-30 Hz at the 2 Hz resolution of a 500-sample window)
+BETA_BINS = (7, 16)
+
+
+# -----------------------------
+# Welch PSD of the Whole Cohort
+# -----------------------------
+def welch_rows(rows, fs, nperseg, noverlap, detrend='linear'):
+    """
+    Welch PSD (Hann window, density scaling, mean over segments) of every row, as scipy.signal.welch but
+    with the segments of all rows detrended by one projection and transformed by one rfft.
+
+    Args:
+        rows (array): Time series (rows x samples).
+        fs, nperseg, noverlap: As scipy.signal.welch.
+        detrend (str or bool): 'linear', 'constant' or False.
+
+    Returns:
+        psd (array): rows x (nperseg // 2 + 1).
+    """
+    step = nperseg - noverlap
+    segments = np.lib.stride_tricks.sliding_window_view(rows, nperseg, axis=-1)[:, ::step]
+    if detrend in ('linear', 'constant'):
+        # remove the least-squares fit: project onto the orthonormal basis of [1, t] (or [1])
+        basis = np.vander(np.arange(nperseg, dtype=float), 2 if detrend == 'linear' else 1)
+        q, _ = np.linalg.qr(basis)
+        segments = segments - (segments @ q) @ q.T
+    elif detrend:
+        raise ValueError("Invalid detrend. Choose 'linear', 'constant' or False.")
+    win = scipy.signal.get_window('hann', nperseg)
+    spec = np.abs(np.fft.rfft(segments * win, axis=-1)) ** 2 / (fs * (win ** 2).sum())
+    # one-sided spectrum: double all bins but DC (and Nyquist for even nperseg)
+    spec[..., 1:nperseg // 2 + nperseg % 2] *= 2
+    return spec.mean(1)
+
+
+def _welch_chunk(rows, welch_kw, method):
+    if method == 'scipy':
+        return scipy.signal.welch(rows, axis=-1, **welch_kw)[1]
+    return welch_rows(rows, **welch_kw)
+
+
+def cohort_psd(data, window, rois=None, chunk_rows=4096, workers=None, executor='thread', method='fast', cache=None,
+               **welch_kw):
+    """
+    Welch PSD of the window of every subject in one stacked, chunked call.
+
+    Args:
+        data (list or array): Subject arrays (... x time); leading shapes may differ between subjects.
+        window (tuple): (start, stop) samples of the analysis window.
+        rois (array): ROIs (first axis) for which the PSD is computed, all if None.
+        chunk_rows (int): Number of time series per welch call.
+        workers (int): Size of the pool (None: run the chunks in this process).
+        executor (str): 'thread' or 'process' pool.
+        method (str): 'fast' (welch_rows) or 'scipy' (scipy.signal.welch).
+        cache (FeatureCache): Reuse the PSDs of subjects whose window data and parameters were seen before.
+        **welch_kw: Overrides of WELCH.
+
+    Returns:
+        freqs (array): Frequencies of the PSD bins.
+        psd (list): PSD of every subject (... x freq).
+    """
+    welch_kw = dict(WELCH, **welch_kw)
+    start, stop = window
+    data = [np.asarray(x)[..., start:stop] if rois is None else np.asarray(x)[rois, ..., start:stop] for x in data]
+    # scipy shortens nperseg to the window length; keep noverlap below it
+    welch_kw['nperseg'] = min(welch_kw['nperseg'], stop - start)
+    welch_kw['noverlap'] = min(welch_kw['noverlap'], welch_kw['nperseg'] - 1)
+    freqs = np.fft.rfftfreq(welch_kw['nperseg'], 1 / welch_kw['fs'])
+
+    # the key covers the windowed ROI data, so window and ROI set need not be part of the parameters
+    psd = cached_per_subject(cache, 'psd', dict(welch_kw, method=method), data,
+                             lambda todo: _stacked_psd(todo, welch_kw, chunk_rows, workers, executor, method))
+    return freqs, psd
+
+
+def _stacked_psd(data, welch_kw, chunk_rows, workers, executor, method):
+    shapes = [x.shape[:-1] for x in data]
+    rows = np.concatenate([x.reshape(-1, x.shape[-1]) for x in data])
+    chunks = [rows[i:i + chunk_rows] for i in range(0, len(rows), chunk_rows)]
+    if workers is None or len(chunks) == 1:
+        psd = [_welch_chunk(chunk, welch_kw, method) for chunk in chunks]
+    else:
+        pool = ThreadPoolExecutor if executor == 'thread' else ProcessPoolExecutor
+        with pool(workers) as ex:
+            psd = list(ex.map(_welch_chunk, chunks, [welch_kw] * len(chunks), [method] * len(chunks)))
+    psd = np.concatenate(psd)
+
+    out, i = [], 0
+    for shape in shapes:
+        n = int(np.prod(shape))
+        out.append(psd[i:i + n].reshape(shape + (psd.shape[-1],)))
+        i += n
+    return out
+
+
+# -----------------------------
+# Band Power per ROI
+# -----------------------------
+def band_power(data, window, bins=BETA_BINS, rois=None, cache=None, **kwargs):
+    """
+    Mean PSD over the frequency bins of a band for every subject, ROI (and trial).
+
+    Args:
+        data (list or array): Subject arrays (ROI x ... x time).
+        window (tuple): (start, stop) samples of the analysis window (EMP_WINDOW or SIM_WINDOW).
+        bins (tuple): (start, stop) PSD bins of the band (BETA_BINS).
+        rois (array): ROIs kept (first axis), all if None.
+        cache (FeatureCache): Reuse band powers (and PSDs) computed before from the same data and parameters.
+        **kwargs: Passed to cohort_psd (chunk_rows, workers, executor, Welch overrides).
+
+    Returns:
+        power (array or list): subject x ROI (x trial) array if all subjects have the same shape,
+            else one ROI (x trial) array per subject.
+    """
+    start, stop = window
+    data = [np.asarray(x)[..., start:stop] if rois is None else np.asarray(x)[rois, ..., start:stop] for x in data]
+
+    def compute(todo):
+        # window and ROIs are already applied
+        _, psd = cohort_psd(todo, (0, stop - start), cache=cache, **kwargs)
+        return [p[..., bins[0]:bins[1]].mean(-1) for p in psd]
+
+    # the pool settings do not change the result and are not part of the key
+    params = {key: value for key, value in dict(WELCH, **kwargs).items()
+              if key not in ('chunk_rows', 'workers', 'executor')}
+    power = cached_per_subject(cache, 'band', dict(params, bins=list(bins)), data, compute)
+    if len({p.shape for p in power}) == 1:
+        return np.stack(power)
+    return power
+
+
+def band_power_table(power, subjects, rois=None, **columns):
+    """
+    Tidy table of band powers: one row per subject, ROI (and trial).
+
+    Args:
+        power (array or list): Output of band_power.
+        subjects (list): Subject IDs.
+        rois (array): ROI number of every row of the ROI axis (0..n-1 if None).
+        **columns: Constant columns added to the table (e.g. condition='verb', kind='simulated').
+
+    Returns:
+        df (DataFrame): subject, roi, trial (empirical trials only), power and the extra columns.
+    """
+    import pandas as pd
+    frames = []
+    for subj, p in zip(subjects, power):
+        p = np.asarray(p)
+        roi = np.arange(p.shape[0]) if rois is None else np.asarray(rois)
+        if p.ndim == 1:
+            frame = pd.DataFrame({'subject': subj, 'roi': roi, 'power': p})
+        else:
+            trial = np.arange(p.shape[1])
+            frame = pd.DataFrame({'subject': subj, 'roi': np.repeat(roi, p.shape[1]),
+                                  'trial': np.tile(trial, p.shape[0]), 'power': p.reshape(-1)})
+        frames.append(frame)
+    df = pd.concat(frames, ignore_index=True)
+    for key, value in columns.items():
+        df[key] = value
+    return df
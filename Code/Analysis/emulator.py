@@ -0,0 +1,505 @@
+"""
+Gaussian-process emulator of the frontal beta ERD/S and LI of fitted models as a function of model parameters
+(e.g. local inhibition c4 and the frontal interhemispheric P->I coupling) and of the subject's connectome.
+
+A Simulator holds the NumPy values (JR_Model_Fitting.export_numpy_model) of a subject's verb and noise fits.
+For a parameter setting it sets the scalar parameters, scales interhemispheric coupling blocks (JR_Atlas), runs
+both fits with the NumPy engine (same seed, so settings differ by their parameters and not by the noise) and
+returns the outputs of OUTPUTS: mean verb - noise beta power of the right and left frontal ROIs and the LI of the
+difference (laterality.simulated_laterality, in the empirically significant regions if given, else in all
+frontal ROIs). Batches of settings run in worker processes.
+
+The GaussianProcess maps [parameters scaled to the unit cube, connectome embedding] to the standardised outputs
+with one ARD squared-exponential kernel shared by all outputs; its hyperparameters maximise the log marginal
+likelihood (analytic gradient, L-BFGS-B). Predictions (mean and standard deviation) of thousands of settings take
+milliseconds. acquire picks the next batch of simulations among candidate settings (largest predictive variance,
+UCB of an output or straddling a level such as LI = 0), conditioning the variance on the points already picked.
+
+    space = ParameterSpace({'c4': (25, 45), 'fr_p2i': (0, 2)})    # c4 value, scale of the fitted fr P->I blocks
+    sims = [Simulator(jr.export_numpy_model(jr.load_fit(v)), jr.export_numpy_model(jr.load_fit(n)))]
+    em, X, Y, subjects = active_learning(sims, space, n_init=32, iterations=4, batch=8, workers=8)
+    mean, std = em.map('c4', 'fr_p2i', n=100, embedding=sims[0].embedding)    # 100 x 100 x output
+    em.save('emulator.npz')
+
+    python emulator.py verb_fit.pkl noise_fit.pkl --bounds c4 25 45 --bounds fr_p2i 0 2 --workers 8
+"""
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.linalg import cho_solve, cholesky, solve_triangular
+from scipy.optimize import minimize
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from JR_Atlas import atlas  # noqa: E402
+from JR_Numpy import JRNumpy, scalar_names  # noqa: E402
+from beta_features import SIM_WINDOW, band_power  # noqa: E402
+from laterality import simulated_laterality  # noqa: E402
+
+OUTPUTS = ('beta_diff_right', 'beta_diff_left', 'LI')
+
+# coupling labels of the scale parameters (<scope>_<label>[_<direction>]) and their export_numpy_model keys
+COUPLINGS = {'p2i': 'w_n_b', 'p2e': 'w_n_f', 'p2p': 'w_n_l'}
+
+
+# -----------------------------
+# Parameters
+# -----------------------------
+class ParameterSpace:
+    """
+    Box of parameter settings
+    Attributes
+    ----------
+    names: list
+        scalar parameters of JR_Numpy (absolute values, e.g. c4) or coupling scales <scope>_<label>[_<direction>]
+        (fr_p2i: both frontal interhemispheric blocks of the P->I coupling, wb_p2e_L2R: ...)
+    lower, upper: arrays
+        bounds of every parameter
+    """
+
+    def __init__(self, bounds):
+        for name in bounds:
+            parse_parameter(name)
+        self.names = list(bounds)
+        self.lower = np.array([float(bounds[name][0]) for name in self.names])
+        self.upper = np.array([float(bounds[name][1]) for name in self.names])
+
+    def sample(self, n, seed=None):
+        """
+        n settings (n x parameter) of a Latin hypercube.
+        """
+        from scipy.stats import qmc
+        return self.from_unit(qmc.LatinHypercube(len(self.names), seed=seed).random(n))
+
+    def to_unit(self, X):
+        return (np.asarray(X, dtype=float) - self.lower) / (self.upper - self.lower)
+
+    def from_unit(self, U):
+        return self.lower + np.asarray(U, dtype=float) * (self.upper - self.lower)
+
+    def dicts(self, X):
+        return [dict(zip(self.names, map(float, x))) for x in np.atleast_2d(X)]
+
+
+def parse_parameter(name):
+    """
+    (scalar name, None, None) or (scope, coupling key, directions) of a parameter name.
+    """
+    if name in scalar_names:
+        return name, None, None
+    parts = name.split('_')
+    if len(parts) in (2, 3) and parts[0] in ('fr', 'wb') and parts[1] in COUPLINGS \
+            and (len(parts) == 2 or parts[2] in ('L2R', 'R2L')):
+        return parts[0], COUPLINGS[parts[1]], parts[2:] or ['L2R', 'R2L']
+    raise ValueError('unknown parameter %r (JR_Numpy.scalar_names or <fr|wb>_<%s>[_L2R|_R2L])'
+                     % (name, '|'.join(COUPLINGS)))
+
+
+def apply_parameters(values, params):
+    """
+    Copy of export_numpy_model values with the scalar parameters set and the coupling blocks scaled.
+    """
+    values = dict(values)
+    shen = atlas(len(values['w_n_l']))
+    copied = set()
+    for name, x in params.items():
+        scope, key, directions = parse_parameter(name)
+        if key is None:
+            values[name] = x
+            continue
+        if key not in copied:
+            values[key] = np.array(values[key], dtype=np.float64)
+            copied.add(key)
+        for direction in directions:
+            values[key][shen.blocks[scope + '_' + direction]] *= x
+    return values
+
+
+def connectome_embedding(values, k=2):
+    """
+    Connectome features of a fit: frontal and whole-brain interhemispheric means (int = (L2R + R2L) / 2) of the
+    P->I, P->E and P->P couplings and the k largest eigenvalues of the P->P coupling.
+    """
+    w_n_l = np.asarray(values['w_n_l'], dtype=float)
+    means = atlas(len(w_n_l)).block_means(np.stack([values[key] for key in COUPLINGS.values()]))
+    features = [(means[scope + '_L2R'] + means[scope + '_R2L']) / 2 for scope in ('fr', 'wb')]
+    eig = np.linalg.eigvalsh((w_n_l + w_n_l.T) / 2)[::-1][:k]
+    return np.concatenate(features + [eig])
+
+
+# -----------------------------
+# Simulation
+# -----------------------------
+class Simulator:
+    """
+    Beta ERD/S and LI of one subject (verb and noise fits) for parameter settings; holds NumPy arrays only, so
+    it can be sent to worker processes
+    Attributes
+    ----------
+    verb, noise: dicts
+        export_numpy_model values of the two fits
+    positive, negative: boolean arrays or None
+        significant empirical frontal regions (right first, as LIHybrid_Age.py); all frontal ROIs if None
+    length, base_window_num, seed:
+        as JRNumpy.simulate (stimulus of JR_CLI simulate --numpy)
+    embedding: array
+        connectome_embedding of the verb fit
+    """
+
+    def __init__(self, verb, noise, positive=None, negative=None, length=1500, base_window_num=250, seed=0):
+        self.verb, self.noise = verb, noise
+        self.shen = atlas(len(verb['w_n_l']))
+        n_regions = len(self.shen.frontal)
+        self.sig = np.ones(n_regions, dtype=bool) if positive is None else np.asarray(positive) | negative
+        self.length, self.base_window_num, self.seed = length, base_window_num, seed
+        self.embedding = connectome_embedding(verb)
+
+    def source(self, values):
+        model = JRNumpy(values, values['steps_per_TR'], values['TRs_per_window'])
+        u = np.zeros((model.node_size, model.steps_per_TR, self.length))
+        u[:, :, 100:140] = 5000
+        return model.simulate(u, self.base_window_num, self.seed)['P']
+
+    def __call__(self, params):
+        """
+        OUTPUTS of one setting (dict of parameter values).
+        """
+        P = [self.source(apply_parameters(values, params)) for values in (self.verb, self.noise)]
+        v_beta, n_beta = band_power(P, SIM_WINDOW, rois=self.shen.frontal)
+        diff = v_beta - n_beta
+        LI, _ = simulated_laterality(v_beta, n_beta, self.sig, np.zeros_like(self.sig))
+        pos = self.shen.frontal_pos
+        return np.array([diff[pos['right']].mean(), diff[pos['left']].mean(), LI])
+
+
+def _simulate(args):
+    simulator, params = args
+    return simulator(params)
+
+
+def run_batch(simulators, space, X, subjects=None, workers=None):
+    """
+    Simulate settings X (n x parameter) of the subjects (index into simulators, all 0 if None).
+
+    Returns:
+        Y (array): n x output.
+    """
+    subjects = np.zeros(len(X), dtype=int) if subjects is None else subjects
+    jobs = [(simulators[s], params) for s, params in zip(subjects, space.dicts(X))]
+    if workers is None or len(jobs) < 2:
+        return np.array(list(map(_simulate, jobs)))
+    with ProcessPoolExecutor(workers) as ex:
+        return np.array(list(ex.map(_simulate, jobs)))
+
+
+# -----------------------------
+# Gaussian Process
+# -----------------------------
+class GaussianProcess:
+    """
+    Multi-output GP regression with an ARD squared-exponential kernel shared by the (standardised) outputs
+    Attributes
+    ----------
+    lengthscales: array
+        one per (standardised) input
+    signal, noise: float
+        kernel variance and noise variance (in standardised output units)
+    """
+
+    def __init__(self, min_noise=1e-6):
+        self.min_noise = min_noise
+        self.lengthscales = self.signal = self.noise = None
+
+    def _kernel(self, A, B, ell, sf2):
+        d2 = (((A[:, None, :] - B[None, :, :]) / ell) ** 2).sum(-1)
+        return sf2 * np.exp(-0.5 * d2)
+
+    def _nlml(self, theta, X, Y):
+        d = X.shape[1]
+        ell, sf2, sn2 = np.exp(theta[:d]), np.exp(theta[d]), np.exp(theta[d + 1]) + self.min_noise
+        n, m = Y.shape
+        diff2 = (X[:, None, :] - X[None, :, :]) ** 2
+        K0 = sf2 * np.exp(-0.5 * (diff2 / ell ** 2).sum(-1))
+        try:
+            L = cholesky(K0 + sn2 * np.eye(n), lower=True)
+        except np.linalg.LinAlgError:
+            return 1e10, np.zeros_like(theta)
+        alpha = cho_solve((L, True), Y)
+        nlml = 0.5 * (Y * alpha).sum() + m * np.log(np.diag(L)).sum() + 0.5 * n * m * np.log(2 * np.pi)
+        # d nlml / d theta = 0.5 tr((m K^-1 - alpha alpha^T) dK / d theta)
+        W = m * cho_solve((L, True), np.eye(n)) - alpha @ alpha.T
+        grad = np.empty_like(theta)
+        WK = W * K0
+        grad[:d] = 0.5 * np.einsum('ij,ijk->k', WK, diff2) / ell ** 2
+        grad[d] = 0.5 * WK.sum()
+        grad[d + 1] = 0.5 * np.trace(W) * (sn2 - self.min_noise)
+        return nlml, grad
+
+    def fit(self, X, Y, restarts=3, seed=0):
+        """
+        Standardise inputs and outputs and fit the hyperparameters (best of restarts random starts).
+
+        Args:
+            X (array): n x input.
+            Y (array): n x output.
+        """
+        X, Y = np.asarray(X, dtype=float), np.asarray(Y, dtype=float).reshape(len(X), -1)
+        self.x_mean, self.x_std = X.mean(0), X.std(0)
+        self.x_std[self.x_std == 0] = 1
+        self.y_mean, self.y_std = Y.mean(0), Y.std(0)
+        self.y_std[self.y_std == 0] = 1
+        self.X, self.Y = (X - self.x_mean) / self.x_std, (Y - self.y_mean) / self.y_std
+
+        d = X.shape[1]
+        rng = np.random.default_rng(seed)
+        bounds = [(np.log(1e-2), np.log(1e2))] * d + [(np.log(1e-2), np.log(1e2)), (np.log(1e-8), 0)]
+        starts = [np.r_[np.zeros(d), 0, np.log(1e-2)]]
+        starts += [np.r_[rng.uniform(-1, 1.5, d), rng.uniform(-1, 1), rng.uniform(-8, -2)] for _ in range(restarts)]
+        best = None
+        for theta0 in starts:
+            res = minimize(self._nlml, theta0, args=(self.X, self.Y), jac=True, method='L-BFGS-B', bounds=bounds)
+            if best is None or res.fun < best.fun:
+                best = res
+        self.set_hyperparameters(best.x)
+        return self
+
+    def set_hyperparameters(self, theta):
+        d = self.X.shape[1]
+        self.theta = np.asarray(theta, dtype=float)
+        self.lengthscales, self.signal = np.exp(self.theta[:d]), np.exp(self.theta[d])
+        self.noise = np.exp(self.theta[d + 1]) + self.min_noise
+        K = self._kernel(self.X, self.X, self.lengthscales, self.signal)
+        self.L = cholesky(K + self.noise * np.eye(len(self.X)), lower=True)
+        self.alpha = cho_solve((self.L, True), self.Y)
+
+    def _cross(self, X):
+        return self._kernel((np.asarray(X, dtype=float) - self.x_mean) / self.x_std, self.X, self.lengthscales,
+                            self.signal)
+
+    def predict(self, X, return_std=True, chunk=8192):
+        """
+        Posterior mean (and standard deviation of the latent function) in output units.
+
+        Returns:
+            mean (array): n x output.
+            std (array): n x output.
+        """
+        X = np.atleast_2d(np.asarray(X, dtype=float))
+        mean, var = np.empty((len(X), self.Y.shape[1])), np.empty(len(X))
+        for i in range(0, len(X), chunk):
+            Ks = self._cross(X[i:i + chunk])
+            mean[i:i + chunk] = Ks @ self.alpha
+            if return_std:
+                A = solve_triangular(self.L, Ks.T, lower=True)
+                var[i:i + chunk] = np.maximum(self.signal - (A ** 2).sum(0), 0)
+        mean = mean * self.y_std + self.y_mean
+        if not return_std:
+            return mean
+        return mean, np.sqrt(var)[:, None] * self.y_std
+
+    def acquire(self, candidates, n, rule='variance', output=0, beta=2.0, level=0.0):
+        """
+        Greedy batch of candidates to simulate next; after each pick the variance of the others is conditioned on
+        it (the mean is kept, so no simulation result is needed within a batch).
+
+        Args:
+            candidates (array): m x input.
+            n (int): Batch size.
+            rule (str): 'variance' (largest predictive variance), 'ucb' (mean + beta std of output) or 'straddle'
+                (beta std - |mean - level| of output: settings close to a level such as LI = 0).
+            output (int): Output of 'ucb' and 'straddle'.
+
+        Returns:
+            picks (array): Indices into candidates.
+        """
+        C = np.atleast_2d(np.asarray(candidates, dtype=float))
+        Ks = self._cross(C)
+        A = solve_triangular(self.L, Ks.T, lower=True)
+        var = np.maximum(self.signal - (A ** 2).sum(0), 0)
+        mean = (Ks @ self.alpha[:, output]) * self.y_std[output] + self.y_mean[output]
+        Cz = (C - self.x_mean) / self.x_std
+        picks, cols = [], []
+        for _ in range(min(n, len(C))):
+            std = np.sqrt(var) * self.y_std[output]
+            if rule == 'variance':
+                score = var.copy()
+            elif rule == 'ucb':
+                score = mean + beta * std
+            elif rule == 'straddle':
+                score = beta * std - np.abs(mean - level)
+            else:
+                raise ValueError('rule must be variance, ucb or straddle')
+            score[picks] = -np.inf
+            s = int(np.argmax(score))
+            picks.append(s)
+            k = self._kernel(Cz, Cz[s:s + 1], self.lengthscales, self.signal)[:, 0] - A.T @ A[:, s]
+            for col in cols:
+                k -= col * col[s]
+            col = k / np.sqrt(max(k[s], 0) + self.noise)
+            var = np.maximum(var - col ** 2, 0)
+            cols.append(col)
+        return np.array(picks)
+
+
+# -----------------------------
+# Emulator
+# -----------------------------
+class Emulator:
+    """
+    GaussianProcess of OUTPUTS over [unit-scaled parameters of a ParameterSpace, connectome embedding]
+    Attributes
+    ----------
+    space: ParameterSpace
+    outputs: tuple
+    gp: GaussianProcess
+    """
+
+    def __init__(self, space, outputs=OUTPUTS):
+        self.space, self.outputs = space, tuple(outputs)
+        self.gp = GaussianProcess()
+
+    def inputs(self, X, embedding=None):
+        U = self.space.to_unit(np.atleast_2d(X))
+        if embedding is None:
+            return U
+        E = np.broadcast_to(np.asarray(embedding, dtype=float), (len(U), np.shape(embedding)[-1]))
+        return np.hstack([U, E])
+
+    def fit(self, X, Y, embedding=None, **kwargs):
+        """
+        Fit to settings X (n x parameter), outputs Y (n x output) and embeddings (n x feature or one row).
+        """
+        self.gp.fit(self.inputs(X, embedding), Y, **kwargs)
+        return self
+
+    def predict(self, X, embedding=None):
+        """
+        Mean and standard deviation (n x output) of settings X.
+        """
+        return self.gp.predict(self.inputs(X, embedding))
+
+    def map(self, x_name, y_name, n=50, fixed=None, embedding=None):
+        """
+        Mean and standard deviation over an n x n grid of two parameters (rows: x_name), the others at fixed
+        (default: centre of the space).
+
+        Returns:
+            grid_x, grid_y (array): Grid values.
+            mean, std (array): n x n x output.
+        """
+        fixed = dict(fixed or {})
+        centre = (self.space.lower + self.space.upper) / 2
+        base = np.array([fixed.get(name, c) for name, c in zip(self.space.names, centre)])
+        i, j = self.space.names.index(x_name), self.space.names.index(y_name)
+        grid_x = np.linspace(self.space.lower[i], self.space.upper[i], n)
+        grid_y = np.linspace(self.space.lower[j], self.space.upper[j], n)
+        X = np.tile(base, (n * n, 1))
+        X[:, i], X[:, j] = np.repeat(grid_x, n), np.tile(grid_y, n)
+        mean, std = self.predict(X, embedding)
+        return grid_x, grid_y, mean.reshape(n, n, -1), std.reshape(n, n, -1)
+
+    def save(self, filename):
+        gp = self.gp
+        np.savez(filename, names=np.array(self.space.names), lower=self.space.lower, upper=self.space.upper,
+                 outputs=np.array(self.outputs), X=gp.X, Y=gp.Y, theta=gp.theta, min_noise=gp.min_noise,
+                 x_mean=gp.x_mean, x_std=gp.x_std, y_mean=gp.y_mean, y_std=gp.y_std)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            space = ParameterSpace({name: (lo, hi) for name, lo, hi in
+                                    zip(data['names'].tolist(), data['lower'], data['upper'])})
+            em = cls(space, data['outputs'].tolist())
+            gp = em.gp
+            gp.min_noise = float(data['min_noise'])
+            for key in ('X', 'Y', 'x_mean', 'x_std', 'y_mean', 'y_std'):
+                setattr(gp, key, data[key])
+            gp.set_hyperparameters(data['theta'])
+        return em
+
+
+def active_learning(simulators, space, n_init=32, iterations=4, batch=8, candidates=2048, rule='variance',
+                    output=0, workers=None, seed=0, callback=None):
+    """
+    Simulate a Latin hypercube of settings, then alternately fit the emulator and simulate the batch picked by
+    acquire among random candidate (setting, subject) pairs.
+
+    Args:
+        simulators (list): Simulator of every subject.
+        space (ParameterSpace): Parameters and bounds.
+        n_init (int): Initial simulations (subjects drawn at random).
+        iterations (int): Acquisition rounds.
+        batch (int): Simulations per round.
+        candidates (int): Candidate settings per round.
+        rule, output: As GaussianProcess.acquire.
+        workers (int): Worker processes of the simulations.
+        seed (int): Random seed.
+        callback (callable): Called with (iteration, emulator, X, Y, subjects) after every fit.
+
+    Returns:
+        emulator (Emulator): Fitted to all simulations.
+        X, Y (array): Settings and outputs of all simulations.
+        subjects (array): Subject (index into simulators) of every simulation.
+    """
+    rng = np.random.default_rng(seed)
+    embeddings = np.array([sim.embedding for sim in simulators])
+    X = space.sample(n_init, seed=rng)
+    subjects = rng.integers(len(simulators), size=n_init)
+    Y = run_batch(simulators, space, X, subjects, workers)
+    em = Emulator(space)
+    for it in range(iterations + 1):
+        em.fit(X, Y, embeddings[subjects], seed=seed + it)
+        if callback is not None:
+            callback(it, em, X, Y, subjects)
+        if it == iterations:
+            break
+        cand_X = space.sample(candidates, seed=rng)
+        cand_s = rng.integers(len(simulators), size=candidates)
+        picks = em.gp.acquire(em.inputs(cand_X, embeddings[cand_s]), batch, rule, output)
+        X, subjects = np.vstack([X, cand_X[picks]]), np.r_[subjects, cand_s[picks]]
+        Y = np.vstack([Y, run_batch(simulators, space, cand_X[picks], cand_s[picks], workers)])
+    return em, X, Y, subjects
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('fits', nargs='+', help='verb and noise fits (*_fittingresults_stim_exp.pkl) of every '
+                                                'subject, in pairs')
+    parser.add_argument('--bounds', nargs=3, action='append', metavar=('NAME', 'LOW', 'HIGH'),
+                        help='parameter and bounds; default c4 25 45 and fr_p2i 0 2')
+    parser.add_argument('--n-init', type=int, default=32)
+    parser.add_argument('--iterations', type=int, default=4)
+    parser.add_argument('--batch', type=int, default=8)
+    parser.add_argument('--rule', default='variance', choices=['variance', 'ucb', 'straddle'])
+    parser.add_argument('--output', default='LI', choices=OUTPUTS, help='output of ucb and straddle')
+    parser.add_argument('--base-windows', type=int, default=250, help='burn-in windows')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='emulator.npz')
+    args = parser.parse_args(argv)
+    if len(args.fits) % 2:
+        parser.error('fits must come in verb/noise pairs')
+
+    import JR_Model_Fitting as jr
+    bounds = {'c4': (25, 45), 'fr_p2i': (0, 2)} if args.bounds is None else \
+        {name: (float(lo), float(hi)) for name, lo, hi in args.bounds}
+    simulators = [Simulator(jr.export_numpy_model(jr.load_fit(verb)), jr.export_numpy_model(jr.load_fit(noise)),
+                            base_window_num=args.base_windows)
+                  for verb, noise in zip(args.fits[::2], args.fits[1::2])]
+
+    def report(it, em, X, Y, subjects):
+        print('round', it, len(X), 'simulations, lengthscales', np.round(em.gp.lengthscales, 3))
+
+    em, X, Y, subjects = active_learning(simulators, ParameterSpace(bounds), args.n_init, args.iterations,
+                                         args.batch, rule=args.rule, output=OUTPUTS.index(args.output),
+                                         workers=args.workers, seed=args.seed, callback=report)
+    em.save(args.out)
+    np.savez(os.path.splitext(args.out)[0] + '_runs.npz', X=X, Y=Y, subjects=subjects)
+    print('saved', args.out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+"""
+Build and incrementally update the parameter table (subject_data.pkl columns) from a directory of fitted models.
+
+Each fit {subject}_{run}_fittingresults_stim_exp.pkl is read through its {subject}_{run}_fields.npz: the scalar
+parameters and normalised couplings (sc_m_b, sc_m_f, sc_fitted) that fit_subject saves next to the checkpoint.
+Fits without it are unpickled once (in a worker process), and the .npz is written for the next run. The
+interhemispheric block means of all couplings come from one product of the flattened coupling matrix with
+the precomputed, normalised ROI block masks of JR_Atlas.
+
+Rows of a coupling matrix are target nodes and columns are source nodes (JR_Atlas), so L2R = mean of w[R, L],
+R2L = mean of w[L, R] and int = (L2R + R2L) / 2. fr_* uses the frontal ROIs of the left and right hemisphere and
+wb_* uses all nodes.
+
+    python extract_params.py path/to/fits params.pkl --workers 8     # only new or changed fits are read
+
+One row per fit (with the file modification time) is kept in <table>.fits.pkl, and the wide table (one row per
+subject: a_verb, ..., fr_int_p2i_verb_L2R, ..., Age) is rewritten from it.
+"""
+import argparse
+import glob
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from JR_Atlas import atlas  # noqa: E402
+
+fit_pattern = re.compile(r'^(CTL_\d+_\d+|sub-[^_]+)_(.+)_fittingresults_stim_exp\.pkl$')
+
+# couplings (fit_fields) and their column labels; P->P (symmetrised) has no direction
+COUPLINGS = {'sc_m_b': 'p2i', 'sc_m_f': 'p2e', 'sc_fitted': 'p2p'}
+DIRECTED = ('p2i', 'p2e')
+
+
+# -----------------------------
+# One Fit
+# -----------------------------
+def read_fit_fields(filename):
+    """
+    fit_fields of a fitted checkpoint, from its _fields.npz if it is up to date (else from the pickle, writing
+    the .npz).
+    """
+    from_npz = filename.replace('_fittingresults_stim_exp.pkl', '_fields.npz')
+    if os.path.exists(from_npz) and os.path.getmtime(from_npz) >= os.path.getmtime(filename):
+        with np.load(from_npz) as data:
+            return {key: data[key] for key in data.files}
+    import JR_Model_Fitting as jr
+    fields = jr.fit_fields(jr.load_fit(filename))
+    try:
+        jr.save_params(fields, from_npz)
+    except OSError:
+        pass
+    return fields
+
+
+def summarise_fit(filename):
+    """
+    Summary row of one fit: subject, run, condition, mtime, the scalar parameters and the block means.
+    """
+    subject, run = fit_pattern.match(os.path.basename(filename)).groups()
+    fields = read_fit_fields(filename)
+    row = {'file': os.path.abspath(filename), 'mtime': os.path.getmtime(filename), 'subject': subject, 'run': run,
+           'condition': run.split('_')[0]}
+    for key, value in fields.items():
+        if np.size(value) == 1:
+            row[key] = float(np.ravel(value)[0])
+    means = {}
+    for key, label in COUPLINGS.items():
+        if key in fields:
+            means[label] = atlas(len(fields[key])).block_means(fields[key])
+    for scope in ('fr', 'wb'):
+        for label, m in means.items():
+            l2r, r2l = float(m[scope + '_L2R']), float(m[scope + '_R2L'])
+            row['%s_int_%s' % (scope, label)] = (l2r + r2l) / 2
+            if label in DIRECTED:
+                row['%s_int_%s_L2R' % (scope, label)] = l2r
+                row['%s_int_%s_R2L' % (scope, label)] = r2l
+    return row
+
+
+# -----------------------------
+# Table
+# -----------------------------
+def wide_table(fits, conditions=('verb', 'noise')):
+    """
+    One row per subject with <field>_<condition> columns (directions last: fr_int_p2i_verb_L2R) and Age.
+    """
+    import pandas as pd
+    from JR_SimStore import parse_subject
+    fields = [c for c in fits.columns if c not in ('file', 'mtime', 'subject', 'run', 'condition')]
+    wide = fits[fits['condition'].isin(conditions)].pivot_table(index='subject', columns='condition',
+                                                                 values=fields, aggfunc='last')
+    # subject_data.pkl order: a_verb, a_noise, ..., fr_int_p2i_verb, fr_int_p2i_verb_L2R, fr_int_p2i_verb_R2L, ...
+    bases = [field for field in fields if not field.endswith(('_L2R', '_R2L'))]
+    columns = {}
+    for base in bases:
+        for condition in conditions:
+            for direction in ('', '_L2R', '_R2L'):
+                if (base + direction, condition) in wide.columns:
+                    columns['%s_%s%s' % (base, condition, direction)] = wide[(base + direction, condition)]
+    table = pd.DataFrame(columns, index=wide.index)
+    table['Age'] = [parse_subject(s)[1] for s in table.index]
+    return table.reset_index()
+
+
+def update_table(fits_dir, table_path, workers=None, conditions=('verb', 'noise')):
+    """
+    Summarise the new or changed fits of fits_dir and rewrite the wide table.
+
+    Args:
+        fits_dir (str): Directory of *_fittingresults_stim_exp.pkl files.
+        table_path (str): Wide table (.pkl); the per-fit rows are kept in <table_path>.fits.pkl.
+        workers (int): Number of worker processes (None: read the fits in this process).
+        conditions (tuple): Conditions (first token of the run name) in the wide table.
+
+    Returns:
+        table (DataFrame): Wide table.
+        n_new (int): Number of fits read.
+    """
+    import pandas as pd
+    fits_path = table_path + '.fits.pkl'
+    fits = pd.read_pickle(fits_path) if os.path.exists(fits_path) else pd.DataFrame(columns=['file', 'mtime'])
+    known = dict(zip(fits['file'], fits['mtime']))
+    files = [os.path.abspath(f) for f in sorted(glob.glob(os.path.join(fits_dir, '*_fittingresults_stim_exp.pkl')))
+             if fit_pattern.match(os.path.basename(f))]
+    todo = [f for f in files if known.get(f) != os.path.getmtime(f)]
+
+    if todo:
+        if workers is None:
+            rows = [summarise_fit(f) for f in todo]
+        else:
+            with ProcessPoolExecutor(workers) as ex:
+                rows = list(ex.map(summarise_fit, todo, chunksize=4))
+        new = pd.DataFrame(rows)
+        fits = pd.concat([fits[~fits['file'].isin(new['file'])], new], ignore_index=True)
+        fits.to_pickle(fits_path)
+
+    table = wide_table(fits, conditions) if len(fits) else pd.DataFrame()
+    table.to_pickle(table_path)
+    return table, len(todo)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('fits_dir', help='directory of *_fittingresults_stim_exp.pkl')
+    parser.add_argument('table', help='wide parameter table (.pkl)')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--conditions', nargs='+', default=['verb', 'noise'])
+    args = parser.parse_args(argv)
+    table, n_new = update_table(args.fits_dir, args.table, args.workers, tuple(args.conditions))
+    print(n_new, 'fits read,', len(table), 'subjects in', args.table)
+
+
+if __name__ == '__main__':
+    main()
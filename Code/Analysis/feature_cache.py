@@ -0,0 +1,138 @@
+"""
+On-disk, content-addressed cache of derived features (PSDs, band powers) shared by the analysis scripts.
+
+An entry is keyed by the hash of the input data it was computed from and of the analysis parameters
+(window, nperseg, noverlap, band, ROI set, ...), so the same numbers are reused across scripts and
+sessions and any change of data or parameters is a miss. Entries are .npy files; once the cache grows
+beyond max_bytes the least recently used ones are evicted.
+
+    cache = FeatureCache()                                   # ~/.cache/jr_features (or $JR_FEATURE_CACHE)
+    beta = band_power(Adol_sim_verb, SIM_WINDOW, rois=frontal_rois, cache=cache)
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+
+default_path = os.environ.get('JR_FEATURE_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'jr_features'))
+
+
+class FeatureCache:
+    """
+    Content-addressed .npy cache with LRU eviction.
+
+    Args:
+        path (str): Cache directory.
+        max_bytes (int): Size budget of the cache directory.
+    """
+
+    def __init__(self, path=default_path, max_bytes=2 * 1024 ** 3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        """
+        Hash of arrays (dtype, shape and content) and JSON-serialisable parameters.
+        """
+        h = hashlib.blake2b(digest_size=20)
+        for part in parts:
+            if isinstance(part, np.ndarray):
+                h.update(('%s%s' % (part.dtype.str, part.shape)).encode())
+                h.update(np.ascontiguousarray(part).data)
+            else:
+                h.update(json.dumps(part, sort_keys=True, default=_to_json).encode())
+        return h.hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.npy')
+
+    def get(self, key):
+        """
+        Cached array or None; a hit marks the entry as recently used.
+        """
+        filename = self._file(key)
+        try:
+            value = np.load(filename)
+        except (FileNotFoundError, ValueError, EOFError):
+            self.misses += 1
+            return None
+        os.utime(filename)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        filename = self._file(key)
+        tmp = filename + '.%d.tmp' % os.getpid()
+        with open(tmp, 'wb') as f:
+            np.save(f, value)
+        os.replace(tmp, filename)
+        self.evict()
+
+    def entries(self):
+        """
+        (mtime, size, filename) of all entries, least recently used first.
+        """
+        out = []
+        for name in os.listdir(self.path):
+            if name.endswith('.npy'):
+                try:
+                    st = os.stat(os.path.join(self.path, name))
+                except FileNotFoundError:
+                    continue
+                out.append((st.st_mtime, st.st_size, os.path.join(self.path, name)))
+        return sorted(out)
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, filename in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        for _, _, filename in self.entries():
+            os.remove(filename)
+
+
+def _to_json(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError('Unhashable parameter %r' % (value,))
+
+
+def cached_per_subject(cache, kind, params, data, compute):
+    """
+    Per-subject results of compute(list of subject arrays), computed only for the subjects missing in cache.
+
+    Args:
+        cache (FeatureCache or None): Cache (compute everything if None).
+        kind (str): Name of the feature (part of the key).
+        params (dict): Analysis parameters (part of the key).
+        data (list): Subject arrays the features are computed from.
+        compute (callable): list of subject arrays -> list of results.
+
+    Returns:
+        results (list): One array per subject.
+    """
+    if cache is None:
+        return compute(data)
+    keys = [cache.key(kind, params, np.asarray(x)) for x in data]
+    results = [cache.get(k) for k in keys]
+    todo = [i for i, r in enumerate(results) if r is None]
+    if todo:
+        for i, value in zip(todo, compute([data[i] for i in todo])):
+            cache.put(keys[i], value)
+            results[i] = value
+    return results
@@ -0,0 +1,199 @@
+"""
+Group mean, variance (and median) of the effective couplings of fitted checkpoints: the donor matrices of the
+virtual transplants (avg_{group}_sc_p2i.npy, read by transplant_fit and virtual_P2I_transplant.py).
+
+The fits of a group are streamed one at a time (through their _fields.npz, see extract_params.py) into Welford
+accumulators, so memory does not grow with the size of the cohort; groups run in parallel worker processes.
+Exact medians need all subjects of an element at once: with --median the matrices are spilled to a float32
+memory map and the median is taken in blocks of rows.
+
+    python group_couplings.py path/to/fits path/to/data --run verb_evoked                 # YC (4-7), Adol (15-18)
+    python group_couplings.py path/to/fits path/to/data --group Y 4 9 --group O 10 18 --median --workers 2
+
+For every group and coupling (p2i: sc_m_b, p2e: sc_m_f, p2p: sc_fitted) it writes avg_{group}_sc_{coupling}.npy
+and var_{group}_sc_{coupling}.npy (and median_{group}_sc_{coupling}.npy).
+"""
+import argparse
+import glob
+import os
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from extract_params import COUPLINGS, fit_pattern, read_fit_fields  # noqa: E402
+
+# age bins (inclusive) of the groups of the paper: young children and adolescents
+GROUPS = {'YC': (4, 7), 'Adol': (15, 18)}
+
+
+class Welford:
+    """
+    Running element-wise mean and variance (Welford's update, Chan's merge of two accumulators)
+    Attributes
+    ----------
+    n: int
+        number of samples
+    mean, m2: arrays
+        running mean and sum of squared deviations (float64)
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.mean = None
+        self.m2 = None
+
+    def update(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        if self.mean is None:
+            self.mean, self.m2 = np.zeros_like(x), np.zeros_like(x)
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+    def merge(self, other):
+        if other.n == 0:
+            return self
+        if self.n == 0:
+            self.n, self.mean, self.m2 = other.n, other.mean.copy(), other.m2.copy()
+            return self
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * other.n / n
+        self.m2 = self.m2 + other.m2 + delta ** 2 * self.n * other.n / n
+        self.n = n
+        return self
+
+    def variance(self, ddof=1):
+        return self.m2 / max(self.n - ddof, 1)
+
+
+def in_group(subject, definition):
+    """
+    Whether a subject (CTL_XX_YY or sub-XX-YYY) belongs to a group: an inclusive (min age, max age) bin,
+    a collection of subject names or a callable of the age.
+    """
+    from JR_SimStore import parse_subject
+    if callable(definition):
+        return bool(definition(parse_subject(subject)[1]))
+    if isinstance(definition, tuple) and len(definition) == 2 and not isinstance(definition[0], str):
+        return definition[0] <= parse_subject(subject)[1] <= definition[1]
+    return subject in definition
+
+
+def group_files(fits_dir, run, groups=GROUPS):
+    """
+    Fitted checkpoints of run in fits_dir for every group.
+    """
+    files = {}
+    for filename in sorted(glob.glob(os.path.join(fits_dir, '*_' + run + '_fittingresults_stim_exp.pkl'))):
+        match = fit_pattern.match(os.path.basename(filename))
+        if match is None or match.group(2) != run:
+            continue
+        for name, definition in groups.items():
+            if in_group(match.group(1), definition):
+                files.setdefault(name, []).append(filename)
+    return {name: files.get(name, []) for name in groups}
+
+
+def aggregate(files, couplings=COUPLINGS, median=False, block_bytes=2 ** 26):
+    """
+    Mean, variance and (optionally) median of every coupling over the fits, streaming one fit at a time. A fit
+    without a coupling in its fit_fields (e.g. a model that never ran a forward pass) is left out of that coupling
+    and counted as missing.
+
+    Args:
+        files (list): Fitted checkpoints of one group.
+        couplings (dict): fit_fields coupling -> label.
+        median (bool): Also compute the element-wise median (spilled to a temporary memory map).
+        block_bytes (int): Size of the row blocks read at once for the median.
+
+    Returns:
+        stats (dict): label -> {'n', 'missing'(, 'mean', 'var', 'median')}; without fits of a coupling only the
+            counts.
+    """
+    acc = {label: Welford() for label in couplings.values()}
+    missing = {label: 0 for label in couplings.values()}
+    spill, tmp = {}, tempfile.TemporaryDirectory() if median else None
+    try:
+        for filename in files:
+            fields = read_fit_fields(filename)
+            for key, label in couplings.items():
+                if key not in fields:
+                    missing[label] += 1
+                    continue
+                if median:
+                    if label not in spill:
+                        spill[label] = np.lib.format.open_memmap(os.path.join(tmp.name, label + '.npy'), 'w+',
+                                                                 np.float32, (len(files),) + fields[key].shape)
+                    spill[label][acc[label].n] = fields[key]
+                acc[label].update(fields[key])
+        stats = {}
+        for label, a in acc.items():
+            stats[label] = {'n': a.n, 'missing': missing[label]}
+            if a.n == 0:
+                continue
+            stats[label].update(mean=a.mean, var=a.variance())
+            if median:
+                stack = spill[label][:a.n]
+                rows = max(1, block_bytes // (stack[0, 0].nbytes * a.n))
+                stats[label]['median'] = np.concatenate([np.median(stack[:, r:r + rows], axis=0)
+                                                         for r in range(0, stack.shape[1], rows)])
+        return stats
+    finally:
+        spill.clear()
+        if tmp is not None:
+            tmp.cleanup()
+
+
+def _write_group(args):
+    name, files, out_dir, couplings, median = args
+    stats = aggregate(files, couplings, median)
+    for label, s in stats.items():
+        if s['missing']:
+            print('%s: %d of %d fits have no %s coupling' % (name, s['missing'], len(files), label), flush=True)
+        for stat, prefix in (('mean', 'avg'), ('var', 'var'), ('median', 'median')):
+            if stat in s:
+                np.save(os.path.join(out_dir, '%s_%s_sc_%s.npy' % (prefix, name, label)), s[stat].astype(np.float32))
+    return name, len(files)
+
+
+def write_donors(fits_dir, out_dir, run='verb_evoked', groups=GROUPS, couplings=COUPLINGS, median=False,
+                 workers=None):
+    """
+    Write the group matrices of every group (in parallel worker processes with workers).
+
+    Returns:
+        counts (dict): Number of fits per group.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    jobs = [(name, files, out_dir, couplings, median) for name, files in group_files(fits_dir, run, groups).items()
+            if files]
+    if workers is None or len(jobs) < 2:
+        return dict(map(_write_group, jobs))
+    with ProcessPoolExecutor(workers) as ex:
+        return dict(ex.map(_write_group, jobs))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('fits_dir', help='directory of *_fittingresults_stim_exp.pkl')
+    parser.add_argument('out_dir', help='directory of the donor matrices (data_path for transplant_fit)')
+    parser.add_argument('--run', default='verb_evoked')
+    parser.add_argument('--group', nargs=3, action='append', metavar=('NAME', 'MIN_AGE', 'MAX_AGE'),
+                        help='age bin (inclusive); default YC 4 7 and Adol 15 18')
+    parser.add_argument('--median', action='store_true')
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args(argv)
+    groups = GROUPS if args.group is None else {name: (float(lo), float(hi)) for name, lo, hi in args.group}
+    for name, n in write_donors(args.fits_dir, args.out_dir, args.run, groups, median=args.median,
+                                workers=args.workers).items():
+        print(name, n, 'fits')
+
+
+if __name__ == '__main__':
+    main()
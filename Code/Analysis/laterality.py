@@ -0,0 +1,167 @@
+"""
+Vectorised per-region Welch t-tests and laterality indices (LI, LI_neg) of a whole cohort.
+
+Beta powers are stacked into (subject, region, trial) arrays; subjects with fewer trials are padded with NaN and
+their trial counts kept alongside. welch_ttest runs scipy.stats.ttest_ind(equal_var=False) with axis=-1 once per
+group of subjects with the same trial counts (once in total for simulated or resampled data), so every t and p
+value is the one of the per-region call. Significance, hemisphere counts, LI and LI_neg are array reductions with
+masks; leading axes (e.g. bootstrap replicates of the trials) are carried through.
+
+    v, n_v = stack_trials(Aemp_v_beta)
+    n, n_n = stack_trials(Aemp_n_beta)
+    t, p = welch_ttest(v, n, n_v, n_n)                    # subject x region
+    positive, negative = significant(t, p)
+    LI, LI_neg = laterality(positive, negative)           # subject
+    LI_sim, LI_neg_sim = simulated_laterality(np.stack(Asim_v_beta), np.stack(Asim_n_beta), positive, negative)
+
+Regions are ordered right hemisphere first: region i is right if i < n_regions / 2.
+"""
+import numpy as np
+from scipy.stats import ttest_ind
+
+
+# -----------------------------
+# Stacking
+# -----------------------------
+def stack_trials(beta):
+    """
+    Stack per-subject (region x trial) arrays into one NaN-padded array.
+
+    Args:
+        beta (list): Beta power of every subject (region x trial).
+
+    Returns:
+        stacked (array): subject x region x max trials, NaN beyond the trials of a subject.
+        n_trials (array): Number of trials of every subject.
+    """
+    beta = [np.asarray(b, dtype=float) for b in beta]
+    n_trials = np.array([b.shape[-1] for b in beta])
+    stacked = np.full((len(beta), beta[0].shape[0], n_trials.max()), np.nan)
+    for s, b in enumerate(beta):
+        stacked[s, :, :b.shape[-1]] = b
+    return stacked, n_trials
+
+
+# -----------------------------
+# Welch t-tests
+# -----------------------------
+def welch_ttest(a, b, n_a=None, n_b=None):
+    """
+    Welch t-test of a against b over the trial axis for every subject and region.
+
+    Args:
+        a, b (array): ... x subject x region x trial.
+        n_a, n_b (array): Trials of every subject (stack_trials); all trials are used if None.
+
+    Returns:
+        t, p (array): ... x subject x region.
+    """
+    a, b = np.asarray(a, dtype=float), np.asarray(b, dtype=float)
+    if n_a is None and n_b is None:
+        res = ttest_ind(a, b, axis=-1, equal_var=False)
+        return res.statistic, res.pvalue
+
+    n_a = np.full(a.shape[-3], a.shape[-1]) if n_a is None else np.asarray(n_a)
+    n_b = np.full(b.shape[-3], b.shape[-1]) if n_b is None else np.asarray(n_b)
+    shape = np.broadcast_shapes(a.shape[:-1], b.shape[:-1])
+    t, p = np.full(shape, np.nan), np.full(shape, np.nan)
+    # one call per group of subjects with the same trial counts
+    for na, nb in set(zip(n_a.tolist(), n_b.tolist())):
+        s = np.flatnonzero((n_a == na) & (n_b == nb))
+        res = ttest_ind(a[..., s, :, :na], b[..., s, :, :nb], axis=-1, equal_var=False)
+        t[..., s, :], p[..., s, :] = res.statistic, res.pvalue
+    return t, p
+
+
+def significant(t, p, alpha=0.05):
+    """
+    Masks of the regions with a significant positive and negative difference.
+
+    Args:
+        t, p (array): Output of welch_ttest.
+        alpha (float): Significance level.
+
+    Returns:
+        positive, negative (array): Boolean masks of the shape of t.
+    """
+    sig = p < alpha
+    return sig & (t > 0), sig & ~(t > 0)
+
+
+# -----------------------------
+# Laterality Index
+# -----------------------------
+def hemisphere_counts(positive, negative):
+    """
+    Number of positive and negative regions per hemisphere.
+
+    Args:
+        positive, negative (array): Boolean masks (... x region).
+
+    Returns:
+        counts (array): ... x 4 (pos_right, neg_right, pos_left, neg_left).
+    """
+    right = np.arange(positive.shape[-1]) < positive.shape[-1] / 2
+    return np.stack([(positive & right).sum(-1), (negative & right).sum(-1),
+                     (positive & ~right).sum(-1), (negative & ~right).sum(-1)], axis=-1)
+
+
+def laterality(positive, negative):
+    """
+    LI = (pos_right + neg_left - neg_right - pos_left) / all significant regions and
+    LI_neg = (neg_left - neg_right) / negative regions; NaN without regions.
+
+    Args:
+        positive, negative (array): Boolean masks (... x region).
+
+    Returns:
+        LI, LI_neg (array): One value per leading index (e.g. per subject).
+    """
+    pos_right, neg_right, pos_left, neg_left = np.moveaxis(hemisphere_counts(positive, negative), -1, 0)
+    den = pos_right + neg_right + pos_left + neg_left
+    den_neg = neg_left + neg_right
+    with np.errstate(divide='ignore', invalid='ignore'):
+        LI = np.where(den != 0, (pos_right + neg_left - (neg_right + pos_left)) / den, np.nan)
+        LI_neg = np.where(den_neg != 0, (neg_left - neg_right) / den_neg, np.nan)
+    return LI, LI_neg
+
+
+def empirical_laterality(v_beta, n_beta, alpha=0.05):
+    """
+    Welch t-tests (verb vs. noise trials) and LI of every subject.
+
+    Args:
+        v_beta, n_beta (list or array): Beta power during verb and noise trials (list of region x trial arrays
+            or stacked ... x subject x region x trial arrays).
+        alpha (float): Significance level.
+
+    Returns:
+        t, p (array): ... x subject x region.
+        positive, negative (array): Significant regions (... x subject x region).
+        LI, LI_neg (array): ... x subject.
+    """
+    if isinstance(v_beta, (list, tuple)):
+        v_beta, n_v = stack_trials(v_beta)
+        n_beta, n_n = stack_trials(n_beta)
+    else:
+        n_v = n_n = None
+    t, p = welch_ttest(v_beta, n_beta, n_v, n_n)
+    positive, negative = significant(t, p, alpha)
+    LI, LI_neg = laterality(positive, negative)
+    return t, p, positive, negative, LI, LI_neg
+
+
+def simulated_laterality(v_beta, n_beta, positive, negative):
+    """
+    LI of the simulated beta difference in the regions that are significant in the empirical data.
+
+    Args:
+        v_beta, n_beta (array): Simulated beta power (... x subject x region).
+        positive, negative (array): Significant empirical regions (subject x region).
+
+    Returns:
+        LI, LI_neg (array): ... x subject.
+    """
+    sig = positive | negative
+    diff = np.asarray(v_beta, dtype=float) - np.asarray(n_beta, dtype=float)
+    return laterality(sig & (diff > 0), sig & ~(diff > 0))
@@ -1,10 +1,18 @@
+import os
+import sys
+
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
-import scipy.signal
 from scipy import stats
 
+from beta_features import band_power, EMP_WINDOW, SIM_WINDOW
+from feature_cache import FeatureCache
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from JR_Atlas import atlas  # noqa: E402
+
 # Sampling parameters
 fs = 1000  # Sampling frequency (Hz)
 nperseg = 512  # Segment length (500 ms)
@@ -14,68 +22,32 @@ noverlap = 256  # 50% overlap
 start_freq = 7
 end_freq = 16
 
-# Define frontal ROIs of shen atlas based on mask (subtract 1 for Python indexing)
-frontal_rois = np.array([2, 7, 10, 17, 18, 24, 25, 26, 28, 30, 31, 33,
-                         37, 38, 42, 50, 56, 59, 61, 62, 65, 66, 68, 71, 77,
-                         78, 83, 91, 92, 94, 96, 98, 99, 100, 101, 102, 103,
-                         108, 110, 113, 117, 125, 126, 129, 132, 133, 135, 137,
-                         140, 142, 150, 158, 161, 172, 178, 180, 182, 183]) - 1
-
-# Separate left and right hemisphere indices
-right_frontal_idx = frontal_rois[frontal_rois < 93]
-left_frontal_idx = frontal_rois[frontal_rois > 93]
-
-# Initialize storage lists
-adol_emp_verb_psd, adol_emp_noise_psd = [], []
-yc_emp_verb_psd, yc_emp_noise_psd = [], []
-adol_sim_verb_psd, adol_sim_noise_psd = [], []
-yc_sim_verb_psd, yc_sim_noise_psd = [], []
-
-# Compute power spectral density (PSD) using Welch's method for 700-1200 ms window (time series are -500 to 1500 ms)
-for i in range(len(Adol_subs)):
-    emp_verb = scipy.signal.welch(Adol_emp_verb[i][:, :, 1200:1700], fs=fs, noverlap=noverlap, nperseg=nperseg, detrend='linear')
-    emp_noise = scipy.signal.welch(Adol_emp_noise[i][:, :, 1200:1700], fs=fs, noverlap=noverlap, nperseg=nperseg, detrend='linear')
-
-    sim_verb = scipy.signal.welch(Adol_sim_verb[i][:, 800:1300], fs=fs, noverlap=noverlap, nperseg=nperseg, detrend='linear')
-    sim_noise = scipy.signal.welch(Adol_sim_noise[i][:, 800:1300], fs=fs, noverlap=noverlap, nperseg=nperseg, detrend='linear')
-
-    adol_emp_verb_psd.append(emp_verb)
-    adol_emp_noise_psd.append(emp_noise)
-    adol_sim_verb_psd.append(sim_verb)
-    adol_sim_noise_psd.append(sim_noise)
-
-for i in range(len(YC_subs)):
-    emp_verb = scipy.signal.welch(YC_emp_verb[i][:, :, 1200:1700], fs=fs, noverlap=noverlap, nperseg=nperseg, detrend='linear')
-    emp_noise = scipy.signal.welch(YC_emp_noise[i][:, :, 1200:1700], fs=fs, noverlap=noverlap, nperseg=nperseg, detrend='linear')
-
-    sim_verb = scipy.signal.welch(YC_sim_verb[i][:, 800:1300], fs=fs, noverlap=noverlap, nperseg=nperseg, detrend='linear')
-    sim_noise = scipy.signal.welch(YC_sim_noise[i][:, 800:1300], fs=fs, noverlap=noverlap, nperseg=nperseg, detrend='linear')
-
-    yc_emp_verb_psd.append(emp_verb)
-    yc_emp_noise_psd.append(emp_noise)
-    yc_sim_verb_psd.append(sim_verb)
-    yc_sim_noise_psd.append(sim_noise)
-
-# Compute beta power averages
-def compute_beta_power_difference(emp_verb_psd, emp_noise_psd, sim_verb_psd, sim_noise_psd):
-    emp_verb_beta, emp_noise_beta = [], []
-    sim_verb_beta, sim_noise_beta = [], []
+# PSDs and band powers computed before (by this or another script) are read from the on-disk cache
+cache = FeatureCache()
 
-    for i in range(len(emp_verb_psd)):
-        emp_verb_beta.append(np.mean(emp_verb_psd[i][1][:, :, start_freq:end_freq], axis=(2))[frontal_rois])
-        emp_noise_beta.append(np.mean(emp_noise_psd[i][1][:, :, start_freq:end_freq], axis=(2))[frontal_rois])
+# Frontal ROIs of the shen atlas (0-based node indices)
+shen = atlas(Adol_sim_verb[0].shape[0])
+frontal_rois = shen.frontal
 
-        sim_verb_beta.append(np.mean(sim_verb_psd[i][1][:, start_freq:end_freq], axis=1)[frontal_rois])
-        sim_noise_beta.append(np.mean(sim_noise_psd[i][1][:, start_freq:end_freq], axis=1)[frontal_rois])
+# Positions of the left and right hemisphere ROIs within the frontal selection (the columns of the beta arrays)
+right_frontal_idx = shen.frontal_pos['right']
+left_frontal_idx = shen.frontal_pos['left']
 
-    emp_beta_diff = np.array(emp_verb_beta) - np.array(emp_noise_beta)
-    sim_beta_diff = np.array(sim_verb_beta) - np.array(sim_noise_beta)
+# Beta power of the 700-1200 ms window (time series are -500 to 1500 ms) of all subjects and frontal ROIs,
+# with one stacked Welch PSD per condition and data kind
+def compute_beta_power_difference(emp_verb, emp_noise, sim_verb, sim_noise):
+    welch_kw = dict(bins=(start_freq, end_freq), rois=frontal_rois, fs=fs, nperseg=nperseg, noverlap=noverlap,
+                    cache=cache)
+    emp_beta_diff = np.array(band_power(emp_verb, EMP_WINDOW, **welch_kw)) - \
+        np.array(band_power(emp_noise, EMP_WINDOW, **welch_kw))
+    sim_beta_diff = np.array(band_power(sim_verb, SIM_WINDOW, **welch_kw)) - \
+        np.array(band_power(sim_noise, SIM_WINDOW, **welch_kw))
 
     return emp_beta_diff, sim_beta_diff
 
 # Compute beta power differences for both groups
-adol_emp_beta_diff, adol_sim_beta_diff = compute_beta_power_difference(adol_emp_verb_psd, adol_emp_noise_psd, adol_sim_verb_psd, adol_sim_noise_psd)
-yc_emp_beta_diff, yc_sim_beta_diff = compute_beta_power_difference(yc_emp_verb_psd, yc_emp_noise_psd, yc_sim_verb_psd, yc_sim_noise_psd)
+adol_emp_beta_diff, adol_sim_beta_diff = compute_beta_power_difference(Adol_emp_verb, Adol_emp_noise, Adol_sim_verb, Adol_sim_noise)
+yc_emp_beta_diff, yc_sim_beta_diff = compute_beta_power_difference(YC_emp_verb, YC_emp_noise, YC_sim_verb, YC_sim_noise)
 
 # Compute mean beta power for left and right frontal regions
 def compute_mean_beta_per_hemisphere(emp_beta_diff, sim_beta_diff):
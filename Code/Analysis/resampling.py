@@ -0,0 +1,412 @@
+"""
+Batched bootstrap and permutation statistics for LI, age regressions and group contrasts.
+
+Replicates are drawn as an (n_resamples, n_subjects) index matrix and evaluated with matrix algebra: all
+permutations of a regression are one product of the permuted, standardised outcome with the standardised
+predictors (every column of subject_data.pkl at once), bootstrap OLS fits are batched reductions over the last
+axis, and group contrasts multiply permuted group masks with the values. Replicates are processed in chunks
+(bounded memory), optionally on a thread pool; every chunk has its own seed, so results do not depend on workers.
+
+Subjects with a missing value (NaN, e.g. the LI of a subject without significant regions) in any input of a test
+are dropped before resampling; a statistic that is still NaN (e.g. the correlation with a constant column) gets a
+NaN p-value. regression_table drops subjects per predictor column.
+
+    df = pd.read_pickle('subject_data.pkl')
+    r, p, null = permutation_test(df['Age'], df['t_LI_sim'])                       # LI vs. age
+    r, p, null = permutation_test(df['fr_int_p2i_verb'], df['t_LI_sim'], control=df['Age'])
+    table = regression_table(df, ['fr_int_p2i_verb', 'fr_int_p2p_verb'], 't_LI_sim', control='Age')
+    diff, p, null = group_permutation_test(df['fr_int_p2i_verb'], df['Age'] < 10)
+    LI = bootstrap_laterality(Aemp_v_beta, Aemp_n_beta, n_resamples=1000)         # resample x subject
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+# -----------------------------
+# Resampling
+# -----------------------------
+def index_matrix(n, n_resamples, kind='permutation', rng=None):
+    """
+    Resampled subject indices.
+
+    Args:
+        n (int): Number of subjects.
+        n_resamples (int): Number of replicates.
+        kind (str): 'permutation' (every row a permutation) or 'bootstrap' (drawn with replacement).
+        rng (Generator): Random generator.
+
+    Returns:
+        idx (array): n_resamples x n.
+    """
+    rng = np.random.default_rng(rng)
+    if kind == 'permutation':
+        return rng.permuted(np.broadcast_to(np.arange(n), (n_resamples, n)), axis=1)
+    if kind == 'bootstrap':
+        return rng.integers(0, n, (n_resamples, n))
+    raise ValueError("Invalid kind. Choose 'permutation' or 'bootstrap'.")
+
+
+def run_chunks(fn, n_resamples, chunk=1000, workers=None, seed=0):
+    """
+    Evaluate fn(rng, size) on chunks of the replicates and concatenate the results along the first axis.
+
+    Args:
+        fn (callable): (Generator, number of replicates) -> array with the replicates on the first axis.
+        n_resamples (int): Total number of replicates.
+        chunk (int): Replicates per call.
+        workers (int): Size of the thread pool (None: run the chunks in this thread).
+        seed (int): Seed of the chunk generators.
+
+    Returns:
+        replicates (array): n_resamples x ...
+    """
+    sizes = [min(chunk, n_resamples - i) for i in range(0, n_resamples, chunk)]
+    rngs = [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(len(sizes))]
+    if workers is None or len(sizes) == 1:
+        out = [fn(rng, size) for rng, size in zip(rngs, sizes)]
+    else:
+        with ThreadPoolExecutor(workers) as ex:
+            out = list(ex.map(fn, rngs, sizes))
+    return np.concatenate(out)
+
+
+def pvalue(null, observed):
+    """
+    Two-sided resampling p-value (1 + #|null| >= |observed|) / (1 + n_resamples) for every statistic; NaN where
+    the observed statistic is NaN.
+    """
+    observed = np.abs(observed)
+    # relative tolerance: replicates equal to the observed statistic up to rounding count as extreme
+    extreme = np.abs(null) >= observed * (1 - 1e-12)
+    return np.where(np.isnan(observed), np.nan, (1 + extreme.sum(0)) / (1 + len(null)))
+
+
+def complete_subjects(*arrays):
+    """
+    Boolean mask of the subjects without NaN in any of the arrays (subjects on the last axis; None is skipped).
+    """
+    keep = None
+    for a in arrays:
+        if a is None:
+            continue
+        a = np.asarray(a, dtype=float)
+        ok = ~np.isnan(a.reshape(-1, a.shape[-1])).any(0)
+        keep = ok if keep is None else keep & ok
+    return keep
+
+
+def percentile_ci(replicates, level=0.95):
+    """
+    Percentile bootstrap interval (lower, upper) of every statistic.
+    """
+    alpha = (1 - level) / 2
+    return np.nanquantile(replicates, [alpha, 1 - alpha], axis=0)
+
+
+# -----------------------------
+# OLS
+# -----------------------------
+def standardise(x):
+    """
+    Centred, unit-norm rows (the correlation of two rows is their dot product); NaN for constant rows.
+    """
+    x = x - x.mean(-1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return x / np.sqrt((x ** 2).sum(-1, keepdims=True))
+
+
+def linear_fit(x, y):
+    """
+    Slope, intercept and correlation of y on x over the last axis (as scipy.stats.linregress), broadcasting
+    over leading axes.
+
+    Args:
+        x, y (array): ... x n.
+
+    Returns:
+        slope, intercept, r (array): ...
+    """
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    mx, my = x.mean(-1, keepdims=True), y.mean(-1, keepdims=True)
+    sxy = ((x - mx) * (y - my)).sum(-1)
+    sxx = ((x - mx) ** 2).sum(-1)
+    syy = ((y - my) ** 2).sum(-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = sxy / sxx
+        r = np.clip(sxy / np.sqrt(sxx * syy), -1, 1)
+    return slope, my[..., 0] - slope * mx[..., 0], r
+
+
+def residualise(y, control):
+    """
+    Residuals of y after the OLS fit on control (with intercept), as compute_residuals in param_space_explore.py.
+
+    Args:
+        y (array): ... x n.
+        control (array): n (one control variable) or n x k.
+
+    Returns:
+        residuals (array): ... x n.
+    """
+    control = np.asarray(control, dtype=float)
+    X = np.column_stack([np.ones(len(control)), control])
+    q, _ = np.linalg.qr(X)
+    y = np.asarray(y, dtype=float)
+    return y - (y @ q) @ q.T
+
+
+# -----------------------------
+# Regressions
+# -----------------------------
+def _drop_missing(x, y, control):
+    # x (n or m x n), y (n) and control (n or n x k) without the subjects with NaN in any of them
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    control = None if control is None else np.asarray(control, dtype=float)
+    keep = complete_subjects(x, y, None if control is None else control.T)
+    return x[..., keep], y[keep], None if control is None else control[keep]
+
+
+def permutation_test(x, y, control=None, n_resamples=10000, chunk=1000, workers=None, seed=0):
+    """
+    Permutation test of the correlation of y (optionally residualised on control) with one or more predictors.
+    Subjects with NaN in x (any predictor), y or control are dropped.
+
+    Args:
+        x (array): Predictor (n) or predictors (m x n).
+        y (array): Outcome (n), e.g. LI.
+        control (array): Variables regressed out of y first (e.g. age), none if None.
+        n_resamples (int): Number of permutations.
+        chunk (int): Permutations per batch.
+        workers (int): Size of the thread pool.
+        seed (int): Random seed.
+
+    Returns:
+        r (float or array): Observed correlation (per predictor).
+        p (float or array): Two-sided permutation p-value.
+        null (array): n_resamples (x m) correlations under permuted y.
+    """
+    x, y, control = _drop_missing(x, y, control)
+    if control is not None:
+        y = residualise(y, control)
+    xz, yz = standardise(np.atleast_2d(x)), standardise(y)
+    r = xz @ yz
+
+    def fn(rng, size):
+        # permuting y permutes its standardised values: one product for all replicates and predictors
+        return yz[index_matrix(len(yz), size, 'permutation', rng)] @ xz.T
+
+    null = run_chunks(fn, n_resamples, chunk, workers, seed)
+    p = pvalue(null, r)
+    if x.ndim == 1:
+        return r[0], p[0], null[:, 0]
+    return r, p, null
+
+
+def bootstrap_fit(x, y, control=None, n_resamples=10000, chunk=1000, workers=None, seed=0, level=0.95):
+    """
+    Case-resampling bootstrap of the regression of y (optionally residualised on control) on x.
+    Subjects with NaN in x (any predictor), y or control are dropped.
+
+    Args:
+        x (array): Predictor (n) or predictors (m x n).
+        y (array): Outcome (n).
+        control (array): Variables regressed out of y first, none if None.
+        n_resamples (int): Number of bootstrap samples.
+        chunk, workers, seed: As permutation_test.
+        level (float): Level of the percentile intervals.
+
+    Returns:
+        fit (dict): Observed slope, intercept, r and their percentile intervals (slope_ci, intercept_ci, r_ci,
+            lower and upper bound on the first axis).
+        replicates (array): n_resamples x 3 (x m): slope, intercept, r of every bootstrap sample.
+    """
+    x, y, control = _drop_missing(x, y, control)
+    x = np.atleast_2d(x)
+    if control is not None:
+        y = residualise(y, control)
+
+    def fn(rng, size):
+        idx = index_matrix(len(y), size, 'bootstrap', rng)
+        return np.stack(linear_fit(x[:, idx], y[idx]), axis=-1).transpose(1, 2, 0)
+
+    replicates = run_chunks(fn, n_resamples, chunk, workers, seed)
+    fit = {}
+    for i, (name, value) in enumerate(zip(['slope', 'intercept', 'r'], linear_fit(x, y))):
+        fit[name] = value
+        fit[name + '_ci'] = percentile_ci(replicates[:, i], level)
+    if x.shape[0] == 1:
+        return {key: value[..., 0] for key, value in fit.items()}, replicates[..., 0]
+    return fit, replicates
+
+
+def regression_table(df, columns, outcome, control=None, n_resamples=10000, chunk=1000, workers=None, seed=0):
+    """
+    Regression of an outcome on every column (e.g. the parameters of subject_data.pkl) with parametric,
+    permutation and bootstrap statistics.
+
+    Args:
+        df (DataFrame): One row per subject.
+        columns (list): Predictor columns.
+        outcome (str): Outcome column (e.g. 't_LI_sim').
+        control (str or list): Columns regressed out of the outcome first (e.g. 'Age').
+        n_resamples, chunk, workers, seed: As permutation_test.
+
+    Returns:
+        table (DataFrame): column, n (subjects used), slope, r, p (parametric, n - 2 - k degrees of freedom for k
+            controls), p_perm, r_low, r_high (95% bootstrap interval). Every column uses the subjects where it, the
+            outcome and the controls are not NaN.
+    """
+    import pandas as pd
+    from scipy.stats import t as t_dist
+    x = df[columns].to_numpy(dtype=float).T
+    y = df[outcome].to_numpy(dtype=float)
+    ctrl = None if control is None else df[control].to_numpy(dtype=float)
+    base = complete_subjects(y, None if ctrl is None else ctrl.T)
+    n_control = 0 if ctrl is None else ctrl.reshape(len(ctrl), -1).shape[1]
+    # columns with the same missing subjects are tested together
+    keep = ~np.isnan(x) & base
+    patterns, which = np.unique(keep, axis=0, return_inverse=True)
+    stats = np.full((len(columns), 7), np.nan)
+    for i, rows in enumerate(patterns):
+        cols = np.flatnonzero(np.ravel(which) == i)
+        r, p_perm, _ = permutation_test(x[np.ix_(cols, rows)], y[rows], None if ctrl is None else ctrl[rows],
+                                        n_resamples, chunk, workers, seed)
+        fit, _ = bootstrap_fit(x[np.ix_(cols, rows)], y[rows], None if ctrl is None else ctrl[rows], n_resamples,
+                               chunk, workers, seed)
+        # parametric p of r as linregress, with n - 2 - k degrees of freedom for k controls
+        n = rows.sum()
+        dof = n - 2 - n_control
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = r * np.sqrt(dof / (1 - r ** 2))
+        stats[cols] = np.column_stack([np.full(len(cols), n), fit['slope'], r, 2 * t_dist.sf(np.abs(t), dof),
+                                       p_perm, fit['r_ci'][0], fit['r_ci'][1]])
+    table = pd.DataFrame(stats, columns=['n', 'slope', 'r', 'p', 'p_perm', 'r_low', 'r_high'])
+    table.insert(0, 'column', columns)
+    table['n'] = table['n'].astype(int)
+    return table
+
+
+# -----------------------------
+# Group Contrasts
+# -----------------------------
+def _group_inputs(values, group):
+    # values (n or n x m), the same as n x m and the group mask, without the subjects with NaN values
+    values = np.asarray(values, dtype=float)
+    v = values.reshape(len(values), -1)
+    keep = complete_subjects(v.T)
+    return values[keep], v[keep], np.asarray(group, dtype=bool)[keep]
+
+
+def _group_stat(values, mask, statistic):
+    # values: (...) x n x m, mask: ... x n (1: first group) -> ... x m
+    mask = mask.astype(float)
+    other = 1 - mask
+    n1 = mask.sum(-1, keepdims=True)
+    n2 = mask.shape[-1] - n1
+    m1, m2 = (mask @ values) / n1, (other @ values) / n2
+    if statistic == 'mean':
+        return m1 - m2
+    v1 = ((mask @ values ** 2) - n1 * m1 ** 2) / (n1 - 1)
+    v2 = ((other @ values ** 2) - n2 * m2 ** 2) / (n2 - 1)
+    return (m1 - m2) / np.sqrt(v1 / n1 + v2 / n2)
+
+
+def group_permutation_test(values, group, statistic='mean', n_resamples=10000, chunk=1000, workers=None, seed=0):
+    """
+    Permutation test of the difference between two groups of subjects. Subjects with NaN in any variable are
+    dropped.
+
+    Args:
+        values (array): n (one variable) or n x m (e.g. df[columns]).
+        group (array): Boolean mask of the first group (e.g. df['Age'] < 10).
+        statistic (str): 'mean' (difference of means) or 't' (Welch t).
+        n_resamples, chunk, workers, seed: As permutation_test.
+
+    Returns:
+        stat (float or array): Observed statistic (first minus second group).
+        p (float or array): Two-sided permutation p-value.
+        null (array): n_resamples (x m) statistics under permuted group labels.
+    """
+    if statistic not in ('mean', 't'):
+        raise ValueError("Invalid statistic. Choose 'mean' or 't'.")
+    values, v, group = _group_inputs(values, group)
+    stat = _group_stat(v, group, statistic)
+
+    def fn(rng, size):
+        mask = group[index_matrix(len(group), size, 'permutation', rng)]
+        return _group_stat(v, mask, statistic)
+
+    null = run_chunks(fn, n_resamples, chunk, workers, seed)
+    p = pvalue(null, stat)
+    if values.ndim == 1:
+        return stat[0], p[0], null[:, 0]
+    return stat, p, null
+
+
+def group_bootstrap_ci(values, group, statistic='mean', n_resamples=10000, chunk=1000, workers=None, seed=0,
+                       level=0.95):
+    """
+    Percentile interval of the group difference, resampling subjects within each group. Subjects with NaN in
+    any variable are dropped.
+
+    Args:
+        values, group, statistic: As group_permutation_test.
+        n_resamples, chunk, workers, seed: As permutation_test.
+        level (float): Level of the interval.
+
+    Returns:
+        ci (array): Lower and upper bound (x m).
+        replicates (array): n_resamples (x m).
+    """
+    values, v, group = _group_inputs(values, group)
+    first, second = np.flatnonzero(group), np.flatnonzero(~group)
+    mask = np.r_[np.ones(len(first)), np.zeros(len(second))]
+
+    def fn(rng, size):
+        idx = np.concatenate([first[index_matrix(len(first), size, 'bootstrap', rng)],
+                              second[index_matrix(len(second), size, 'bootstrap', rng)]], axis=1)
+        # resampled values of every replicate: size x n x m, first group first
+        return _group_stat(v[idx], mask, statistic)
+
+    replicates = run_chunks(fn, n_resamples, chunk, workers, seed)
+    ci = percentile_ci(replicates, level)
+    if values.ndim == 1:
+        return ci[:, 0], replicates[:, 0]
+    return ci, replicates
+
+
+# -----------------------------
+# Laterality Index
+# -----------------------------
+def bootstrap_laterality(v_beta, n_beta, alpha=0.05, n_resamples=1000, chunk=50, workers=None, seed=0):
+    """
+    Bootstrap of the empirical LI: the verb and noise trials of every subject are resampled with replacement
+    and the per-region t-tests and LI of all replicates are computed at once (laterality.py).
+
+    Args:
+        v_beta, n_beta (list): Beta power of every subject during verb and noise trials (region x trial).
+        alpha (float): Significance level of the t-tests.
+        n_resamples (int): Number of bootstrap samples.
+        chunk (int): Replicates per batch (memory: chunk x subject x region x trial).
+        workers, seed: As permutation_test.
+
+    Returns:
+        LI, LI_neg (array): n_resamples x subject.
+    """
+    from laterality import laterality, significant, stack_trials, welch_ttest
+    v, n_v = stack_trials(v_beta)
+    n, n_n = stack_trials(n_beta)
+
+    def resample(rng, size, beta, n_trials):
+        # trial indices below the trial count of every subject (padding positions are never drawn)
+        idx = (rng.random((size, len(n_trials), 1, beta.shape[-1])) * n_trials[:, None, None]).astype(int)
+        return np.take_along_axis(beta[None], idx, axis=-1)
+
+    def fn(rng, size):
+        vb, nb = resample(rng, size, v, n_v), resample(rng, size, n, n_n)
+        positive, negative = significant(*welch_ttest(vb, nb, n_v, n_n), alpha)
+        return np.stack(laterality(positive, negative), axis=-1)
+
+    replicates = run_chunks(fn, n_resamples, chunk, workers, seed)
+    return replicates[..., 0], replicates[..., 1]
@@ -0,0 +1,31 @@
+import numpy as np
+import pandas as pd
+from scipy.stats import t as t_dist
+
+from association_scan import scan
+
+
+def test_missing_and_constant_inputs_get_nan():
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(30, 4))
+    X[:, 1] = 1.0
+    X[5, 2] = np.nan
+    age = rng.normal(size=30)
+    li = X[:, 0] + 0.5 * rng.normal(size=30)
+    li[[3, 9]] = np.nan
+    table = scan(pd.DataFrame(X, columns=list('abcd')), {'LI': li, 'const': np.ones(30)}, control={'LI': age},
+                 n_resamples=199)
+    li_rows = table[table['target'] == 'LI'].set_index('feature')
+    assert (li_rows['n'] == 28).all()
+    assert li_rows.loc[['b', 'c'], ['r', 'p', 'p_perm', 'p_fwer']].isna().all().all()
+    assert li_rows.loc[['a', 'd'], ['r', 'p', 'p_perm', 'p_fwer']].notna().all().all()
+    assert table[table['target'] == 'const'][['r', 'p', 'p_perm', 'p_fwer']].isna().all().all()
+
+
+def test_control_degrees_of_freedom():
+    rng = np.random.default_rng(1)
+    X, age, li = rng.normal(size=(30, 3)), rng.normal(size=30), rng.normal(size=30)
+    table = scan(X, {'LI': li}, control={'LI': age}, n_resamples=99)
+    r = table['r'].to_numpy()
+    t = r * np.sqrt((30 - 3) / (1 - r ** 2))
+    assert np.allclose(table['p'], 2 * t_dist.sf(np.abs(t), 30 - 3))
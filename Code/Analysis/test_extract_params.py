@@ -0,0 +1,32 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from extract_params import update_table
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def write_fit(fits_dir, subject, run, rng, node_size=188):
+    # empty checkpoint with an up-to-date _fields.npz next to it (read instead of the pickle)
+    fit = os.path.join(fits_dir, '%s_%s_fittingresults_stim_exp.pkl' % (subject, run))
+    open(fit, 'wb').close()
+    fields = {key: np.float32(rng.normal()) for key in ('a', 'b', 'g', 'g_f', 'g_b', 'c1', 'c2', 'c3', 'c4')}
+    for key in ('sc_m_b', 'sc_m_f', 'sc_fitted'):
+        fields[key] = rng.random((node_size, node_size)).astype(np.float32)
+    np.savez(fit.replace('_fittingresults_stim_exp.pkl', '_fields.npz'), **fields)
+
+
+def test_update_table_matches_subject_data(tmp_path):
+    rng = np.random.default_rng(0)
+    for subject in ('CTL_01_08', 'CTL_02_12'):
+        for run in ('verb', 'noise'):
+            write_fit(str(tmp_path), subject, run, rng)
+    table, n_new = update_table(str(tmp_path), str(tmp_path / 'params.pkl'))
+    assert n_new == 4 and len(table) == 2
+    reference = pd.read_pickle(os.path.join(HERE, 'subject_data.pkl')).drop(columns=['t_LI_emp', 't_LI_sim'])
+    values = table.drop(columns='subject')
+    assert list(values.columns) == list(reference.columns)
+    assert all(pd.api.types.is_numeric_dtype(dtype) for dtype in values.dtypes)
+    assert list(values.select_dtypes('number').columns) == list(reference.columns)
@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+
+from resampling import (pvalue, permutation_test, bootstrap_fit, regression_table, group_permutation_test,
+                        group_bootstrap_ci)
+
+
+def test_pvalue_nan_statistic():
+    null = np.zeros((99, 2))
+    p = pvalue(null, np.array([np.nan, 1.0]))
+    assert np.isnan(p[0])
+    assert p[1] == 1 / 100
+
+
+def test_constant_predictor_has_nan_p():
+    rng = np.random.default_rng(0)
+    x = np.vstack([np.ones(20), rng.normal(size=20)])
+    r, p, _ = permutation_test(x, rng.normal(size=20), n_resamples=199)
+    assert np.isnan(r[0]) and np.isnan(p[0])
+    assert np.isfinite(r[1]) and 0 < p[1] <= 1
+
+
+def test_missing_subjects_are_dropped():
+    rng = np.random.default_rng(1)
+    x, y, age = rng.normal(size=(3, 30))
+    y_nan, age_nan = y.copy(), age.copy()
+    y_nan[3], age_nan[7] = np.nan, np.nan
+    keep = np.ones(30, dtype=bool)
+    keep[[3, 7]] = False
+    r, p, _ = permutation_test(x, y_nan, age_nan, n_resamples=199)
+    r_ref, p_ref, _ = permutation_test(x[keep], y[keep], age[keep], n_resamples=199)
+    assert r == r_ref and p == p_ref
+    fit, _ = bootstrap_fit(x, y_nan, age_nan, n_resamples=199)
+    fit_ref, _ = bootstrap_fit(x[keep], y[keep], age[keep], n_resamples=199)
+    assert np.isfinite(fit['slope']) and fit['slope'] == fit_ref['slope']
+
+
+def test_regression_table_drops_per_column():
+    rng = np.random.default_rng(2)
+    df = pd.DataFrame(rng.normal(size=(30, 3)), columns=['a', 'b', 'y'])
+    df.loc[[0, 1], 'a'] = np.nan
+    table = regression_table(df, ['a', 'b'], 'y', n_resamples=199)
+    assert list(table['n']) == [28, 30]
+    assert table[['slope', 'r', 'p', 'p_perm']].notna().all().all()
+    r, p, _ = permutation_test(df['b'], df['y'], n_resamples=199)
+    assert table['r'][1] == r and table['p_perm'][1] == p
+
+
+def test_group_tests_drop_missing_subjects():
+    rng = np.random.default_rng(3)
+    values = rng.normal(size=20)
+    values[[2, 15]] = np.nan
+    group = np.arange(20) < 10
+    diff, p, _ = group_permutation_test(values, group, n_resamples=199)
+    assert np.isfinite(diff) and 0 < p <= 1
+    ci, _ = group_bootstrap_ci(values, group, n_resamples=199)
+    assert np.isfinite(ci).all()
+
+
+def test_regression_table_control_degrees_of_freedom():
+    from scipy.stats import t as t_dist
+    rng = np.random.default_rng(4)
+    df = pd.DataFrame(rng.normal(size=(25, 4)), columns=['a', 'age', 'sex', 'y'])
+    table = regression_table(df, ['a'], 'y', control=['age', 'sex'], n_resamples=99)
+    r = table['r'][0]
+    t = r * np.sqrt((25 - 4) / (1 - r ** 2))
+    assert np.isclose(table['p'][0], 2 * t_dist.sf(abs(t), 25 - 4))
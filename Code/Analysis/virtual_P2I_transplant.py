@@ -1,10 +1,13 @@
+import os
 import numpy as np
-import torch
-import pickle
 import sys
 import pandas as pd
 import warnings
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from JR_Atlas import frontal_hemisphere_idx  # noqa: E402
+from JR_Model_Fitting import dataloader, load_fit, transplant_p2i  # noqa: E402
+
 warnings.filterwarnings('ignore')
 
 # -----------------------------
@@ -38,8 +41,7 @@ sc = np.log1p(sc) / np.linalg.norm(np.log1p(sc))
 #  Load Model Fitting Results
 # -----------------------------
 fitting_file = f"{fitting_results_path}{sub}_{run}_fittingresults_stim_exp.pkl"
-with open(fitting_file, 'rb') as f:
-    F = pickle.load(f)
+F = load_fit(fitting_file)
 
 # -----------------------------
 #  Load Source Group P2I Data
@@ -51,29 +53,13 @@ avg_source_p2i = np.load(source_p2i_file)
 # -----------------------------
 # Define Frontal ROIs and Split Left/Right Hemisphere nodes
 # -----------------------------
-NEW_Frontal_roi = np.array([2, 7, 10, 17, 18, 24, 25, 26, 28, 30, 31, 33,
-                             37, 38, 42, 50, 56, 59, 61, 62, 65, 66, 68, 71,
-                             77, 78, 83, 91, 92, 94, 96, 98, 99, 100, 101, 102, 103,
-                             108, 110, 113, 117, 125, 126, 129, 132, 133, 135, 137,
-                             140, 142, 150, 158, 161, 172, 178, 180, 182, 183])
-
-R_Frontal_idx = NEW_Frontal_roi[NEW_Frontal_roi < 94] - 1  # Right Hemisphere Indices
-L_Frontal_idx = NEW_Frontal_roi[NEW_Frontal_roi > 93] - 1  # Left Hemisphere Indices
+L_Frontal_idx, R_Frontal_idx = frontal_hemisphere_idx()  # Left and Right Hemisphere Indices
 
 # -----------------------------
 # Apply P2I Transplantation from Source to Target Group only between frontal hemispheres
 # -----------------------------
-new_sc_m_b = F.model.sc_m_b.detach().clone()
-
-tensor_to_assign1 = torch.from_numpy(avg_source_p2i[np.ix_(L_Frontal_idx, R_Frontal_idx)]).to(
-    dtype=new_sc_m_b.dtype, device=new_sc_m_b.device)
-tensor_to_assign2 = torch.from_numpy(avg_source_p2i[np.ix_(R_Frontal_idx, L_Frontal_idx)]).to(
-    dtype=new_sc_m_b.dtype, device=new_sc_m_b.device)
-
-new_sc_m_b[np.ix_(L_Frontal_idx, R_Frontal_idx)] = tensor_to_assign1
-new_sc_m_b[np.ix_(R_Frontal_idx, L_Frontal_idx)] = tensor_to_assign2
-
-F.model.sc_m_b = new_sc_m_b  # Update the model with the transplanted P2I
+# sc_m_b is recomputed from w_bb in every forward call; transplant_p2i pins the transplanted matrix
+transplant_p2i(F.model, avg_source_p2i, L_Frontal_idx, R_Frontal_idx)
 
 # -----------------------------
 #  Set Up Model Simulation Parameters
@@ -95,7 +81,6 @@ hidden_size = int(tr / step_size)
 # -----------------------------
 #  Run Model Simulation
 # -----------------------------
-#dataloader defined in JR script
 data_mean = dataloader((meg_sub - meg_sub.mean(0)).T, num_epoches, batch_size)
 F.ts = data_mean
 
@@ -0,0 +1,197 @@
+"""
+Benchmarks for the JR fitting engine (JR_Model_Fitting.py) on synthetic inputs.
+
+No patient data is needed: structural connectivity, distances, a 3D leadfield and evoked M/EEG are
+generated at the requested number of nodes and channels. Each configuration times
+
+    dataloader          windowing of the evoked data for all epochs
+    leadfield_prep      SVD collapse of the 3D leadfield (leadfield_from_3d)
+    forward_window      one integration_forward call (one window of TRs_per_window samples)
+    train_epoch         one full Model_fitting.train epoch
+    test_burn_in        Model_fitting.test with the burn-in windows
+
+and records the peak RSS after every stage. Results are written as JSON so runs can be compared
+against a saved baseline:
+
+    python bench_jr.py --nodes 50 188 --channels 100 --out bench.json
+    python bench_jr.py --nodes 50 188 --channels 100 --baseline bench.json
+
+--gain-mode lowrank/block/sparse runs the same stages with a reduced parameterisation of the connection gains.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import JR_Model_Fitting as jr  # noqa: E402
+
+
+def synthetic_inputs(node_size, output_size, time_dim, seed=0):
+    """
+    Random model inputs with the shapes and scales of the real ones.
+
+    Args:
+        node_size (int): Number of regions.
+        output_size (int): Number of M/EEG channels.
+        time_dim (int): Number of time points of the evoked response.
+        seed (int): Seed of the generator.
+
+    Returns:
+        sc (array): Normalised structural connectivity (node_size x node_size).
+        dist (array): Symmetric distance matrix in mm (node_size x node_size).
+        lm_3d (array): Leadfield (node_size x output_size x 3).
+        meg (array): Evoked response (output_size x time_dim).
+    """
+    rng = np.random.RandomState(seed)
+    # sparse, symmetric streamline counts
+    counts = rng.poisson(20, (node_size, node_size)) * (rng.rand(node_size, node_size) < 0.3)
+    counts = np.triu(counts, 1)
+    counts = counts + counts.T
+    sc = np.log1p(counts) / np.linalg.norm(np.log1p(counts))
+
+    xyz = rng.uniform(-70, 70, (node_size, 3))
+    dist = np.sqrt(((xyz[:, None, :] - xyz[None, :, :]) ** 2).sum(-1))
+
+    lm_3d = 1e-11 * rng.randn(node_size, output_size, 3)
+    meg = 1e-13 * rng.randn(output_size, time_dim)
+    return sc, dist, lm_3d, meg
+
+
+def build_fit(sc, dist, lm, meg, batch_size, num_epoches, step_size=0.0001, tr=0.001, gain_mode='dense'):
+    node_size = sc.shape[0]
+    output_size = meg.shape[0]
+    ki0 = np.zeros((node_size, 1))
+    ki0[:3] = 1
+    par = jr.default_jr_params(lm, ki0)
+    meg_sub = meg / np.abs(meg).max()
+    data_mean = jr.dataloader(meg_sub.T, num_epoches, batch_size)
+    with contextlib.redirect_stdout(io.StringIO()):
+        # block gains between the two hemispheres (first and second half of the nodes)
+        model = jr.RNNJANSEN(node_size, batch_size, step_size, output_size, tr, sc, lm, dist, True, False, par,
+                             gain_mode=gain_mode, gain_labels=np.arange(node_size) >= node_size // 2)
+        model.setModelParameters()
+    F = jr.Model_fitting(model, data_mean, num_epoches, 0)
+    u = np.zeros((node_size, model.steps_per_TR, meg.shape[1]))
+    u[:, :, 100:140] = 5000
+    return F, u
+
+
+def timed(fn, repeat=1):
+    times = []
+    out = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = fn()
+        times.append(time.perf_counter() - t0)
+    return out, {'mean_s': float(np.mean(times)), 'min_s': float(np.min(times)), 'repeat': repeat}
+
+
+def bench_config(node_size, output_size, batch_size=250, windows=2, forward_repeat=3, base_windows=2, seed=0,
+                 gain_mode='dense'):
+    """
+    Run all stages for one (node_size, output_size) configuration.
+    """
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    time_dim = batch_size * windows
+    sc, dist, lm_3d, meg = synthetic_inputs(node_size, output_size, time_dim, seed)
+    result = {'node_size': node_size, 'output_size': output_size, 'batch_size': batch_size,
+              'windows': windows, 'base_windows': base_windows, 'gain_mode': gain_mode, 'stages': {}}
+    stages = result['stages']
+
+    def record(name, stats):
+        stats['peak_rss_mb'] = jr.peak_rss_mb()
+        stages[name] = stats
+
+    _, stats = timed(lambda: jr.dataloader(meg.T, 250, batch_size), repeat=3)
+    record('dataloader', stats)
+
+    lm, stats = timed(lambda: jr.leadfield_from_3d(lm_3d))
+    record('leadfield_prep', stats)
+
+    F, u = build_fit(sc, dist, lm, meg, batch_size, num_epoches=1, gain_mode=gain_mode)
+    model = F.model
+    result['num_params'] = int(sum(p.numel() for p in model.parameters()))
+
+    X = torch.tensor(np.random.uniform(-0.01, 0.01, (node_size, model.state_size)), dtype=torch.float32)
+    hE = torch.tensor(np.random.uniform(-0.01, 0.01, (node_size, 500)), dtype=torch.float32)
+    external = torch.tensor(u[:, :, :batch_size], dtype=torch.float32)
+    _, stats = timed(lambda: model(external, X, hE.clone()), repeat=forward_repeat)
+    record('forward_window', stats)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        _, stats = timed(lambda: F.train(u=u))
+    stats['per_window_s'] = stats['mean_s'] / windows
+    record('train_epoch', stats)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        _, stats = timed(lambda: F.test(base_windows, u=u))
+    record('test_burn_in', stats)
+
+    result['peak_rss_mb'] = jr.peak_rss_mb()
+    return result
+
+
+def compare(results, baseline):
+    """
+    Print the time ratio (current / baseline) of every stage present in both runs.
+    """
+    base = {(r['node_size'], r['output_size']): r for r in baseline['results']}
+    for r in results['results']:
+        b = base.get((r['node_size'], r['output_size']))
+        if b is None:
+            continue
+        for name, stats in r['stages'].items():
+            if name in b['stages']:
+                ratio = stats['mean_s'] / b['stages'][name]['mean_s']
+                print(f"N={r['node_size']:5d} C={r['output_size']:4d} {name:15s} "
+                      f"{stats['mean_s']:10.4f}s  x{ratio:6.2f} vs baseline")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--nodes', type=int, nargs='+', default=[50, 188])
+    parser.add_argument('--channels', type=int, nargs='+', default=[100])
+    parser.add_argument('--batch-size', type=int, default=250, help='TRs_per_window')
+    parser.add_argument('--windows', type=int, default=2, help='windows per training epoch')
+    parser.add_argument('--base-windows', type=int, default=2, help='burn-in windows of test()')
+    parser.add_argument('--gain-mode', default='dense', choices=['dense', 'lowrank', 'block', 'sparse'],
+                        help='parameterisation of the connection gains')
+    parser.add_argument('--threads', type=int, default=None, help='torch.set_num_threads')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='bench_jr.json')
+    parser.add_argument('--baseline', default=None, help='JSON of a previous run to compare against')
+    args = parser.parse_args(argv)
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    results = {'python': platform.python_version(), 'torch': torch.__version__, 'numpy': np.__version__,
+               'machine': platform.machine(), 'num_threads': torch.get_num_threads(), 'results': []}
+    for node_size in args.nodes:
+        for output_size in args.channels:
+            r = bench_config(node_size, output_size, args.batch_size, args.windows,
+                             base_windows=args.base_windows, seed=args.seed, gain_mode=args.gain_mode)
+            results['results'].append(r)
+            print(f"N={node_size:5d} C={output_size:4d} " +
+                  ' '.join(f"{name}={stats['mean_s']:.4f}s" for name, stats in r['stages'].items()) +
+                  f" params={r['num_params']} peak_rss={r['peak_rss_mb']:.0f}MB")
+
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""
+Startup benchmarks of the JR engine: the cost every sweep worker pays before its first fit.
+
+Each stage is timed in fresh interpreters (subprocesses) started from Code/:
+
+    interpreter         python -c pass (baseline of every other stage)
+    import_engine       python -c "import JR_Model_Fitting"
+    import_numpy        python -c "import JR_Numpy"
+    cli_help            python JR_CLI.py --help (must not import the engine)
+    cli_fit_help        python JR_CLI.py fit --help
+
+and `python -X importtime -c "import JR_Model_Fitting"` lists the modules with the largest cumulative
+import time. Results are written as JSON, like bench_jr.py:
+
+    python bench_startup.py --repeat 5 --out startup.json
+    python bench_startup.py --repeat 5 --baseline startup.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+CODE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+STAGES = {
+    'interpreter': ['-c', 'pass'],
+    'import_engine': ['-c', 'import JR_Model_Fitting'],
+    'import_numpy': ['-c', 'import JR_Numpy'],
+    'cli_help': ['JR_CLI.py', '--help'],
+    'cli_fit_help': ['JR_CLI.py', 'fit', '--help'],
+}
+
+
+def timed_run(args, repeat):
+    """
+    Wall time of `python <args>` in a new interpreter, repeated.
+
+    Args:
+        args (list): Interpreter arguments.
+        repeat (int): Number of runs.
+
+    Returns:
+        stats (dict): mean_s, min_s and repeat.
+    """
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        subprocess.run([sys.executable] + args, cwd=CODE_DIR, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - t0)
+    return {'mean_s': float(np.mean(times)), 'min_s': float(np.min(times)), 'repeat': repeat}
+
+
+def import_profile(module='JR_Model_Fitting', top=15):
+    """
+    Modules with the largest cumulative import time (python -X importtime).
+
+    Returns:
+        rows (list): (module, cumulative seconds) of the `top` slowest imports of the module.
+    """
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module], cwd=CODE_DIR,
+                         check=True, capture_output=True, text=True).stderr
+    rows = []
+    for line in out.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not cumulative.strip().isdigit():
+            continue
+        # only the imports requested directly by the module (one level of nesting)
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1:
+            rows.append((name.strip(), int(cumulative) * 1e-6))
+    return sorted(rows, key=lambda row: -row[1])[:top]
+
+
+def compare(results, baseline):
+    """
+    Print the time ratio (current / baseline) of every stage present in both runs.
+    """
+    for name, stats in results['stages'].items():
+        if name in baseline['stages']:
+            ratio = stats['mean_s'] / baseline['stages'][name]['mean_s']
+            print(f"{name:15s} {stats['mean_s']:8.3f}s  x{ratio:6.2f} vs baseline")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15, help='slowest imports listed')
+    parser.add_argument('--out', default='bench_startup.json')
+    parser.add_argument('--baseline', default=None, help='JSON of a previous run to compare against')
+    args = parser.parse_args(argv)
+
+    results = {'python': platform.python_version(), 'machine': platform.machine(), 'stages': {}}
+    for name, stage_args in STAGES.items():
+        stats = timed_run(stage_args, args.repeat)
+        results['stages'][name] = stats
+        print(f"{name:15s} {stats['mean_s']:8.3f}s (min {stats['min_s']:.3f}s)")
+
+    results['imports'] = import_profile(top=args.top)
+    for name, seconds in results['imports']:
+        print(f"  import {name:30s} {seconds:8.3f}s")
+
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
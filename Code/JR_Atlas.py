@@ -0,0 +1,138 @@
+"""
+ROI indices of the Shen atlas used by the fitting, transplant and analysis code, computed once per node count.
+
+Conventions (all arrays below are 0-based node indices unless named *_roi):
+    right hemisphere: ROI numbers 1-93 (nodes 0-92), left hemisphere: ROI numbers 94 and above
+    coupling matrices: rows are target nodes, columns source nodes (as integration_forward), so the
+    left-to-right block is w[right, left]
+
+    a = atlas(188)
+    a.frontal_left, a.frontal_right          # node indices
+    a.frontal_pos['left']                    # positions within a.frontal (arrays restricted to frontal ROIs)
+    w[a.blocks['fr_L2R']]                    # np.ix_ view: frontal left-to-right block of one matrix
+    a.extract(W, 'wb_R2L')                   # the same block of a stack of matrices (... x node x node)
+    ki0 = a.stimulus_input()                 # node_size x 1 stimulus gains of the driver
+
+The arrays are read-only and shared by all callers of atlas(node_size).
+"""
+import functools
+
+import numpy as np
+
+FRONTAL_ROI = np.array([2, 7, 10, 17, 18, 24, 25, 26, 28, 30, 31, 33,
+                        37, 38, 42, 50, 56, 59, 61, 62, 65, 66, 68, 71,
+                        77, 78, 83, 91, 92, 94, 96, 98, 99, 100, 101, 102, 103,
+                        108, 110, 113, 117, 125, 126, 129, 132, 133, 135, 137,
+                        140, 142, 150, 158, 161, 172, 178, 180, 182, 183])  # frontal Shen ROIs (1-based)
+RIGHT_LAST_ROI = 93  # ROI numbers up to 93 are in the right hemisphere
+STIMULUS_ROI = np.array([3, 184, 6])  # ROIs driven by the stimulus input (ki0[2], ki0[183], ki0[5])
+
+# lobes with a ROI list (1-based); more can be added with add_lobe
+LOBES = {'frontal': FRONTAL_ROI}
+
+
+def add_lobe(name, rois):
+    """
+    Register the (1-based) ROIs of a lobe; atlases built afterwards have its masks.
+    """
+    LOBES[name] = np.asarray(rois)
+    atlas.cache_clear()
+
+
+def _frozen(x):
+    x = np.asarray(x)
+    x.setflags(write=False)
+    return x
+
+
+class Atlas:
+    """
+    Index arrays and masks of one node count
+    Attributes
+    ----------
+    node_size: int
+    right, left: int arrays
+        nodes of each hemisphere (right_mask, left_mask: boolean masks)
+    lobes: dict
+        lobe -> nodes (lobe_masks: boolean masks); frontal, frontal_left, frontal_right for the frontal lobe
+    frontal_pos: dict
+        'left'/'right' -> positions of the hemisphere within frontal
+    stimulus: int array
+        nodes driven by the stimulus
+    blocks: dict
+        np.ix_ index tuples of the interhemispheric blocks (fr_/wb_ + L2R/R2L, target rows and source columns)
+    block_masks: dict
+        boolean node_size x node_size masks of the same blocks (block_weights: normalised and flattened)
+    """
+
+    def __init__(self, node_size):
+        self.node_size = node_size
+        nodes = np.arange(node_size)
+        self.right_mask = _frozen(nodes < RIGHT_LAST_ROI)
+        self.left_mask = _frozen(~self.right_mask)
+        self.right, self.left = _frozen(nodes[self.right_mask]), _frozen(nodes[self.left_mask])
+
+        self.lobes, self.lobe_masks = {}, {}
+        for name, rois in LOBES.items():
+            idx = rois[rois <= node_size] - 1
+            mask = np.zeros(node_size, dtype=bool)
+            mask[idx] = True
+            self.lobes[name], self.lobe_masks[name] = _frozen(idx), _frozen(mask)
+        self.frontal = self.lobes['frontal']
+        self.frontal_right = _frozen(self.frontal[self.right_mask[self.frontal]])
+        self.frontal_left = _frozen(self.frontal[self.left_mask[self.frontal]])
+        self.frontal_pos = {'right': _frozen(np.flatnonzero(self.right_mask[self.frontal])),
+                            'left': _frozen(np.flatnonzero(self.left_mask[self.frontal]))}
+        self.stimulus = _frozen(STIMULUS_ROI[STIMULUS_ROI <= node_size] - 1)
+
+        self.blocks, self.block_masks = {}, {}
+        for scope, (L, R) in (('fr', (self.frontal_left, self.frontal_right)), ('wb', (self.left, self.right))):
+            for direction, (target, source) in (('L2R', (R, L)), ('R2L', (L, R))):
+                ix = tuple(_frozen(i) for i in np.ix_(target, source))
+                mask = np.zeros((node_size, node_size), dtype=bool)
+                mask[ix] = True
+                self.blocks[scope + '_' + direction] = ix
+                self.block_masks[scope + '_' + direction] = _frozen(mask)
+        # normalised masks: flattened matrices @ block_weights.T are the block means
+        self.block_weights = _frozen(np.array([m.ravel() / m.sum() for m in self.block_masks.values()]))
+
+    def extract(self, matrices, block):
+        """
+        Block of a matrix or of a stack of matrices (... x node_size x node_size).
+        """
+        return np.asarray(matrices)[(Ellipsis,) + self.blocks[block]]
+
+    def block_means(self, matrices, blocks=None):
+        """
+        Mean of every block (name -> ... array) of a matrix or a stack of matrices, as one product of the
+        flattened matrices with the normalised block masks.
+        """
+        names = list(self.block_masks)
+        blocks = names if blocks is None else list(blocks)
+        weights = self.block_weights[[names.index(b) for b in blocks]]
+        matrices = np.asarray(matrices)
+        means = matrices.reshape(matrices.shape[:-2] + (-1,)) @ weights.T
+        return {b: means[..., i] for i, b in enumerate(blocks)}
+
+    def stimulus_input(self):
+        """
+        node_size x 1 stimulus gains (ki0): 1 at the stimulus nodes (a new, writable array).
+        """
+        ki0 = np.zeros((self.node_size, 1))
+        ki0[self.stimulus] = 1
+        return ki0
+
+
+@functools.lru_cache(maxsize=None)
+def atlas(node_size):
+    """
+    Atlas of a node count (built once, then shared).
+    """
+    return Atlas(node_size)
+
+
+def frontal_hemisphere_idx():
+    """
+    0-based indices of the left and right frontal ROIs (right hemisphere: ROI numbers below 94).
+    """
+    return FRONTAL_ROI[FRONTAL_ROI > RIGHT_LAST_ROI] - 1, FRONTAL_ROI[FRONTAL_ROI <= RIGHT_LAST_ROI] - 1
@@ -0,0 +1,108 @@
+"""
+Command line entry point of the JR engine.
+
+    python JR_CLI.py fit <sub> <run> [--profile] [--warm FILE [--warm-subject]] [--starts P] [--joint RUN2] [--shared]
+                                     [--checkpoint-every N]
+    python JR_CLI.py simulate <fit.pkl> [--meg RUN.npy] [--length 1500] [--numpy] [--seed S] [--out PREFIX]
+    python JR_CLI.py transplant <sub> <run> [--group YC] [--fits DIR] [--out DIR]
+
+The engine (torch, pandas, scipy) is only imported once a subcommand runs, so `--help` and argument
+errors return immediately; `import JR_Model_Fitting` itself has no side effects.
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_fit(args):
+    import JR_Model_Fitting as jr
+    inputs = None
+    if args.shared:
+        from JR_SharedInputs import publish_subject, attach_subject
+        runs = [args.run] + ([args.joint] if args.joint else [])
+        publish_subject(args.sub, runs)
+        inputs = attach_subject(args.sub, runs)
+    jr.fit_subject(args.sub, args.run, profile=args.profile, warm=args.warm, starts=args.starts, joint=args.joint,
+                   inputs=inputs, checkpoint_every=args.checkpoint_every, warm_subject=args.warm_subject)
+
+
+def run_simulate(args):
+    import numpy as np
+    import JR_Model_Fitting as jr
+    F = jr.load_fit(args.fit)
+    meg_data = np.load(args.meg) if args.meg else None
+    prefix = args.out or os.path.splitext(args.fit)[0]
+    if args.numpy:
+        from JR_Numpy import JRNumpy
+        values = jr.export_numpy_model(F)
+        model = JRNumpy(values, values['steps_per_TR'], values['TRs_per_window'])
+        u = np.zeros((model.node_size, model.steps_per_TR, args.length))
+        u[:, :, 100:140] = 5000
+        out = model.simulate(u, base_window_num=args.base_windows, seed=args.seed)
+        P, eeg = out['P'], out['eeg']
+    else:
+        if args.seed is not None:
+            np.random.seed(args.seed)
+            jr.torch.manual_seed(args.seed)
+        jr.simulate_fit(F, meg_data, args.length, args.base_windows)
+        P, eeg = F.output_sim.P_test, F.output_sim.eeg_test
+    np.save(prefix + '_source_ts.npy', P)
+    np.save(prefix + '_sensor_ts.npy', eeg)
+    print(f"Saved results to:\n  {prefix}_source_ts.npy\n  {prefix}_sensor_ts.npy")
+
+
+def run_transplant(args):
+    import JR_Model_Fitting as jr
+    jr.transplant_fit(args.sub, args.run, args.group, fits_path=args.fits, out_path=args.out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('fit', help='fit the evoked M/EEG of one subject (JR_Model_Fitting.fit_subject)')
+    p.add_argument('sub')
+    p.add_argument('run')
+    p.add_argument('--profile', action='store_true', help='write a FitProfiler report')
+    p.add_argument('--warm', default=None, help='fitted .pkl or parameter .npz to warm-start from')
+    p.add_argument('--warm-subject', action='store_true',
+                   help='also warm-start the leadfield (only for a warm fit of the same subject)')
+    p.add_argument('--starts', type=int, default=None, help='number of starts of a multi-start fit')
+    p.add_argument('--joint', default=None, help='second run fitted jointly with shared connection gains')
+    p.add_argument('--checkpoint-every', type=int, default=None,
+                   help='checkpoint the (single-start) training every N epochs and resume from an existing '
+                        'checkpoint of the same settings')
+    p.add_argument('--shared', action='store_true',
+                   help='read the inputs from the node-local shared copy (JR_SharedInputs), publishing it if needed')
+    p.set_defaults(func=run_fit)
+
+    p = sub.add_parser('simulate', help='stimulus-driven simulation of a fitted model')
+    p.add_argument('fit', help='_fittingresults_stim_exp.pkl')
+    p.add_argument('--meg', default=None, help='evoked data of the run (FC/cosine report only)')
+    p.add_argument('--length', type=int, default=1500, help='simulated samples')
+    p.add_argument('--base-windows', type=int, default=250, help='burn-in windows')
+    p.add_argument('--numpy', action='store_true', help='simulate with the NumPy engine (JR_Numpy)')
+    p.add_argument('--seed', type=int, default=None)
+    p.add_argument('--out', default=None, help='prefix of the _source_ts/_sensor_ts.npy outputs')
+    p.set_defaults(func=run_simulate)
+
+    p = sub.add_parser('transplant', help='simulate a fit with the frontal interhemispheric P2I of a group')
+    p.add_argument('sub')
+    p.add_argument('run')
+    p.add_argument('--group', default='YC', help='source group of avg_{group}_sc_p2i.npy')
+    p.add_argument('--fits', default=None, help='directory of the fitted models (default output_path)')
+    p.add_argument('--out', default=None, help='output directory (default output_path)')
+    p.set_defaults(func=run_transplant)
+
+    args = parser.parse_args(argv)
+    if args.command == 'fit' and (args.starts or args.joint) and (args.checkpoint_every or args.warm):
+        parser.error('--checkpoint-every and --warm are only supported by single-start fits (not --starts/--joint)')
+    import warnings
+    warnings.filterwarnings('ignore')
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Hierarchical (group-level) JR fitting of a cohort in one process.
+
+All subjects of the batch are simulated by one RNNJANSENBatch (each with its own connectome, distances,
+leadfield and evoked data) and share learnable group-level prior means and precisions of the scalar
+parameters; with `age` the prior means also get a learnable linear age slope (age from CTL_XX_YY).
+
+    python JR_Group_Fitting.py <run> <sub1> <sub2> ... [age]
+
+Training stops once every subject passes the FC stop rule. Every subject is saved with the outputs of
+fit_subject ({sub}_{run}_fittingresults_stim_exp.pkl, _fields.npz and the _pred1500 source/sensor time
+series), and the group-level hyper parameters as group_{run}_prior.npz.
+"""
+import sys
+import warnings
+
+import numpy as np
+
+from JR_Atlas import atlas
+from JR_Model_Fitting import (output_path, RNNJANSENBatch, BatchFitting, dataloader, default_jr_params,
+                              load_subject_inputs, save_params, save_fit_outputs, stack_epochs)
+
+
+def load_subject(sub, run, num_epoches, batch_size):
+    """
+    Model inputs of one subject, prepared as in JR_Model_Fitting.py, and its evoked data.
+    """
+    inputs = load_subject_inputs(sub, [run])
+    meg_data = inputs['meg'][run]
+    meg_sub = meg_data / np.abs(meg_data).max()
+    return inputs['sc'], inputs['dist'], inputs['lm'], dataloader(meg_sub.T, num_epoches, batch_size), meg_data
+
+
+if __name__ == "__main__":
+    warnings.filterwarnings('ignore')
+    run = sys.argv[1]
+    subs = [arg for arg in sys.argv[2:] if arg != 'age']
+    ages = [int(sub.split('_')[-1]) for sub in subs] if 'age' in sys.argv[2:] else None
+
+    batch_size = 250
+    step_size = 0.0001
+    num_epoches = 250
+    tr = 0.001
+
+    inputs = [load_subject(sub, run, num_epoches, batch_size) for sub in subs]
+    sc, dist, lm = [np.stack(x) for x in list(zip(*inputs))[:3]]
+    data = stack_epochs([x[3] for x in inputs])
+    meg = [x[4] for x in inputs]
+    node_size = sc.shape[1]
+    output_size = lm.shape[1]
+    time_dim = data.shape[2] * batch_size
+    hidden_size = int(tr / step_size)
+
+    ki0 = atlas(node_size).stimulus_input()
+    pars = [default_jr_params(lm_s, ki0) for lm_s in lm]
+
+    model = RNNJANSENBatch(len(subs), node_size, batch_size, step_size, output_size, tr, sc, lm, dist, True, False,
+                           pars, group_prior=True, age=ages)
+    model.setModelParameters()
+
+    u = np.zeros((node_size, hidden_size, time_dim))
+    u[:, :, 100:140] = 5000
+
+    B = BatchFitting(model, data, num_epoches, 0)
+    B.train(u=u, stop='all')
+
+    group = {key: value.detach().numpy().copy() for key, value in model.named_parameters()
+             if value.shape[0] == 1 and (key.endswith('_m') or key.endswith('_v_inv') or key.endswith('_m_age'))}
+    save_params(group, output_path + '/group_' + run + '_prior.npz')
+
+    for i, sub in enumerate(subs):
+        save_fit_outputs(B.best_fit(i), sub, run, meg[i], u)
@@ -3,12 +3,22 @@ output_path = "path/to/output/"  # Directory to save model outputs
 
 
 import numpy as np
-import pandas as pd
 import torch
 import torch.optim as optim
 from torch.nn.parameter import Parameter
-from sklearn.metrics.pairwise import cosine_similarity
 import pickle
+import contextlib
+import copy
+import io
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import warnings
+
+from JR_Atlas import FRONTAL_ROI, atlas, frontal_hemisphere_idx  # noqa: F401 (re-exported)
 
 
 class ParamsModel:
@@ -121,16 +131,21 @@ class OutputNM:
 
 
 def dataloader(emp, epoch_size, TRperwindow):
+    """
+    Windows of the empirical data for every epoch (epoch_size x window x node x TRperwindow).
+    A single time series (time x node) gives the same windows in every epoch: they are stored once and the
+    epochs are a read-only broadcast view of them (no epoch_size copies). Several series (data x time x node)
+    are cycled over the epochs.
+    """
     window_size = int(emp.shape[0] / TRperwindow)
     data_out = 0
     if len(emp.shape) == 2:
         node_size = emp.shape[1]
         length_ts = emp.shape[0]
         window_size = int(length_ts / TRperwindow)
-        data_out = np.zeros((epoch_size, window_size, node_size, TRperwindow))
-        for i_epoch in range(epoch_size):
-            for i_win in range(window_size):
-                data_out[i_epoch, i_win, :, :] = emp.T[:, i_win * TRperwindow:(i_win + 1) * TRperwindow]
+        windows = np.asarray(emp, dtype=np.float64)[:window_size * TRperwindow].T
+        windows = np.ascontiguousarray(windows.reshape(node_size, window_size, TRperwindow).transpose(1, 0, 2))
+        data_out = np.broadcast_to(windows, (epoch_size, window_size, node_size, TRperwindow))
     if len(emp.shape) == 3:
         node_size = emp.shape[2]
         length_ts = emp.shape[1]
@@ -143,6 +158,16 @@ def dataloader(emp, epoch_size, TRperwindow):
                     emp[i_epoch % data_size, i_win * TRperwindow:(i_win + 1) * TRperwindow, :].T
     return data_out
 
+def stack_epochs(data):
+    """
+    Stack the dataloader outputs of several models (models x epochs x window x node x TRperwindow); repeated
+    epochs (broadcast views) stay a view of the stacked windows.
+    """
+    data = [np.asarray(d) for d in data]
+    if all(d.strides[0] == 0 for d in data):
+        return np.broadcast_to(np.stack([d[0] for d in data])[:, None], (len(data),) + data[0].shape)
+    return np.stack(data)
+
 def sys2nd(A, a, u, x, v):
     return A * a * u - 2 * a * v - a ** 2 * x
 
@@ -163,6 +188,44 @@ def h_tf(a, b, d, z):
     return torch.divide(num, den)
 
 
+GAIN_NAMES = ['w_bb', 'w_ff', 'w_ll']  # connection gains of the JR model (P->I, P->E and P->P coupling)
+
+
+def set_gain_parameters(model):
+    """
+    Fitted parameters of the connection gains for model.gain_mode (JR only)
+    'lowrank': name_u, name_v node_size x gain_rank factors, w = 0.05 + name_u name_v^T
+    'block': name_blk n_blocks x n_blocks gains between the groups of gain_labels, w = name_blk[labels][:, labels]
+    'sparse': name_nz gains on the non-zero entries of sc only (the other entries are multiplied by sc = 0)
+    All start from the dense initial value 0.05.
+    """
+    N = model.node_size
+    for name in GAIN_NAMES:
+        if model.gain_mode == 'lowrank':
+            setattr(model, name + '_u', Parameter(torch.zeros((N, model.gain_rank), dtype=torch.float32)))
+            setattr(model, name + '_v', Parameter(0.01 * torch.randn((N, model.gain_rank), dtype=torch.float32)))
+        elif model.gain_mode == 'block':
+            n_blocks = int(model.gain_labels.max()) + 1
+            setattr(model, name + '_blk', Parameter(torch.zeros((n_blocks, n_blocks), dtype=torch.float32) + 0.05))
+        elif model.gain_mode == 'sparse':
+            setattr(model, name + '_nz', Parameter(torch.zeros(len(model.gain_rows), dtype=torch.float32) + 0.05))
+
+
+def gain_matrix(model, name):
+    """
+    Effective node_size x node_size connection gain (w_bb, w_ff or w_ll) of a JR model
+    under its gain parameterisation (see set_gain_parameters).
+    """
+    gain_mode = getattr(model, 'gain_mode', 'dense')
+    if gain_mode == 'dense' or not model.use_fit_gains:
+        return getattr(model, name)
+    if gain_mode == 'lowrank':
+        return 0.05 + torch.matmul(getattr(model, name + '_u'), getattr(model, name + '_v').T)
+    if gain_mode == 'block':
+        return getattr(model, name + '_blk')[model.gain_labels][:, model.gain_labels]
+    w = torch.zeros((model.node_size, model.node_size), dtype=torch.float32)
+    return w.index_put((model.gain_rows, model.gain_cols), getattr(model, name + '_nz'))
+
 
 def setModelParameters(model):
     if model.model_name == 'RWW':
@@ -223,7 +286,9 @@ def setModelParameters(model):
     if model.model_name == 'JR':
         # set model parameters (variables: need to calculate gradient) as Parameter others : tensor
         # set w_bb as Parameter if fit_gain is True
-        if model.use_fit_gains:
+        if model.use_fit_gains and getattr(model, 'gain_mode', 'dense') != 'dense':
+            set_gain_parameters(model)
+        elif model.use_fit_gains:
             model.w_bb = Parameter(torch.tensor(np.zeros((model.node_size, model.node_size)) + 0.05,
                                                 dtype=torch.float32))  # connenction gain to modify empirical sc
             model.w_ff = Parameter(torch.tensor(np.zeros((model.node_size, model.node_size)) + 0.05,
@@ -298,6 +363,63 @@ def setModelParameters(model):
                 setattr(model, var, torch.tensor(getattr(model.param, var)[0], dtype=torch.float32))
 
 
+def balloon_window(model, E_hist, x, f, v, q, saturate):
+    """
+    Balloon-Windkessel stage of the RWW model for one window: a single scan over the
+    TRs_per_window x steps_per_TR recorded excitatory activities, with the BOLD observation
+    computed for all TRs of the window at once.
+    Parameters
+    ----------
+    E_hist: tensor with node_size x TRs_per_window x steps_per_TR
+        excitatory activity driving the haemodynamics
+    x, f, v, q: tensors with node_size x 1
+        haemodynamic states at the start of the window
+    saturate: bool
+        tanh saturation of the states (dynamic boundary) instead of lower bounds on f, v and q
+    Outputs
+    -------
+    x, f, v, q at the end of the window, and x_window, f_window, v_window, q_window, bold_window
+    (node_size x TRs_per_window)
+    """
+    m = torch.nn.ReLU()
+    dt = torch.tensor(model.step_size, dtype=torch.float32)
+    inv_tau_s = torch.reciprocal(model.tau_s)
+    inv_tau_f = torch.reciprocal(model.tau_f)
+    inv_tau_0 = torch.reciprocal(model.tau_0)
+    inv_alpha = torch.reciprocal(model.alpha)
+    inv_rho = torch.reciprocal(model.rho)
+
+    E_steps = E_hist.reshape((model.node_size, -1))
+    windows = {'x': [], 'f': [], 'v': [], 'q': []}
+    for i_step in range(E_steps.shape[1]):
+        x_next = x + dt * (E_steps[:, i_step:i_step + 1] - inv_tau_s * x - inv_tau_f * (f - 1))
+        f_next = f + dt * x
+        v_next = v + dt * (f - torch.pow(v, inv_alpha)) * inv_tau_0
+        q_next = q + dt * (f * (1 - torch.pow(1 - model.rho, torch.reciprocal(f))) * inv_rho
+                           - q * torch.pow(v, inv_alpha) * torch.reciprocal(v)) * inv_tau_0
+        if saturate:
+            x = torch.tanh(x_next)
+            f = (1 + torch.tanh(f_next - 1))
+            v = (1 + torch.tanh(v_next - 1))
+            q = (1 + torch.tanh(q_next - 1))
+        else:
+            x = x_next
+            f = torch.clamp(f_next, min=0.001)
+            v = torch.clamp(v_next, min=0.001)
+            q = torch.clamp(q_next, min=0.001)
+        if (i_step + 1) % model.steps_per_TR == 0:
+            for name, value in zip(['x', 'f', 'v', 'q'], [x, f, v, q]):
+                windows[name].append(value)
+    windows = {name: torch.cat(value, dim=1) for name, value in windows.items()}
+
+    # BOLD of all TRs (the noise is drawn TR by TR, node_size values each)
+    noise = torch.randn(model.TRs_per_window, model.node_size).T
+    q_w, v_w = windows['q'], windows['v']
+    bold_window = (0.00 + m(model.std_out)) * noise + 100.0 * model.V * torch.reciprocal(model.E0) * \
+        (model.k1 * (1 - q_w) + model.k2 * (1 - q_w * torch.reciprocal(v_w)) + model.k3 * (1 - v_w))
+    return x, f, v, q, windows['x'], windows['f'], windows['v'], windows['q'], bold_window
+
+
 def integration_forward(model, external, hx, hE):
     if model.model_name == 'RWW':
         """
@@ -333,7 +455,7 @@ def integration_forward(model, external, hx, hE):
         if model.sc.shape[0] > 1:
 
             # Update the Laplacian based on the updated connection gains gains_con.
-            sc_mod = torch.exp(model.gains_con) * torch.tensor(model.sc, dtype=torch.float32)
+            sc_mod = torch.exp(model.gains_con) * sc_tensor(model)
             sc_mod_normalized = (0.5 * (sc_mod + torch.transpose(sc_mod, 0, 1))) / torch.linalg.norm(
                 0.5 * (sc_mod + torch.transpose(sc_mod, 0, 1)))
             model.sc_fitted = sc_mod_normalized
@@ -349,56 +471,42 @@ def integration_forward(model, external, hx, hE):
         # placeholder for the updated current state
         current_state = torch.zeros_like(hx)
 
-        # placeholders for output BOLD, history of E I x f v and q
-        # placeholders for output BOLD, history of E I x f v and q
-        bold_window = torch.zeros((model.node_size, model.TRs_per_window))
-        # E_window = torch.zeros((model.node_size,model.TRs_per_window))
-        # I_window = torch.zeros((model.node_size,model.TRs_per_window))
-
-        x_window = torch.zeros((model.node_size, model.TRs_per_window))
-        f_window = torch.zeros((model.node_size, model.TRs_per_window))
-        v_window = torch.zeros((model.node_size, model.TRs_per_window))
-        q_window = torch.zeros((model.node_size, model.TRs_per_window))
-
         E_hist = torch.zeros((model.node_size, model.TRs_per_window, model.steps_per_TR))
         I_hist = torch.zeros((model.node_size, model.TRs_per_window, model.steps_per_TR))
         E_mean = hx[:, 0:1]
         I_mean = hx[:, 1:2]
-        # print(E_m.shape)
+        # spread of the sampled E around its mean
+        E_sample_std = 0.02 if model.use_dynamic_boundary else 0.001
         # Use the forward model to get neural activity at ith element in the window.
-        if model.use_dynamic_boundary:
-            for TR_i in range(model.TRs_per_window):
-
-                # print(E.shape)
-
-                # Since tr is about second we need to use a small step size like 0.05 to integrate the model states.
-                for step_i in range(model.steps_per_TR):
-                    E = torch.zeros((model.node_size, model.sampling_size))
-                    I = torch.zeros((model.node_size, model.sampling_size))
-                    for sample_i in range(model.sampling_size):
-                        E[:, sample_i] = E_mean[:, 0] + 0.02 * torch.randn(model.node_size)
-                        I[:, sample_i] = I_mean[:, 0] + 0.001 * torch.randn(model.node_size)
-
-                    # Calculate the input recurrent.
-                    IE = torch.tanh(m(model.W_E * model.I_0 + (0.001 + m(model.g_EE)) * E
-                                      + model.g * torch.matmul(lap_adj, E) - (
-                                              0.001 + m(model.g_IE)) * I))  # input currents for E
-                    II = torch.tanh(m(model.W_I * model.I_0 + (0.001 + m(model.g_EI)) * E - I))  # input currents for I
-
-                    # Calculate the firing rates.
-                    rE = h_tf(model.aE, model.bE, model.dE, IE)  # firing rate for E
-                    rI = h_tf(model.aI, model.bI, model.dI, II)  # firing rate for I
-                    # Update the states by step-size 0.05.
-                    E_next = E + dt * (-E * torch.reciprocal(model.tau_E) + model.gamma_E * (1. - E) * rE) \
-                             + torch.sqrt(dt) * torch.randn(model.node_size, model.sampling_size) * (0.02 + m(
-                        model.std_in))  ### equlibrim point at E=(tau_E*gamma_E*rE)/(1+tau_E*gamma_E*rE)
-                    I_next = I + dt * (-I * torch.reciprocal(model.tau_I) + model.gamma_I * rI) \
-                             + torch.sqrt(dt) * torch.randn(model.node_size, model.sampling_size) * (
-                                     0.02 + m(model.std_in))
-
-                    # Calculate the saturation for model states (for stability and gradient calculation).
-
-                    # E_next[E_next>=0.9] = torch.tanh(1.6358*E_next[E_next>=0.9])
+        for TR_i in range(model.TRs_per_window):
+
+            # Since tr is about second we need to use a small step size like 0.05 to integrate the model states.
+            for step_i in range(model.steps_per_TR):
+                # samples around the mean states, one draw for all samples
+                # (ordered as the former per-sample E then I draws)
+                noise = torch.randn(model.sampling_size, 2, model.node_size)
+                E = E_mean + E_sample_std * noise[:, 0].T
+                I = I_mean + 0.001 * noise[:, 1].T
+
+                # Calculate the input recurrent.
+                IE = torch.tanh(m(model.W_E * model.I_0 + (0.001 + m(model.g_EE)) * E
+                                  + model.g * torch.matmul(lap_adj, E) - (
+                                          0.001 + m(model.g_IE)) * I))  # input currents for E
+                II = torch.tanh(m(model.W_I * model.I_0 + (0.001 + m(model.g_EI)) * E - I))  # input currents for I
+
+                # Calculate the firing rates.
+                rE = h_tf(model.aE, model.bE, model.dE, IE)  # firing rate for E
+                rI = h_tf(model.aI, model.bI, model.dI, II)  # firing rate for I
+                # Update the states by step-size 0.05.
+                E_next = E + dt * (-E * torch.reciprocal(model.tau_E) + model.gamma_E * (1. - E) * rE) \
+                         + torch.sqrt(dt) * torch.randn(model.node_size, model.sampling_size) * (0.02 + m(
+                    model.std_in))  ### equlibrim point at E=(tau_E*gamma_E*rE)/(1+tau_E*gamma_E*rE)
+                I_next = I + dt * (-I * torch.reciprocal(model.tau_I) + model.gamma_I * rI) \
+                         + torch.sqrt(dt) * torch.randn(model.node_size, model.sampling_size) * (
+                                 0.02 + m(model.std_in))
+
+                # Calculate the saturation for model states (for stability and gradient calculation).
+                if model.use_dynamic_boundary:
                     E = torch.tanh(0.0000 + m(1.0 * E_next))
                     I = torch.tanh(0.0000 + m(1.0 * I_next))
 
@@ -409,114 +517,20 @@ def integration_forward(model, external, hx, hE):
 
                     E_hist[:, TR_i, step_i] = E_mean[:, 0]
                     I_hist[:, TR_i, step_i] = I_mean[:, 0]
-
-            for TR_i in range(model.TRs_per_window):
-
-                for step_i in range(model.steps_per_TR):
-                    x_next = x + 1 * dt * (1 * E_hist[:, TR_i, step_i][:, np.newaxis] - torch.reciprocal(
-                        model.tau_s) * x - torch.reciprocal(model.tau_f) * (f - 1))
-                    f_next = f + 1 * dt * x
-                    v_next = v + 1 * dt * (f - torch.pow(v, torch.reciprocal(model.alpha))) * torch.reciprocal(
-                        model.tau_0)
-                    q_next = q + 1 * dt * (
-                            f * (1 - torch.pow(1 - model.rho, torch.reciprocal(f))) * torch.reciprocal(
-                        model.rho) - q * torch.pow(v, torch.reciprocal(model.alpha)) * torch.reciprocal(v)) \
-                             * torch.reciprocal(model.tau_0)
-
-                    x = torch.tanh(x_next)
-                    f = (1 + torch.tanh(f_next - 1))
-                    v = (1 + torch.tanh(v_next - 1))
-                    q = (1 + torch.tanh(q_next - 1))
-                    # Put x f v q from each tr to the placeholders for checking them visually.
-                x_window[:, TR_i] = x[:, 0]
-                f_window[:, TR_i] = f[:, 0]
-                v_window[:, TR_i] = v[:, 0]
-                q_window[:, TR_i] = q[:, 0]
-
-                # Put the BOLD signal each tr to the placeholder being used in the cost calculation.
-
-                bold_window[:, TR_i] = ((0.00 + m(model.std_out)) * torch.randn(model.node_size, 1) +
-                                        100.0 * model.V * torch.reciprocal(model.E0) *
-                                        (model.k1 * (1 - q) + model.k2 * (1 - q * torch.reciprocal(v)) + model.k3 * (
-                                                1 - v)))[:, 0]
-        else:
-
-            for TR_i in range(model.TRs_per_window):
-
-                # print(E.shape)
-
-                # Since tr is about second we need to use a small step size like 0.05 to integrate the model states.
-                for step_i in range(model.steps_per_TR):
-                    E = torch.zeros((model.node_size, model.sampling_size))
-                    I = torch.zeros((model.node_size, model.sampling_size))
-                    for sample_i in range(model.sampling_size):
-                        E[:, sample_i] = E_mean[:, 0] + 0.001 * torch.randn(model.node_size)
-                        I[:, sample_i] = I_mean[:, 0] + 0.001 * torch.randn(model.node_size)
-
-                    # Calculate the input recurrent.
-                    IE = 1 * torch.tanh(m(model.W_E * model.I_0 + (0.001 + m(model.g_EE)) * E \
-                                          + model.g * torch.matmul(lap_adj, E) - (
-                                                  0.001 + m(model.g_IE)) * I))  # input currents for E
-                    II = 1 * torch.tanh(
-                        m(model.W_I * model.I_0 + (0.001 + m(model.g_EI)) * E - I))  # input currents for I
-
-                    # Calculate the firing rates.
-                    rE = h_tf(model.aE, model.bE, model.dE, IE)  # firing rate for E
-                    rI = h_tf(model.aI, model.bI, model.dI, II)  # firing rate for I
-                    # Update the states by step-size 0.05.
-                    E_next = E + dt * (-E * torch.reciprocal(model.tau_E) + model.gamma_E * (1. - E) * rE) \
-                             + torch.sqrt(dt) * torch.randn(model.node_size, model.sampling_size) * (0.02 + m(
-                        model.std_in))  ### equlibrim point at E=(tau_E*gamma_E*rE)/(1+tau_E*gamma_E*rE)
-                    I_next = I + dt * (-I * torch.reciprocal(model.tau_I) + model.gamma_I * rI) \
-                             + torch.sqrt(dt) * torch.randn(model.node_size, model.sampling_size) * (
-                                     0.02 + m(model.std_in))
-
-                    # Calculate the saturation for model states (for stability and gradient calculation).
+                else:
                     E_next[E_next < 0.00001] = 0.00001
                     I_next[I_next < 0.00001] = 0.00001
-                    # E_next[E_next>=0.9] = torch.tanh(1.6358*E_next[E_next>=0.9])
-                    E = E_next  # torch.tanh(0.00001+m(1.0*E_next))
-                    I = I_next  # torch.tanh(0.00001+m(1.0*I_next))
+                    E = E_next
+                    I = I_next
 
                     I_mean = I.mean(1)[:, np.newaxis]
                     E_mean = E.mean(1)[:, np.newaxis]
                     E_hist[:, TR_i, step_i] = torch.tanh(E_mean)[:, 0]
                     I_hist[:, TR_i, step_i] = torch.tanh(I_mean)[:, 0]
 
-                # E_window[:,TR_i]=E_mean[:,0]
-                # I_window[:,TR_i]=I_mean[:,0]
-
-            for TR_i in range(model.TRs_per_window):
-
-                for step_i in range(model.steps_per_TR):
-                    x_next = x + 1 * dt * (1 * E_hist[:, TR_i, step_i][:, np.newaxis] - torch.reciprocal(
-                        model.tau_s) * x - torch.reciprocal(model.tau_f) * (f - 1))
-                    f_next = f + 1 * dt * x
-                    v_next = v + 1 * dt * (f - torch.pow(v, torch.reciprocal(model.alpha))) * torch.reciprocal(
-                        model.tau_0)
-                    q_next = q + 1 * dt * (
-                            f * (1 - torch.pow(1 - model.rho, torch.reciprocal(f))) * torch.reciprocal(
-                        model.rho) - q * torch.pow(v, torch.reciprocal(model.alpha)) * torch.reciprocal(v)) \
-                             * torch.reciprocal(model.tau_0)
-
-                    f_next[f_next < 0.001] = 0.001
-                    v_next[v_next < 0.001] = 0.001
-                    q_next[q_next < 0.001] = 0.001
-                    x = x_next  # torch.tanh(x_next)
-                    f = f_next  # (1 + torch.tanh(f_next - 1))
-                    v = v_next  # (1 + torch.tanh(v_next - 1))
-                    q = q_next  # (1 + torch.tanh(q_next - 1))
-                # Put x f v q from each tr to the placeholders for checking them visually.
-                x_window[:, TR_i] = x[:, 0]
-                f_window[:, TR_i] = f[:, 0]
-                v_window[:, TR_i] = v[:, 0]
-                q_window[:, TR_i] = q[:, 0]
-                # Put the BOLD signal each tr to the placeholder being used in the cost calculation.
-
-                bold_window[:, TR_i] = ((0.00 + m(model.std_out)) * torch.randn(model.node_size, 1) +
-                                        100.0 * model.V * torch.reciprocal(
-                            model.E0) * (model.k1 * (1 - q) + model.k2 * (
-                                1 - q * torch.reciprocal(v)) + model.k3 * (1 - v)))[:, 0]
+        # Balloon-Windkessel BOLD over the recorded E
+        x, f, v, q, x_window, f_window, v_window, q_window, bold_window = \
+            balloon_window(model, E_hist, x, f, v, q, model.use_dynamic_boundary)
 
         # Update the current state.
         # print(E_m.shape)
@@ -562,19 +576,22 @@ def integration_forward(model, external, hx, hE):
         if model.sc.shape[0] > 1:
 
             # Update the Laplacian based on the updated connection gains w_bb.
-            w_b = torch.exp(model.w_bb) * torch.tensor(model.sc, dtype=torch.float32)
+            w_b = torch.exp(gain_matrix(model, 'w_bb')) * sc_tensor(model)
             w_n_b = w_b / torch.linalg.norm(w_b)
+            # a transplanted P->I coupling (transplant_p2i) replaces the fitted one
+            if getattr(model, 'sc_m_b_fixed', None) is not None:
+                w_n_b = model.sc_m_b_fixed
 
             model.sc_m_b = w_n_b
             dg_b = -torch.diag(torch.sum(w_n_b, dim=1))
             # Update the Laplacian based on the updated connection gains w_bb.
-            w_f = torch.exp(model.w_ff) * torch.tensor(model.sc, dtype=torch.float32)
+            w_f = torch.exp(gain_matrix(model, 'w_ff')) * sc_tensor(model)
             w_n_f = w_f / torch.linalg.norm(w_f)
 
             model.sc_m_f = w_n_f
             dg_f = -torch.diag(torch.sum(w_n_f, dim=1))
             # Update the Laplacian based on the updated connection gains w_bb.
-            w = torch.exp(model.w_ll) * torch.tensor(model.sc, dtype=torch.float32)
+            w = torch.exp(gain_matrix(model, 'w_ll')) * sc_tensor(model)
             w_n_l = (0.5 * (w + torch.transpose(w, 0, 1))) / torch.linalg.norm(
                 0.5 * (w + torch.transpose(w, 0, 1)))
 
@@ -735,7 +752,7 @@ def integration_forward(model, external, hx, hE):
         if model.sc.shape[0] > 1:
 
             # Update the Laplacian based on the updated connection gains gains_con.
-            sc_mod = torch.exp(model.gains_con) * torch.tensor(model.sc, dtype=torch.float32)
+            sc_mod = torch.exp(model.gains_con) * sc_tensor(model)
             sc_mod_normalized = (0.5 * (sc_mod + torch.transpose(sc_mod, 0, 1))) / torch.linalg.norm(
                 0.5 * (sc_mod + torch.transpose(sc_mod, 0, 1)))
             model.sc_fitted = sc_mod_normalized
@@ -826,6 +843,241 @@ def integration_forward(model, external, hx, hE):
 
         return next_state, hE
 
+
+def stack_members(values):
+    """
+    Stack per-member values into a tensor with a leading member dimension; scalars become
+    num_models x 1 x 1 so they broadcast against num_models x node_size x 1 states.
+    """
+    arr = np.stack([np.asarray(value, dtype=np.float64) for value in values])
+    if arr.ndim == 1:
+        arr = arr.reshape(-1, 1, 1)
+    return torch.tensor(arr, dtype=torch.float32)
+
+
+def setModelParametersBatch(model):
+    """
+    Batched counterpart of setModelParameters (JR only): every fitted parameter, its prior mean (_m)
+    and precision (_v_inv) get a leading dimension of num_models, with independent random jitter
+    per member. Parameters named in model.shared get a leading dimension of 1 (one value, with the
+    prior of the first member, used by all members). Fixed parameters are shared unless their values
+    differ across the members' ParamsModel.
+    With model.group_prior the prior mean and precision of every fitted scalar parameter are single
+    learnable group-level values initialised from the first member's prior (plus a learnable slope
+    var_m_age on the standardised age when model.age is set), so the members are pooled towards them.
+    """
+    P = model.num_models
+    N = model.node_size
+    if model.use_fit_gains:
+        for name in ['w_bb', 'w_ff', 'w_ll']:
+            n = 1 if name in model.shared else P
+            setattr(model, name, Parameter(torch.zeros((n, N, N), dtype=torch.float32) + 0.05))
+    else:
+        model.w_bb = torch.zeros((1, N, N), dtype=torch.float32)
+        model.w_ff = torch.zeros((1, N, N), dtype=torch.float32)
+        model.w_ll = torch.zeros((1, N, N), dtype=torch.float32)
+
+    if model.use_fit_lfm:
+        n = 1 if 'lm' in model.shared else P
+        model.lm = Parameter(model.lm.expand(n, -1, -1).clone())  # leadfield matrix from sourced data to m/eeg
+
+    vars_name = [a for a in dir(model.param) if not a.startswith('__') and not callable(getattr(model.param, a))]
+    for var in vars_name:
+        params = model.params[:1] if var in model.shared else model.params
+        means = [getattr(param, var)[0] for param in params]
+        stds = [getattr(param, var)[1] for param in params]
+        if np.any(stds[0] > 0):
+            values = []
+            for mean, std in zip(means, stds):
+                if type(std) is np.ndarray:
+                    if var == 'lm':
+                        values.append(mean - 0 * np.ones(std.shape))
+                    else:
+                        values.append(mean + std * np.random.randn(*std.shape))
+                else:
+                    values.append(mean + std * np.random.randn(1, )[0])
+            setattr(model, var, Parameter(stack_members(values)))
+            if var != 'std_in' and model.group_prior and type(stds[0]) is not np.ndarray:
+                setattr(model, var + '_m', Parameter(stack_members(means[:1])))
+                setattr(model, var + '_v_inv', Parameter(stack_members([1 / stds[0] ** 2])))
+                if model.age is not None:
+                    setattr(model, var + '_m_age', Parameter(torch.zeros((1, 1, 1), dtype=torch.float32)))
+            elif var != 'std_in':
+                setattr(model, var + '_m', Parameter(stack_members(means)))
+                setattr(model, var + '_v_inv', Parameter(stack_members([1 / std ** 2 for std in stds])))
+        elif all(np.array_equal(mean, means[0]) for mean in means):
+            setattr(model, var, torch.tensor(means[0], dtype=torch.float32))
+        else:
+            setattr(model, var, stack_members(means))
+            model.member_vars.add(var)
+
+
+def integration_forward_batch(model, external, hx, hE):
+    """
+    Forward step of num_models JansenRit models at once (same equations as the JR branch of
+    integration_forward, with a leading member dimension on states, parameters and inputs).
+    Parameters
+    ----------
+    external: tensor with node_size x steps_per_TR x TRs_per_window (shared)
+        or num_models x node_size x steps_per_TR x TRs_per_window
+        stimulus
+    hx: tensor with num_models x node_size x state_size
+        states of the JR models
+    hE: tensor with num_models x node_size x delays_max
+        history of P for the delayed long-range input
+    Outputs
+    -------
+    next_state: dictionary with the same keys as integration_forward, with num_models x ... tensors
+    """
+    # define some constants
+    conduct_lb = 1.5  # lower bound for conduct velocity
+    u_2ndsys_ub = 500  # the bound of the input for second order system
+    lb = 0.01  # lower bound of local gains
+    k_lb = 0.5  # lower bound of coefficient of external inputs
+
+    P = hx.shape[0]
+    next_state = {}
+
+    M = hx[:, :, 0:1]  # current of main population
+    E = hx[:, :, 1:2]  # current of excitory population
+    I = hx[:, :, 2:3]  # current of inhibitory population
+
+    Mv = hx[:, :, 3:4]  # voltage of main population
+    Ev = hx[:, :, 4:5]  # voltage of exictory population
+    Iv = hx[:, :, 5:6]  # voltage of inhibitory population
+
+    dt = model.step_size
+    m = torch.nn.ReLU()
+    con_1 = torch.tensor(1.0, dtype=torch.float32)
+
+    # normalised connection gains (Frobenius norm per member)
+    w_b = torch.exp(model.w_bb) * model.sc
+    w_n_b = w_b / torch.linalg.norm(w_b, dim=(1, 2), keepdim=True)
+    model.sc_m_b = w_n_b
+    w_f = torch.exp(model.w_ff) * model.sc
+    w_n_f = w_f / torch.linalg.norm(w_f, dim=(1, 2), keepdim=True)
+    model.sc_m_f = w_n_f
+    w = torch.exp(model.w_ll) * model.sc
+    w_s = 0.5 * (w + torch.transpose(w, 1, 2))
+    w_n_l = w_s / torch.linalg.norm(w_s, dim=(1, 2), keepdim=True)
+    model.sc_fitted = w_n_l
+    # diagonal (Laplacian) terms as row sums: torch.matmul(diag(d), x) == d * x
+    dg_b = -torch.sum(w_n_b, dim=2, keepdim=True)
+    dg_f = -torch.sum(w_n_f, dim=2, keepdim=True)
+    dg_l = -torch.sum(w_n_l, dim=2, keepdim=True)
+
+    model.delays = (model.dist / (conduct_lb * con_1 + m(model.mu))).type(torch.int64).expand(P, -1, -1)
+    # transposed weights so that sum_j w[i, j] * Ed[j, i] is a row-wise product with Ed
+    w_n_b_t = torch.transpose(w_n_b, 1, 2)
+    w_n_f_t = torch.transpose(w_n_f, 1, 2)
+    w_n_l_t = torch.transpose(w_n_l, 1, 2)
+
+    # leadfield normalisation does not change within the window
+    lm = model.lm.expand(P, -1, -1)
+    lm_t = lm / torch.sum(torch.sqrt(lm ** 2), dim=2, keepdim=True)
+    model.lm_t = lm_t - torch.mean(lm_t, dim=1, keepdim=True)
+
+    eeg_window = []
+    E_window = []
+    I_window = []
+    M_window = []
+    Ev_window = []
+    Iv_window = []
+    Mv_window = []
+
+    for i_window in range(model.TRs_per_window):
+
+        for step_i in range(model.steps_per_TR):
+            Ed = hE.clone().gather(2, model.delays)  # delayed E
+
+            LEd_b = torch.sum(w_n_b_t * Ed, 1).unsqueeze(2)  # weights on delayed E
+            LEd_f = torch.sum(w_n_f_t * Ed, 1).unsqueeze(2)
+            LEd_l = torch.sum(w_n_l_t * Ed, 1).unsqueeze(2)
+
+            u_tms = external[..., step_i:step_i + 1, i_window]
+
+            rM = (k_lb * con_1 + m(model.k)) * m(model.ki) * u_tms + \
+                 (5 * con_1 + torch.exp(model.std_in)) * torch.randn(P, model.node_size, 1) + \
+                 1 * (lb * con_1 + m(model.g)) * (LEd_l + 1 * dg_l * M) + \
+                 sigmoid(E - I, model.vmax, model.v0, model.r)  # firing rate for Main population
+            rE = (0.0 + m(model.kE)) + (5 * con_1 + torch.exp(model.std_in)) * torch.randn(P, model.node_size, 1) + \
+                 1 * (lb * con_1 + m(model.g_f)) * (LEd_f + 1 * dg_f * (E - I)) + \
+                 (lb * con_1 + m(model.c2)) * sigmoid((lb * con_1 + m(model.c1)) * M, model.vmax, model.v0,
+                                                      model.r)  # firing rate for Excitory population
+            rI = (0.0 + m(model.kI)) + (5 * con_1 + torch.exp(model.std_in)) * torch.randn(P, model.node_size, 1) + \
+                 1 * (lb * con_1 + m(model.g_b)) * (-LEd_b - 1 * dg_b * (E - I)) + \
+                 (lb * con_1 + m(model.c4)) * sigmoid((lb * con_1 + m(model.c3)) * M, model.vmax, model.v0,
+                                                      model.r)  # firing rate for Inhibitory population
+
+            # Update the states by step-size.
+            ddM = M + dt * Mv
+            ddE = E + dt * Ev
+            ddI = I + dt * Iv
+            ddMv = Mv + dt * sys2nd(0 * con_1 + m(model.A), 1 * con_1 + m(model.a),
+                                    u_2ndsys_ub * torch.tanh(rM / u_2ndsys_ub), M, Mv)
+            ddEv = Ev + dt * sys2nd(0 * con_1 + m(model.A), 1 * con_1 + m(model.a),
+                                    u_2ndsys_ub * torch.tanh(rE / u_2ndsys_ub), E, Ev)
+            ddIv = Iv + dt * sys2nd(0 * con_1 + m(model.B), 1 * con_1 + m(model.b),
+                                    u_2ndsys_ub * torch.tanh(rI / u_2ndsys_ub), I, Iv)
+
+            # Calculate the saturation for model states (for stability and gradient calculation).
+            E = 1000 * torch.tanh(ddE / 1000)
+            I = 1000 * torch.tanh(ddI / 1000)
+            M = 1000 * torch.tanh(ddM / 1000)
+            Ev = 1000 * torch.tanh(ddEv / 1000)
+            Iv = 1000 * torch.tanh(ddIv / 1000)
+            Mv = 1000 * torch.tanh(ddMv / 1000)
+
+            # update placeholders for E buffer
+            hE[:, :, 0] = M[:, :, 0]
+
+        M_window.append(M)
+        I_window.append(I)
+        E_window.append(E)
+        Mv_window.append(Mv)
+        Iv_window.append(Iv)
+        Ev_window.append(Ev)
+        hE = torch.cat([M, hE[:, :, :-1]], dim=2)  # update placeholders for E buffer
+
+        eeg_window.append(model.cy0 * torch.matmul(model.lm_t, E - I) - 1 * model.y0)
+
+    next_state['current_state'] = torch.cat([M, E, I, Mv, Ev, Iv], dim=2)
+    next_state['eeg_window'] = torch.cat(eeg_window, dim=2)
+    next_state['E_window'] = torch.cat(E_window, dim=2)
+    next_state['I_window'] = torch.cat(I_window, dim=2)
+    next_state['P_window'] = torch.cat(M_window, dim=2)
+    next_state['Ev_window'] = torch.cat(Ev_window, dim=2)
+    next_state['Iv_window'] = torch.cat(Iv_window, dim=2)
+    next_state['Pv_window'] = torch.cat(Mv_window, dim=2)
+
+    return next_state, hE
+
+
+def as_shared_tensor(x):
+    """
+    float32 tensor of x that shares its memory when x already is a float32 array (e.g. a read-only
+    memmap attached with JR_SharedInputs.attach_subject) and is a copy otherwise.
+    """
+    x = np.asarray(x, dtype=np.float32)
+    if x.flags.writeable:
+        return torch.tensor(x)
+    with warnings.catch_warnings():
+        # the model never writes into dist/sc, torch warns about every non-writable array
+        warnings.simplefilter('ignore', UserWarning)
+        return torch.from_numpy(x)
+
+
+def sc_tensor(model):
+    """
+    float32 tensor of model.sc, built once per sc array (shares its memory when sc is an attached float32 input,
+    see as_shared_tensor) instead of at every forward call.
+    """
+    cached = getattr(model, '_sc_tensor', None)
+    if cached is None or cached[0] is not model.sc:
+        cached = model._sc_tensor = (model.sc, as_shared_tensor(model.sc))
+    return cached[1]
+
+
 class RNNJANSEN(torch.nn.Module):
     """
     A module for forward model (JansenRit) to simulate a batch of M/EEG signals
@@ -849,10 +1101,13 @@ class RNNJANSEN(torch.nn.Module):
         structural connectivity
     fit_gains: bool
         flag for fitting gains 1: fit 0: not fit
+    gain_mode: str
+        parameterisation of the fitted connection gains: 'dense', 'lowrank', 'block' or 'sparse'
     g, c1, c2, c3,c4: tensor with gradient on
         model parameters to be fit
     w_bb: tensor with node_size x node_size (grad on depends on fit_gains)
-        connection gains
+        connection gains (for gain_mode other than 'dense' the factors w_bb_u/w_bb_v, w_bb_blk or w_bb_nz;
+        effective_gains() returns the full matrices)
     std_in std_out: tensor with gradient on
         std for state noise and output noise
     hyper parameters for prior distribution of model parameters
@@ -866,7 +1121,8 @@ class RNNJANSEN(torch.nn.Module):
 
     def __init__(self, node_size: int,
                  TRs_per_window: int, step_size: float, output_size: int, tr: float, sc: float, lm: float, dist: float,
-                 use_fit_gains: bool, use_fit_lfm: bool, param: ParamsModel) -> None:
+                 use_fit_gains: bool, use_fit_lfm: bool, param: ParamsModel,
+                 gain_mode: str = 'dense', gain_rank: int = 4, gain_labels=None) -> None:
         """
         Parameters
         ----------
@@ -889,6 +1145,13 @@ class RNNJANSEN(torch.nn.Module):
         use_fit_lfm: bool
             flag for fitting gains 1: fit 0: not fit
         param from ParamJR
+        gain_mode: str
+            'dense' (node_size x node_size gains), 'lowrank' (rank gain_rank factors), 'block' (gains between
+            the groups of gain_labels, e.g. hemispheres or lobes) or 'sparse' (gains on the non-zero sc entries)
+        gain_rank: int
+            rank of the 'lowrank' gains
+        gain_labels: int array with node_size or None
+            group of every node for the 'block' gains
         """
         super(RNNJANSEN, self).__init__()
         self.state_size = 6  # 6 states JR model
@@ -899,11 +1162,21 @@ class RNNJANSEN(torch.nn.Module):
         self.node_size = node_size  # num of ROI
         self.output_size = output_size  # num of M/EEG channels
         self.sc = sc  # matrix node_size x node_size structure connectivity
-        self.dist = torch.tensor(dist, dtype=torch.float32)
+        self.dist = as_shared_tensor(dist)
         self.lm = lm
         self.use_fit_gains = use_fit_gains  # flag for fitting gains
         self.use_fit_lfm = use_fit_lfm
         self.param = param
+        if gain_mode not in ['dense', 'lowrank', 'block', 'sparse']:
+            raise ValueError("Invalid gain_mode. Choose 'dense', 'lowrank', 'block' or 'sparse'.")
+        if gain_mode == 'block' and gain_labels is None:
+            raise ValueError("gain_mode 'block' needs gain_labels.")
+        self.gain_mode = gain_mode
+        self.gain_rank = gain_rank
+        if gain_labels is not None:
+            self.gain_labels = torch.tensor(np.asarray(gain_labels), dtype=torch.int64)
+        if gain_mode == 'sparse':
+            self.gain_rows, self.gain_cols = [torch.tensor(idx, dtype=torch.int64) for idx in np.nonzero(sc)]
 
         self.output_size = lm.shape[0]  # number of M/EEG channels
 
@@ -914,9 +1187,235 @@ class RNNJANSEN(torch.nn.Module):
     def forward(self, external, hx, hE):
         return integration_forward(self, external, hx, hE)
 
+    def effective_gains(self):
+        """
+        Full node_size x node_size connection gains w_bb, w_ff and w_ll as numpy arrays.
+        """
+        return {name: gain_matrix(self, name).detach().numpy().copy() for name in GAIN_NAMES}
+
+
+JOINT_SHARED = ('w_bb', 'w_ff', 'w_ll', 'lm')  # parameters shared by the conditions of a joint fit
+
+
+class RNNJANSENBatch(torch.nn.Module):
+    """
+    num_models JansenRit models simulated as one batch: starts of one subject (multi-start fitting),
+    conditions of one subject (joint fitting) or subjects of a cohort (hierarchical fitting)
+    Attributes
+    ----------
+    num_models: int
+        the number of models (starts) in the batch
+    params: list of ParamsModel
+        priors of each model (the same ParamsModel repeated for a multi-start fit)
+    sc, dist, lm: tensors with 1 or num_models x ...
+        structural connectivity, distances and leadfield (shared when the leading dimension is 1)
+    member_vars: set of str
+        names of the non-parameter tensors with a leading num_models dimension
+    shared: set of str
+        names of the fitted parameters shared by all models (leading dimension 1), e.g. the connection
+        gains and the leadfield when the models are the conditions of one subject
+    group_prior: bool
+        learnable group-level prior means and precisions (var_m, var_v_inv with leading dimension 1)
+    age: tensor with num_models x 1 x 1 or None
+        standardised age of the models (subjects); the group prior mean is var_m + var_m_age * age
+    Other attributes as in RNNJANSEN, with a leading num_models dimension on every fitted parameter
+    Methods
+    -------
+    forward(external, hx, hE)
+        integration_forward_batch for all models at once
+    member(index)
+        RNNJANSEN holding the current parameters of one model
+    select(keep)
+        keep only the models with the given indices
+    prior_mean(var)
+        prior mean of var for every model
+    """
+    state_names = ['E', 'Ev', 'I', 'Iv', 'P', 'Pv']
+    model_name = "JR"
+
+    def __init__(self, num_models: int, node_size: int,
+                 TRs_per_window: int, step_size: float, output_size: int, tr: float, sc, lm, dist,
+                 use_fit_gains: bool, use_fit_lfm: bool, param, shared=(), group_prior=False, age=None) -> None:
+        """
+        Parameters
+        ----------
+        num_models: int
+            the number of models (starts) in the batch
+        sc, lm, dist: arrays with node_size x node_size, output_size x node_size, node_size x node_size
+            shared by all models, or with a leading num_models dimension
+        param: ParamsModel or list of num_models ParamsModel
+        shared: sequence of str
+            fitted parameters with one value for all models (w_bb, w_ff, w_ll, lm or any ParamsModel name)
+        group_prior: bool
+            fit group-level prior means and precisions of the scalar parameters (hierarchical fitting)
+        age: array with num_models or None
+            ages of the subjects for an age-dependent group prior mean
+        Others as in RNNJANSEN
+        """
+        super(RNNJANSENBatch, self).__init__()
+        self.num_models = num_models
+        self.state_size = 6  # 6 states JR model
+        self.tr = tr  # tr ms (integration step 0.1 ms)
+        self.step_size = torch.tensor(step_size, dtype=torch.float32)  # integration step 0.1 ms
+        self.steps_per_TR = int(tr / step_size)
+        self.TRs_per_window = TRs_per_window  # size of the batch used at each step
+        self.node_size = node_size  # num of ROI
+        self.sc = self.as_members(sc, 2)
+        self.dist = self.as_members(dist, 2)
+        self.lm = self.as_members(lm, 2)
+        self.use_fit_gains = use_fit_gains  # flag for fitting gains
+        self.use_fit_lfm = use_fit_lfm
+        self.params = list(param) if isinstance(param, (list, tuple)) else [param] * num_models
+        self.param = self.params[0]
+        self.member_vars = set()
+        self.shared = set(shared)
+        self.group_prior = group_prior
+        self.age = None
+        if age is not None:
+            age = np.asarray(age, dtype=np.float64)
+            age_std = age.std() if age.std() > 0 else 1.
+            self.age = torch.tensor(((age - age.mean()) / age_std).reshape(-1, 1, 1), dtype=torch.float32)
+            self.member_vars.add('age')
+
+        self.output_size = self.lm.shape[1]  # number of M/EEG channels
+
+    @staticmethod
+    def as_members(value, ndim):
+        value = torch.tensor(np.asarray(value), dtype=torch.float32)
+        return value.unsqueeze(0) if value.dim() == ndim else value
+
+    def setModelParameters(self):
+        return setModelParametersBatch(self)
+
+    def forward(self, external, hx, hE):
+        return integration_forward_batch(self, external, hx, hE)
+
+    def prior_mean(self, var):
+        mean = getattr(self, var + '_m')
+        if hasattr(self, var + '_m_age'):
+            mean = mean + getattr(self, var + '_m_age') * self.age
+        return mean
+
+    def member(self, index):
+        """
+        Single RNNJANSEN with the current parameters (and prior hyper parameters) of model index.
+        """
+        def pick(value):
+            return value[index if value.shape[0] > 1 else 0]
+
+        model = RNNJANSEN(self.node_size, self.TRs_per_window, float(self.step_size), self.output_size, self.tr,
+                          pick(self.sc).numpy(), pick(self.lm).detach().numpy(), pick(self.dist).numpy(),
+                          self.use_fit_gains, self.use_fit_lfm, self.params[index])
+        rng_state = np.random.get_state()
+        with contextlib.redirect_stdout(io.StringIO()):
+            model.setModelParameters()
+        np.random.set_state(rng_state)
+        with torch.no_grad():
+            for key, value in model.named_parameters():
+                source = getattr(self, key)
+                if key.endswith('_m') and hasattr(self, key + '_age'):
+                    source = self.prior_mean(key[:-2])
+                value.copy_(pick(source).reshape(value.shape))
+        return model
+
+    def select(self, keep):
+        """
+        Keep the models with indices keep (in that order); parameters are replaced by new Parameters
+        (shared parameters are kept as they are).
+        """
+        keep = torch.as_tensor(np.asarray(keep), dtype=torch.int64)
+        for key, value in list(self.named_parameters()):
+            if value.shape[0] == self.num_models:
+                setattr(self, key, Parameter(value.detach()[keep].clone()))
+        for key in ['sc', 'dist', 'lm'] + sorted(self.member_vars):
+            value = getattr(self, key)
+            if not isinstance(value, Parameter) and value.shape[0] > 1:
+                setattr(self, key, value[keep])
+        self.params = [self.params[i] for i in keep.tolist()]
+        self.num_models = len(self.params)
+
+
+class PriorPack:
+    """
+    Packed form of the prior-penalised model parameters
+    Attributes
+    ----------
+    names: list of str
+        names of the penalised parameters (the prior mean and precision are name_m and name_v_inv)
+    idx_p, idx_m, idx_v: int64 tensors
+        indices into the flattened parameters, means and precisions, broadcast to a common shape
+        for each parameter so the quadratic term matches the per-parameter broadcasting
+    model_id: int
+        id of the model the pack was resolved for
+    """
+    lb = 0.001  # lower bound of the prior precision
+
+    def __init__(self, model):
+        exclude_param = ['std_in']
+        if model.model_name == 'RWW' and model.use_Bifurcation:
+            exclude_param += ['g_EI', 'g_IE']
+        if model.use_fit_gains:
+            exclude_param.append('gains_con')
+        if model.model_name == "JR" and model.use_fit_lfm:
+            exclude_param.append('lm')
+
+        variables_p = [a for a in dir(model.param) if not a.startswith('__') and not callable(getattr(model.param, a))]
+        self.names = [var for var in variables_p
+                      if np.any(getattr(model.param, var)[1] > 0) and var not in exclude_param]
+        self.model_id = id(model)
+
+        idx_p, idx_m, idx_v = [], [], []
+        n_p = n_m = n_v = 0
+        for var in self.names:
+            p, mean, v_inv = getattr(model, var), getattr(model, var + '_m'), getattr(model, var + '_v_inv')
+            shape = torch.broadcast_shapes(p.shape, mean.shape, v_inv.shape)
+            for idx, t, n in zip([idx_p, idx_m, idx_v], [p, mean, v_inv], [n_p, n_m, n_v]):
+                idx.append(torch.broadcast_to(torch.arange(n, n + t.numel()).reshape(t.shape), shape).reshape(-1))
+            n_p, n_m, n_v = n_p + p.numel(), n_m + mean.numel(), n_v + v_inv.numel()
+        self.idx_p = torch.cat(idx_p) if idx_p else torch.zeros(0, dtype=torch.int64)
+        self.idx_m = torch.cat(idx_m) if idx_m else torch.zeros(0, dtype=torch.int64)
+        self.idx_v = torch.cat(idx_v) if idx_v else torch.zeros(0, dtype=torch.int64)
+
+    def pack(self, model):
+        """
+        Flatten the current parameters, prior means and prior precisions into three tensors
+        (gradients flow back to every Parameter, including the learnable prior hyper parameters).
+        """
+        if not self.names:
+            return torch.zeros(0), torch.zeros(0), torch.zeros(0)
+        p = torch.cat([getattr(model, var).reshape(-1) for var in self.names])
+        mean = torch.cat([getattr(model, var + '_m').reshape(-1) for var in self.names])
+        v_inv = torch.cat([getattr(model, var + '_v_inv').reshape(-1) for var in self.names])
+        return p, mean, v_inv
+
+    def loss(self, model):
+        m = torch.nn.ReLU()
+        p, mean, v_inv = self.pack(model)
+        prec = self.lb + m(v_inv)
+        return torch.sum(prec[self.idx_v] * (m(p)[self.idx_p] - m(mean)[self.idx_m]) ** 2) \
+            + torch.sum(-torch.log(prec))
+
+    def member_loss(self, model):
+        """
+        Prior loss of every model of a RNNJANSENBatch (parameters with a leading num_models dimension).
+        The prior of a shared parameter is split evenly over the models, so it enters the summed loss once;
+        the prior means come from prior_mean (group-level and age-dependent for a hierarchical fit).
+        """
+        m = torch.nn.ReLU()
+        loss = torch.zeros(model.num_models)
+        for var in self.names:
+            p, mean, v_inv = getattr(model, var), model.prior_mean(var), getattr(model, var + '_v_inv')
+            prec = self.lb + m(v_inv)
+            scale = 1 / model.num_models if p.shape[0] == 1 else 1
+            loss = loss + scale * (torch.sum((prec * (m(p) - m(mean)) ** 2).flatten(1), 1)
+                                   + torch.sum(-torch.log(prec).flatten(1), 1))
+        return loss
+
+
 class Costs:
     def __init__(self, method):
         self.method = method
+        self.prior = None  # PriorPack resolved on the first call of cost_prior
 
     def cost_dist(self, sim, emp):
         """
@@ -988,22 +1487,53 @@ class Costs:
         losses_corr = -torch.log(0.5000 + 0.5 * corr_FC)  # torch.mean((FC_v -FC_sim_v)**2)#
         return losses_corr
 
+    def cost_prior(self, model: torch.nn.Module):
+        """
+        Gaussian prior penalty on the model parameters with non-zero prior std.
+        The penalised parameters are resolved once per model into a PriorPack,
+        so the training loop only gathers the tensors and evaluates one expression.
+        Parameters
+        ----------
+        model: instance of class RNNJANSEN (or the RWW/LIN counterparts)
+            model with the parameters and their prior mean (_m) and precision (_v_inv)
+        """
+        return self.prior_pack(model).loss(model)
+
+    def prior_pack(self, model):
+        prior = getattr(self, 'prior', None)
+        if prior is None or prior.model_id != id(model):
+            prior = PriorPack(model)
+            self.prior = prior
+        return prior
+
+    def cost_eff_batch(self, sim, emp, model):
+        """
+        Loss of every model of a RNNJANSENBatch (the JR loss of cost_eff per model)
+        Parameters
+        ----------
+        sim: tensor with num_models x output_size x datapoint
+            simulated EEG
+        emp: tensor with output_size x datapoint or num_models x output_size x datapoint
+            empirical EEG
+        Returns
+        -------
+        tensor with num_models losses
+        """
+        w_cost = 10
+        emp = emp.expand_as(sim)
+        if self.method == 0:
+            loss_main = torch.sqrt(torch.mean((sim - emp) ** 2, dim=(1, 2)))
+        else:
+            loss_main = torch.stack([self.cost_r(sim[i], emp[i]) for i in range(sim.shape[0])])
+        return w_cost * loss_main + self.prior_pack(model).member_loss(model)
+
     def cost_eff(self, sim, emp, model: torch.nn.Module, next_window):
         # define some constants
-        lb = 0.001
-
         w_cost = 10
 
         # define the relu function
         m = torch.nn.ReLU()
 
-        exclude_param = []
-        if model.use_fit_gains:
-            exclude_param.append('gains_con')
-
-        if model.model_name == "JR" and model.use_fit_lfm:
-            exclude_param.append('lm')
-
         if self.method == 0:
             loss_main = self.cost_dist(sim, emp)
         else:
@@ -1054,59 +1584,369 @@ class Costs:
                                + 0.5 * I_window * torch.log(I_window) + 0.5 * (1 - I_window) * torch.log(
                         1 - I_window), dim=1))
 
-            loss_prior = []
-
-            variables_p = [a for a in dir(model.param) if
-                           not a.startswith('__') and not callable(getattr(model.param, a))]
-            # get penalty on each model parameters due to prior distribution
-            for var in variables_p:
-                # print(var)
-                if model.use_Bifurcation:
-                    if np.any(getattr(model.param, var)[1] > 0) and var not in ['std_in', 'g_EI', 'g_IE'] and \
-                            var not in exclude_param:
-                        # print(var)
-                        dict_np = {'m': var + '_m', 'v': var + '_v_inv'}
-                        loss_prior.append(torch.sum((lb + m(model.get_parameter(dict_np['v']))) * \
-                                                    (m(model.get_parameter(var)) - m(
-                                                        model.get_parameter(dict_np['m']))) ** 2) \
-                                          + torch.sum(-torch.log(lb + m(model.get_parameter(dict_np['v'])))))
-                else:
-                    if np.any(getattr(model.param, var)[1] > 0) and var not in ['std_in'] and \
-                            var not in exclude_param:
-                        # print(var)
-                        dict_np = {'m': var + '_m', 'v': var + '_v_inv'}
-                        loss_prior.append(torch.sum((lb + m(model.get_parameter(dict_np['v']))) * \
-                                                    (m(model.get_parameter(var)) - m(
-                                                        model.get_parameter(dict_np['m']))) ** 2) \
-                                          + torch.sum(-torch.log(lb + m(model.get_parameter(dict_np['v'])))))
-        else:
-            lose_EI = 0
-            loss_prior = []
+        # get penalty on each model parameters due to prior distribution
+        loss_prior = self.cost_prior(model)
 
-            variables_p = [a for a in dir(model.param) if
-                           not a.startswith('__') and not callable(getattr(model.param, a))]
-
-            for var in variables_p:
-                if np.any(getattr(model.param, var)[1] > 0) and var not in ['std_in'] and \
-                        var not in exclude_param:
-                    # print(var)
-                    dict_np = {'m': var + '_m', 'v': var + '_v_inv'}
-                    loss_prior.append(torch.sum((lb + m(model.get_parameter(dict_np['v']))) * \
-                                                (m(model.get_parameter(var)) - m(
-                                                    model.get_parameter(dict_np['m']))) ** 2) \
-                                      + torch.sum(-torch.log(lb + m(model.get_parameter(dict_np['v'])))))
         # total loss
         loss = 0
         if model.model_name == 'RWW':
-            loss = 0.1 * w_cost * loss_main + 1 * sum(
-                loss_prior) + 1 * loss_EI
+            loss = 0.1 * w_cost * loss_main + 1 * loss_prior + 1 * loss_EI
         elif model.model_name == 'JR':
-            loss = w_cost * loss_main + sum(loss_prior) + 1 * loss_EI
+            loss = w_cost * loss_main + loss_prior + 1 * loss_EI
         elif model.model_name == 'LIN':
-            loss = 0.1 * w_cost * loss_main + sum(loss_prior) + 1 * loss_EI
+            loss = 0.1 * w_cost * loss_main + loss_prior + 1 * loss_EI
         return loss
 
 
+def peak_rss_mb():
+    """
+    Peak resident set size of this process in MB (nan where the resource module is unavailable).
+    """
+    try:
+        import resource
+    except ImportError:
+        return float('nan')
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return rss / 1024 ** 2 if sys.platform == 'darwin' else rss / 1024
+
+
+class FitProfiler:
+    """
+    Opt-in instrumentation for Model_fitting.train and Model_fitting.test
+    Attributes
+    ----------
+    label: str
+        run label written to the report (e.g. subject_run)
+    trace_dir: str or None
+        if given, a torch.profiler chrome trace of the first trace_windows windows of each run is saved there
+    trace_windows: int
+        number of windows recorded by torch.profiler after one wait and one warmup window
+    enabled: bool
+        a disabled profiler is a no-op (used by train/test when no profiler is passed)
+    runs: dict
+        per mode ('train', 'test') record of phase timings, per-epoch wall time and peak memory
+    Methods
+    -------
+    start(mode, model), stop()
+        bracket a whole train/test call
+    phase(name)
+        context manager timing one phase (forward, cost, backward, optimizer_step, history, evaluation)
+    save(filename)
+        write the JSON report
+    """
+
+    def __init__(self, label='', trace_dir=None, trace_windows=5, enabled=True):
+        self.label = label
+        self.trace_dir = trace_dir
+        self.trace_windows = trace_windows
+        self.enabled = enabled
+        self.runs = {}
+        self._record = None
+        self._torch_prof = None
+        self._mode = None
+        self._run_start = 0.
+        self._epoch_start = 0.
+
+    def start(self, mode, model):
+        """
+        Start recording a train/test run of model.
+        """
+        if not self.enabled:
+            return
+        record = {'node_size': model.node_size, 'output_size': model.output_size,
+                  'TRs_per_window': model.TRs_per_window, 'steps_per_TR': model.steps_per_TR,
+                  'phases': {}, 'epochs': []}
+        # repeated runs of the same mode (e.g. a second test on longer data) get numbered keys
+        n_runs = sum(1 for key in self.runs if key == mode or key.startswith(mode + '_'))
+        if n_runs:
+            mode = mode + '_' + str(n_runs + 1)
+        self.runs[mode] = record
+        self._record = record
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        if self.trace_dir is not None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self._torch_prof = torch.profiler.profile(
+                activities=activities, profile_memory=True,
+                schedule=torch.profiler.schedule(wait=1, warmup=1, active=self.trace_windows, repeat=1))
+            self._torch_prof.start()
+        self._mode = mode
+        self._run_start = time.perf_counter()
+        self._epoch_start = self._run_start
+
+    def stop(self):
+        """
+        Finish the current run: total wall time, peak memory and the torch.profiler trace.
+        """
+        record = self._record
+        if record is None:
+            return
+        record['wall_s'] = time.perf_counter() - self._run_start
+        record['peak_rss_mb'] = peak_rss_mb()
+        if torch.cuda.is_available():
+            record['peak_cuda_mb'] = torch.cuda.max_memory_allocated() / 1024 ** 2
+        if self._torch_prof is not None:
+            self._torch_prof.stop()
+            os.makedirs(self.trace_dir, exist_ok=True)
+            trace_file = os.path.join(self.trace_dir,
+                                      (self.label + '_' if self.label else '') + self._mode + '_trace.json')
+            self._torch_prof.export_chrome_trace(trace_file)
+            record['trace'] = trace_file
+            self._torch_prof = None
+        self._record = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if self._record is None:
+            yield
+            return
+        t0 = time.perf_counter()
+        if self._torch_prof is not None:
+            with torch.profiler.record_function(name):
+                yield
+        else:
+            yield
+        dt = time.perf_counter() - t0
+        stat = self._record['phases'].setdefault(name, {'total_s': 0., 'count': 0, 'max_s': 0.})
+        stat['total_s'] += dt
+        stat['count'] += 1
+        stat['max_s'] = max(stat['max_s'], dt)
+
+    def step(self):
+        """
+        Mark the end of a window (advances the torch.profiler schedule).
+        """
+        if self._torch_prof is not None:
+            self._torch_prof.step()
+
+    def epoch(self, i_epoch, **metrics):
+        """
+        Record wall time and peak memory of one epoch with optional metrics (loss, fc_corr, ...).
+        """
+        if self._record is None:
+            return
+        now = time.perf_counter()
+        entry = {'epoch': i_epoch, 'wall_s': now - self._epoch_start, 'peak_rss_mb': peak_rss_mb()}
+        entry.update({key: float(value) for key, value in metrics.items() if value is not None})
+        self._record['epochs'].append(entry)
+        self._epoch_start = now
+
+    def report(self):
+        runs = {}
+        for mode, record in self.runs.items():
+            record = dict(record)
+            record['phases'] = {name: dict(stat, mean_s=stat['total_s'] / max(stat['count'], 1))
+                                for name, stat in record['phases'].items()}
+            runs[mode] = record
+        return {'label': self.label, 'torch_version': torch.__version__, 'num_threads': torch.get_num_threads(),
+                'runs': runs}
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+
+def fit_metrics(ts_sim, ts_emp, mask_e, transient_num=10, fc=None):
+    """
+    Correlation between the simulated and empirical sensor FC (lower triangles) and the mean
+    cosine similarity between matching simulated and empirical channels.
+    Parameters
+    ----------
+    ts_sim, ts_emp: array with output_size x datapoint
+        simulated and empirical M/EEG
+    mask_e: tuple of index arrays
+        lower triangle indices of the FC matrices
+    transient_num: int
+        initial simulated samples left out of the simulated FC
+    fc: array or None
+        precomputed empirical FC (reused across epochs on the same data)
+    """
+    if fc is None:
+        fc = np.corrcoef(ts_emp)
+    fc_sim = np.corrcoef(ts_sim[:, transient_num:])
+    fc_cor = np.corrcoef(fc_sim[mask_e], fc[mask_e])[0, 1]
+    # row-wise cosine (the diagonal of the full channel x channel cosine similarity matrix)
+    norm = np.linalg.norm(ts_sim, axis=1) * np.linalg.norm(ts_emp, axis=1)
+    norm[norm == 0] = 1
+    cos_sim = (np.sum(ts_sim * ts_emp, axis=1) / norm).mean()
+    return fc_cor, cos_sim
+
+
+class StopPolicy:
+    """
+    Stopping rule and learning-rate schedule of Model_fitting.train
+    Attributes
+    ----------
+    epoch_min, r_lb: int, float or None
+        FC stop rule: stop once i_epoch > epoch_min and the sensor FC correlation > r_lb
+        (None: the defaults of train for the model, 200 and 0.95 for JR)
+    patience: int or None
+        stop when the epoch loss has not improved by more than min_delta (relative) for patience epochs
+    min_delta: float
+        relative improvement of the epoch loss counted as progress
+    plateau_min_epochs: int
+        the plateau rule is only checked from this epoch on
+    max_wall_s: float or None
+        time budget of the whole train call in seconds
+    scheduler: None, 'plateau' or 'cosine'
+        ReduceLROnPlateau on the epoch loss or CosineAnnealingLR over num_epoches
+    lr_factor, lr_patience, lr_min: float, int, float
+        parameters of the learning-rate schedulers
+    eval_every: int
+        compute the FC/cosine evaluation every eval_every epochs (and every epoch once the FC rule can fire)
+    history: list of dict
+        epoch, loss, lr and fc_cor of every epoch
+    reason: str or None
+        why training stopped
+    """
+
+    def __init__(self, epoch_min=None, r_lb=None, patience=None, min_delta=1e-3, plateau_min_epochs=20,
+                 max_wall_s=None, scheduler=None, lr_factor=0.5, lr_patience=5, lr_min=1e-4, eval_every=1):
+        self.epoch_min = epoch_min
+        self.r_lb = r_lb
+        self.patience = patience
+        self.min_delta = min_delta
+        self.plateau_min_epochs = plateau_min_epochs
+        self.max_wall_s = max_wall_s
+        self.scheduler = scheduler
+        self.lr_factor = lr_factor
+        self.lr_patience = lr_patience
+        self.lr_min = lr_min
+        self.eval_every = eval_every
+        self.history = []
+        self.reason = None
+
+    def start(self, optimizer, num_epoches, epoch_min, r_lb):
+        """
+        Bind the optimizer and fill in the default FC rule of the model.
+        """
+        self.epoch_min = epoch_min if self.epoch_min is None else self.epoch_min
+        self.r_lb = r_lb if self.r_lb is None else self.r_lb
+        self.optimizer = optimizer
+        self.lr_scheduler = None
+        if self.scheduler == 'plateau':
+            self.lr_scheduler = optim.lr_scheduler.ReduceLROnPlateau(
+                optimizer, factor=self.lr_factor, patience=self.lr_patience, min_lr=self.lr_min)
+        elif self.scheduler == 'cosine':
+            self.lr_scheduler = optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=num_epoches, eta_min=self.lr_min)
+        elif self.scheduler is not None:
+            raise ValueError("Invalid scheduler. Choose None, 'plateau' or 'cosine'.")
+        self.best_loss = np.inf
+        self.best_epoch = 0
+        self.history = []
+        self.reason = None
+        self.t_start = time.perf_counter()
+
+    def needs_eval(self, i_epoch):
+        return i_epoch % self.eval_every == 0 or i_epoch > self.epoch_min
+
+    def update(self, i_epoch, loss, fc_cor=None):
+        """
+        Record one epoch, step the learning-rate schedule and return True if training should stop.
+        """
+        self.history.append({'epoch': i_epoch, 'loss': float(loss), 'fc_cor': None if fc_cor is None else float(fc_cor),
+                             'lr': self.optimizer.param_groups[0]['lr']})
+        if self.lr_scheduler is not None:
+            if self.scheduler == 'plateau':
+                self.lr_scheduler.step(loss)
+            else:
+                self.lr_scheduler.step()
+
+        if not self.history[:-1] or loss < self.best_loss - self.min_delta * abs(self.best_loss):
+            self.best_loss = loss
+            self.best_epoch = i_epoch
+
+        if fc_cor is not None and i_epoch > self.epoch_min and fc_cor > self.r_lb:
+            self.reason = 'fc_cor %.3f > %.3f after epoch %d' % (fc_cor, self.r_lb, self.epoch_min)
+        elif self.patience is not None and i_epoch >= self.plateau_min_epochs \
+                and i_epoch - self.best_epoch >= self.patience:
+            self.reason = 'loss plateau since epoch %d' % self.best_epoch
+        elif self.max_wall_s is not None and time.perf_counter() - self.t_start > self.max_wall_s:
+            self.reason = 'wall time budget of %.0f s' % self.max_wall_s
+        return self.reason is not None
+
+    def state_dict(self):
+        return {'best_loss': self.best_loss, 'best_epoch': self.best_epoch, 'history': list(self.history),
+                'elapsed_s': time.perf_counter() - self.t_start,
+                'lr_scheduler': None if self.lr_scheduler is None else copy.deepcopy(self.lr_scheduler.state_dict())}
+
+    def load_state_dict(self, state):
+        self.best_loss = state['best_loss']
+        self.best_epoch = state['best_epoch']
+        self.history = list(state['history'])
+        # the time budget counts the training time before the interruption
+        self.t_start = time.perf_counter() - state['elapsed_s']
+        if self.lr_scheduler is not None and state['lr_scheduler'] is not None:
+            self.lr_scheduler.load_state_dict(state['lr_scheduler'])
+
+
+class CheckpointWriter:
+    """
+    Writes the training checkpoints of Model_fitting.train from a background thread
+    Attributes
+    ----------
+    filename: str
+        checkpoint file, replaced atomically (a preempted write leaves the previous checkpoint intact)
+    Methods
+    -------
+    submit(state)
+        queue a snapshot for writing; waits only while the previous snapshot is still being written
+    close()
+        finish the pending write and stop the thread (re-raises a failed write)
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.error = None
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            state = self.queue.get()
+            if state is None:
+                return
+            try:
+                tmp = self.filename + '.tmp'
+                torch.save(state, tmp)
+                os.replace(tmp, self.filename)
+            except Exception as e:
+                self.error = e
+
+    def submit(self, state):
+        self.queue.put(state)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def array_digest(arrays):
+    """
+    Hex digest of a dict of arrays (names, shapes, dtypes and values).
+    """
+    import hashlib
+    h = hashlib.blake2b(digest_size=16)
+    for key in sorted(arrays):
+        value = np.ascontiguousarray(arrays[key])
+        h.update(('%s%s%s' % (key, value.shape, value.dtype)).encode())
+        h.update(value.tobytes())
+    return h.hexdigest()
+
+
+def load_checkpoint(filename):
+    """
+    Training checkpoint written by Model_fitting.train(checkpoint=...).
+    """
+    return torch.load(filename, weights_only=False)
+
+
 class Model_fitting:
     """
     Using ADAM and AutoGrad to fit JansenRit to empirical EEG
@@ -1122,7 +1962,6 @@ class Model_fitting:
     """
     u = 0  # external input
 
-    # from sklearn.metrics.pairwise import cosine_similarity
     def __init__(self, model, ts, num_epoches, cost):
         """
         Parameters
@@ -1147,19 +1986,77 @@ class Model_fitting:
         self.ts = ts
 
         self.cost = Costs(cost)
+        self.warm_epoch_frac = None  # fraction of the minimum epochs kept after warm_start
+
+    def warm_start(self, params, include_prior=False, jitter=0., epoch_frac=0.1, include_subject=False):
+        """
+        Initialise the model parameters from a previous fit instead of the prior means plus random jitter.
+        Parameters
+        ----------
+        params: dict or str
+            parameter name -> array (see load_params), or a file accepted by load_params
+            (fitted checkpoint *_fittingresults_stim_exp.pkl or .npz from save_params)
+        include_prior: bool
+            also copy the learned prior hyper parameters (*_m, *_v_inv)
+        jitter: float
+            relative std of Gaussian noise added to the copied values
+        epoch_frac: float
+            the minimum number of epochs before the stop criterion can fire is scaled by this fraction
+        include_subject: bool
+            also copy the parameters seeded from the subject's own inputs (SUBJECT_PARAMS: the leadfield),
+            e.g. when warm-starting from a fit of the same subject
+        Returns
+        -------
+        list of the names of the copied parameters
+        """
+        # settings of the warm start, part of the checkpoint_config of a later train
+        self.warm_source = {'params': params if isinstance(params, str) else array_digest(params),
+                            'include_prior': include_prior, 'jitter': jitter, 'epoch_frac': epoch_frac,
+                            'include_subject': include_subject}
+        if isinstance(params, str):
+            params = load_params(params)
+        copied = warm_start_model(self.model, params, include_prior, jitter, include_subject)
+        self.warm_epoch_frac = epoch_frac
+        return copied
+
+    def checkpoint_config(self, learningrate):
+        """
+        Settings a training checkpoint belongs to: only a checkpoint with the same config is resumed.
+        """
+        return {'num_epoches': self.num_epoches, 'ts_shape': tuple(np.shape(self.ts)),
+                'ts': array_digest({'ts': np.asarray(self.ts)[0]}), 'learningrate': learningrate,
+                'node_size': self.model.node_size, 'warm': getattr(self, 'warm_source', None)}
 
     def save(self, filename):
         with open(filename, 'wb') as f:
             pickle.dump(self, f)
 
-    def train(self, learningrate=0.05, u=0):
+    def train(self, learningrate=0.05, u=0, profiler=None, policy=None, checkpoint=None, checkpoint_every=10,
+              resume=True):
         """
         Parameters
         ----------
         learningrate : for machine learing speed
         u: stimulus
+        profiler: FitProfiler or None
+            optional per-phase timing of the training run
+        policy: StopPolicy or None
+            stopping rule and learning-rate schedule (default: the FC rule with the model's epoch_min and r_lb)
+        checkpoint: str or None
+            file for a checkpoint (parameters, Adam state, X/hE, RNG states, histories) written in the
+            background every checkpoint_every epochs
+        checkpoint_every: int
+            epochs between checkpoints
+        resume: bool
+            continue from the checkpoint if the file exists and was written with the same settings
+            (checkpoint_config: epochs, data, learning rate, warm start); bit-exact with the uninterrupted run
 
         """
+        if profiler is None:
+            profiler = FitProfiler(enabled=False)
+        if policy is None:
+            policy = StopPolicy()
+        profiler.start('train', self.model)
 
         delays_max = 500
         state_ub = 0.01
@@ -1180,10 +2077,15 @@ class Model_fitting:
             epoch_min = 200  # run minimum epoch # part of stop criteria
             r_lb = 0.95
 
+        # a warm-started fit begins near a solution, so the stop criterion may fire much earlier
+        if getattr(self, 'warm_epoch_frac', None) is not None:
+            epoch_min = int(epoch_min * self.warm_epoch_frac)
+
         self.u = u
 
         # define an optimizer(ADAM)
         optimizer = optim.Adam(self.model.parameters(), lr=learningrate, eps=1e-7)
+        policy.start(optimizer, self.num_epoches, epoch_min, r_lb)
 
         # initial state
         X = 0
@@ -1224,126 +2126,185 @@ class Model_fitting:
                 fit_param[key] = [value.detach().numpy().ravel().copy()]
 
         loss_his = []  # loss placeholder
+        ts_emp_last = None  # empirical FC is recomputed only when the epoch data change
+        fc = None
 
         # define constant 1 tensor
 
         # define num_windows
         num_windows = self.ts.shape[1]
-        for i_epoch in range(self.num_epoches):
-
-            # Create placeholders for the simulated states and outputs of entire time series.
-            for name in self.model.state_names + [self.output_sim.output_name]:
-                setattr(self.output_sim, name + '_train', [])
 
-            # initial the external inputs
-            external = torch.tensor(
-                np.zeros([self.model.node_size, self.model.steps_per_TR, self.model.TRs_per_window]),
-                dtype=torch.float32)
-
-            # Perform the training in windows.
-
-            for TR_i in range(num_windows):
-
-                # Reset the gradient to zeros after update model parameters.
-                optimizer.zero_grad()
-
-                # if the external not empty
-                if not isinstance(self.u, int):
-                    external = torch.tensor(
-                        (self.u[:, :, TR_i * self.model.TRs_per_window:(TR_i + 1) * self.model.TRs_per_window]),
-                        dtype=torch.float32)
-
-                # Use the model.forward() function to update next state and get simulated EEG in this batch.
-
-                next_window, hE_new = self.model(external, X, hE)
+        start_epoch = 0
+        config = self.checkpoint_config(learningrate)
+        state = None
+        if checkpoint is not None and resume and os.path.exists(checkpoint):
+            state = load_checkpoint(checkpoint)
+            if state.get('config') != config:
+                print('checkpoint', checkpoint, 'was written with other settings, starting a new fit')
+                state = None
+        if state is not None:
+            self.model.load_state_dict(state['model'])
+            optimizer.load_state_dict(state['optimizer'])
+            policy.load_state_dict(state['policy'])
+            X, hE = state['X'], state['hE']
+            loss_his, fit_param, fit_sc, fit_lm = state['loss_his'], state['fit_param'], state['fit_sc'], state['fit_lm']
+            np.random.set_state(state['np_rng'])
+            torch.set_rng_state(state['torch_rng'])
+            self.output_sim.loss = np.array(loss_his)
+            start_epoch = state['epoch'] + 1
+            print('resume after epoch', state['epoch'], 'from', checkpoint)
+        writer = CheckpointWriter(checkpoint) if checkpoint is not None else None
 
-                # Get the batch of empirical EEG signal.
-                ts_window = torch.tensor(self.ts[i_epoch, TR_i, :, :], dtype=torch.float32)
-
-                # total loss calculation
-                sim = 0
-                if self.model.model_name == 'RWW':
-                    sim = next_window['bold_window']
-                elif self.model.model_name == 'JR':
-                    sim = next_window['eeg_window']
-                elif self.model.model_name == 'LIN':
-                    sim = next_window['bold_window']
-                if TR_i in [5,6]:
-                    loss = 5*self.cost.cost_eff(sim, ts_window, self.model, next_window)
-                else:
-                    loss = self.cost.cost_eff(sim, ts_window, self.model, next_window)
+        # close the writer on errors too: finish the pending snapshot and re-raise a failed write
+        try:
+            for i_epoch in range(start_epoch, self.num_epoches):
 
+                # Create placeholders for the simulated states and outputs of entire time series.
+                for name in self.model.state_names + [self.output_sim.output_name]:
+                    setattr(self.output_sim, name + '_train', [])
+
+                # initial the external inputs
+                external = torch.tensor(
+                    np.zeros([self.model.node_size, self.model.steps_per_TR, self.model.TRs_per_window]),
+                    dtype=torch.float32)
+
+                # Perform the training in windows.
+
+                for TR_i in range(num_windows):
+
+                    # Reset the gradient to zeros after update model parameters.
+                    optimizer.zero_grad()
+
+                    # if the external not empty
+                    if not isinstance(self.u, int):
+                        external = torch.tensor(
+                            (self.u[:, :, TR_i * self.model.TRs_per_window:(TR_i + 1) * self.model.TRs_per_window]),
+                            dtype=torch.float32)
+
+                    # Use the model.forward() function to update next state and get simulated EEG in this batch.
+                    with profiler.phase('forward'):
+                        next_window, hE_new = self.model(external, X, hE)
+
+                    # Get the batch of empirical EEG signal.
+                    ts_window = torch.tensor(self.ts[i_epoch, TR_i, :, :], dtype=torch.float32)
+
+                    # total loss calculation
+                    sim = 0
+                    if self.model.model_name == 'RWW':
+                        sim = next_window['bold_window']
+                    elif self.model.model_name == 'JR':
+                        sim = next_window['eeg_window']
+                    elif self.model.model_name == 'LIN':
+                        sim = next_window['bold_window']
+                    with profiler.phase('cost'):
+                        if TR_i in [5,6]:
+                            loss = 5*self.cost.cost_eff(sim, ts_window, self.model, next_window)
+                        else:
+                            loss = self.cost.cost_eff(sim, ts_window, self.model, next_window)
+
+
+                    # Put the batch of the simulated EEG, E I M Ev Iv Mv in to placeholders for entire time-series.
+                    with profiler.phase('window_output'):
+                        for name in self.model.state_names + [self.output_sim.output_name]:
+                            name_next = name + '_window'
+                            tmp_ls = getattr(self.output_sim, name + '_train')
+                            tmp_ls.append(next_window[name_next].detach().numpy())
+
+                            setattr(self.output_sim, name + '_train', tmp_ls)
+
+                        loss_his.append(loss.detach().numpy())
+
+                    # Calculate gradient using backward (backpropagation) method of the loss function.
+                    with profiler.phase('backward'):
+                        loss.backward(retain_graph=True)
+
+                    # Optimize the model based on the gradient method in updating the model parameters.
+                    with profiler.phase('optimizer_step'):
+                        optimizer.step()
+
+                    # Put the updated model parameters into the history placeholders.
+                    # sc_par.append(self.model.sc[mask].copy())
+                    with profiler.phase('param_history'):
+                        for key, value in self.model.state_dict().items():
+                            if key not in exclude_param:
+                                fit_param[key].append(value.detach().numpy().ravel().copy())
+
+                        if self.model.use_fit_gains:
+                            fit_sc.append(self.model.sc_fitted.detach().numpy()[mask].copy())
+                        if self.model.model_name == "JR" and self.model.use_fit_lfm:
+                            fit_lm.append(self.model.lm.detach().numpy().ravel().copy())
+
+                    # last update current state using next state...
+                    # (no direct use X = X_next, since gradient calculation only depends on one batch no history)
+                    X = torch.tensor(next_window['current_state'].detach().numpy(), dtype=torch.float32)
+                    hE = torch.tensor(hE_new.detach().numpy(), dtype=torch.float32)
+                    # print(hE_new.detach().numpy()[20:25,0:20])
+                    # print(hE.shape)
+                    profiler.step()
+
+                print('epoch: ', i_epoch, loss.detach().numpy())
 
-                # Put the batch of the simulated EEG, E I M Ev Iv Mv in to placeholders for entire time-series.
                 for name in self.model.state_names + [self.output_sim.output_name]:
-                    name_next = name + '_window'
                     tmp_ls = getattr(self.output_sim, name + '_train')
-                    tmp_ls.append(next_window[name_next].detach().numpy())
-
-                    setattr(self.output_sim, name + '_train', tmp_ls)
-
-                loss_his.append(loss.detach().numpy())
-
-                # Calculate gradient using backward (backpropagation) method of the loss function.
-                loss.backward(retain_graph=True)
-
-                # Optimize the model based on the gradient method in updating the model parameters.
-                optimizer.step()
-
-                # Put the updated model parameters into the history placeholders.
-                # sc_par.append(self.model.sc[mask].copy())
-                for key, value in self.model.state_dict().items():
-                    if key not in exclude_param:
-                        fit_param[key].append(value.detach().numpy().ravel().copy())
-
-                if self.model.use_fit_gains:
-                    fit_sc.append(self.model.sc_fitted.detach().numpy()[mask].copy())
-                if self.model.model_name == "JR" and self.model.use_fit_lfm:
-                    fit_lm.append(self.model.lm.detach().numpy().ravel().copy())
-
-                # last update current state using next state...
-                # (no direct use X = X_next, since gradient calculation only depends on one batch no history)
-                X = torch.tensor(next_window['current_state'].detach().numpy(), dtype=torch.float32)
-                hE = torch.tensor(hE_new.detach().numpy(), dtype=torch.float32)
-                # print(hE_new.detach().numpy()[20:25,0:20])
-                # print(hE.shape)
-            ts_emp = np.concatenate(list(self.ts[i_epoch]),1)
-            fc = np.corrcoef(ts_emp)
-
-            tmp_ls = getattr(self.output_sim, self.output_sim.output_name + '_train')
-            ts_sim = np.concatenate(tmp_ls, axis=1)
-            fc_sim = np.corrcoef(ts_sim[:, 10:])
-
-            print('epoch: ', i_epoch, loss.detach().numpy())
-
-            print('epoch: ', i_epoch, np.corrcoef(fc_sim[mask_e], fc[mask_e])[0, 1], 'cos_sim: ',
-                  np.diag(cosine_similarity(ts_sim, ts_emp)).mean())
-
-            for name in self.model.state_names + [self.output_sim.output_name]:
-                tmp_ls = getattr(self.output_sim, name + '_train')
-                setattr(self.output_sim, name + '_train', np.concatenate(tmp_ls, axis=1))
-
-            self.output_sim.loss = np.array(loss_his)
-
-            if i_epoch > epoch_min and np.corrcoef(fc_sim[mask_e], fc[mask_e])[0, 1] > r_lb:
-                break
-
+                    setattr(self.output_sim, name + '_train', np.concatenate(tmp_ls, axis=1))
+
+                fc_cor = cos_sim = None
+                if policy.needs_eval(i_epoch):
+                    with profiler.phase('evaluation'):
+                        ts_emp = np.concatenate(list(self.ts[i_epoch]),1)
+                        if ts_emp_last is None or not np.array_equal(ts_emp, ts_emp_last):
+                            fc = np.corrcoef(ts_emp)
+                            ts_emp_last = ts_emp
+                        ts_sim = getattr(self.output_sim, self.output_sim.output_name + '_train')
+                        fc_cor, cos_sim = fit_metrics(ts_sim, ts_emp, mask_e, 10, fc)
+
+                    print('epoch: ', i_epoch, fc_cor, 'cos_sim: ', cos_sim)
+
+                self.output_sim.loss = np.array(loss_his)
+                epoch_loss = np.mean(loss_his[-num_windows:])
+                profiler.epoch(i_epoch, loss=epoch_loss, fc_cor=fc_cor, cos_sim=cos_sim)
+
+                if policy.update(i_epoch, epoch_loss, fc_cor):
+                    print('stop: ', policy.reason)
+                    break
+
+                if writer is not None and (i_epoch + 1) % checkpoint_every == 0:
+                    # snapshot now (the histories only grow, shallow copies suffice), write in the background
+                    writer.submit({'epoch': i_epoch, 'window': num_windows, 'config': config,
+                                   'model': {key: value.detach().clone()
+                                             for key, value in self.model.state_dict().items()},
+                                   'optimizer': copy.deepcopy(optimizer.state_dict()),
+                                   'policy': policy.state_dict(), 'X': X.clone(), 'hE': hE.clone(),
+                                   'loss_his': list(loss_his),
+                                   'fit_param': {key: list(value) for key, value in fit_param.items()},
+                                   'fit_sc': list(fit_sc) if isinstance(fit_sc, list) else fit_sc,
+                                   'fit_lm': list(fit_lm) if isinstance(fit_lm, list) else fit_lm,
+                                   'np_rng': np.random.get_state(), 'torch_rng': torch.get_rng_state()})
+        finally:
+            if writer is not None:
+                writer.close()
         if self.model.use_fit_gains:
             self.output_sim.weights = np.array(fit_sc)
         if self.model.model_name == 'JR' and self.model.use_fit_lfm:
             self.output_sim.leadfield = np.array(fit_lm)
         for key, value in fit_param.items():
             setattr(self.output_sim, key, np.array(value))
+        profiler.stop()
 
-    def test(self, base_window_num, u=0):
+    def test(self, base_window_num, u=0, profiler=None):
         """
         Parameters
         ----------
         base_window_num: int
             length of num_windows for resting
         u : external or stimulus
+        profiler: FitProfiler or None
+            optional per-phase timing of the test run (burn-in windows are timed as 'burn_in')
         -----------
         """
+        if profiler is None:
+            profiler = FitProfiler(enabled=False)
+        profiler.start('test', self.model)
 
         # define some constants
         state_lb = -0.01
@@ -1396,15 +2357,17 @@ class Model_fitting:
                 dtype=torch.float32)
 
             # Use the model.forward() function to update next state and get simulated EEG in this batch.
-            next_window, hE_new = self.model(external, X, hE)
+            with profiler.phase('forward' if TR_i > base_window_num - 1 else 'burn_in'):
+                next_window, hE_new = self.model(external, X, hE)
 
             if TR_i > base_window_num - 1:
-                for name in self.model.state_names + [self.output_sim.output_name]:
-                    name_next = name + '_window'
-                    tmp_ls = getattr(self.output_sim, name + '_test')
-                    tmp_ls.append(next_window[name_next].detach().numpy())
+                with profiler.phase('window_output'):
+                    for name in self.model.state_names + [self.output_sim.output_name]:
+                        name_next = name + '_window'
+                        tmp_ls = getattr(self.output_sim, name + '_test')
+                        tmp_ls.append(next_window[name_next].detach().numpy())
 
-                    setattr(self.output_sim, name + '_test', tmp_ls)
+                        setattr(self.output_sim, name + '_test', tmp_ls)
 
             # last update current state using next state...
             # (no direct use X = X_next, since gradient calculation only depends on one batch no history)
@@ -1412,173 +2375,785 @@ class Model_fitting:
             hE = torch.tensor(hE_new.detach().numpy(), dtype=torch.float32)
             # print(hE_new.detach().numpy()[20:25,0:20])
             # print(hE.shape)
+            profiler.step()
 
-        ts_emp = np.concatenate(list(self.ts[-1]),1)
-        fc = np.corrcoef(ts_emp)
-        tmp_ls = getattr(self.output_sim, self.output_sim.output_name + '_test')
-        ts_sim = np.concatenate(tmp_ls, axis=1)
-
-        fc_sim = np.corrcoef(ts_sim[:, transient_num:])
-        print(np.corrcoef(fc_sim[mask_e], fc[mask_e])[0, 1], 'cos_sim: ',
-                  np.diag(cosine_similarity(ts_sim, ts_emp)).mean())
+        with profiler.phase('evaluation'):
+            ts_emp = np.concatenate(list(self.ts[-1]),1)
+            tmp_ls = getattr(self.output_sim, self.output_sim.output_name + '_test')
+            ts_sim = np.concatenate(tmp_ls, axis=1)
+            fc_cor, cos_sim = fit_metrics(ts_sim, ts_emp, mask_e, transient_num)
+        print(fc_cor, 'cos_sim: ', cos_sim)
         for name in self.model.state_names + [self.output_sim.output_name]:
             tmp_ls = getattr(self.output_sim, name + '_test')
             setattr(self.output_sim, name + '_test', np.concatenate(tmp_ls, axis=1))
+        profiler.epoch(0, fc_cor=fc_cor, cos_sim=cos_sim)
+        profiler.stop()
 
     def test_realtime(self, tr_p, step_size_n, step_size, num_windows):
-        if self.model.model_name == 'RWW':
-            mask = np.tril_indices(self.model.node_size, -1)
-
-            X_np = 0.2 * np.random.uniform(0, 1, (self.model.node_size, self.model.state_size)) + np.array(
-                [0, 0, 0, 1.0, 1.0, 1.0])
-            variables_p = [a for a in dir(self.model.param) if
-                           not a.startswith('__') and not callable(getattr(self.model.param, a))]
-            # get penalty on each model parameters due to prior distribution
-            for var in variables_p:
-                # print(var)
-                if np.any(getattr(self.model.param, var)[1] > 0):
-                    des = getattr(self.model.param, var)
-                    value = getattr(self.model, var)
-                    des[0] = value.detach().numpy().copy()
-                    setattr(self.model.param, var, des)
-            model_np = WWD_np(self.model.node_size, self.model.TRs_per_window, step_size_n, step_size, tr_p,
-                              self.model.sc_fitted.detach().numpy().copy(),
-                              self.model.use_dynamic_boundary, self.model.use_Laplacian, self.model.param)
-
-            # Create placeholders for the simulated BOLD E I x f and q of entire time series.
+        """
+        Simulate the fitted JR model without torch (JR_Numpy.JRNumpy), driven by noise only.
+        Parameters
+        ----------
+        tr_p: float
+            tr of the simulation
+        step_size_n: float
+            integration step of the simulation
+        step_size: float
+            not used (integration step of the former RWW NumPy model)
+        num_windows: int
+            number of windows kept after 10 burn-in windows
+        """
+        if self.model.model_name == 'JR':
+            import JR_Numpy
+            model_np = JR_Numpy.JRNumpy(export_numpy_model(self.model), int(tr_p / step_size_n),
+                                        self.model.TRs_per_window)
+            model_np.par[JR_Numpy.scalar_names.index('dt')] = step_size_n
+            u = np.zeros((self.model.node_size, model_np.steps_per_TR, num_windows * self.model.TRs_per_window))
+            out = model_np.simulate(u, base_window_num=10)
             for name in self.model.state_names + [self.output_sim.output_name]:
-                setattr(self.output_sim, name + '_test', [])
+                setattr(self.output_sim, name + '_test', out[name])
+        else:
+            print("only JR model for the test_realtime function")
 
-            # Perform the training in batches.
 
-            for TR_i in range(num_windows + 10):
+class BatchFitting:
+    """
+    Multi-start fitting: num_models initialisations of the same subject trained together with ADAM
+    (one batched model, one optimizer; the models do not interact), with successive-halving pruning
+    of the poor starts
+    Attributes
+    ----------
+    model: instance of class RNNJANSENBatch
+        batched forward model JansenRit
+    ts: array with num_epoches x num_windows x output_size x TRs_per_window
+        empirical EEG (dataloader output) shared by all models, or with a leading num_models dimension
+    num_epoches: int
+        the times for repeating trainning
+    cost: choice of the cost function
+    members: array of int
+        original index of each remaining model
+    pruned: list of (epoch, array of int)
+        original indices of the models dropped at each pruning epoch
+    epoch_loss, fc_cor: arrays with num_models
+        mean window loss and sensor FC correlation of the last epoch
+    best: int
+        index (in the remaining models) of the best model after train
+    """
 
-                noise_in_np = np.random.randn(self.model.node_size, self.model.TRs_per_window, int(tr_p / step_size_n),
-                                              2)
+    def __init__(self, model, ts, num_epoches, cost):
+        self.model = model
+        self.ts = ts
+        self.num_epoches = num_epoches
+        self.cost = Costs(cost)
+        self.members = np.arange(model.num_models)
+        self.pruned = []
+        self.best = None
 
-                noise_BOLD_np = np.random.randn(self.model.node_size, self.model.TRs_per_window)
+    def member_ts(self, index):
+        return self.ts[index] if self.ts.ndim == 5 else self.ts
 
-                next_window_np = model_np.forward(X_np, noise_in_np, noise_BOLD_np)
-                if TR_i >= 10:
-                    # Put the batch of the simulated BOLD, E I x f v q in to placeholders for entire time-series.
-                    for name in self.model.state_names + [self.output_sim.output_name]:
-                        name_next = name + '_window'
-                        tmp_ls = getattr(self.output_sim, name + '_test')
-                        tmp_ls.append(next_window_np[name_next])
+    def train(self, learningrate=0.05, u=0, prune_epochs=(), keep_frac=0.5, prune_metric='loss',
+              epoch_min=200, r_lb=0.95, stop='all', profiler=None):
+        """
+        The loss and parameter histories of every model are kept as in Model_fitting.train (all fitted
+        parameters including the connection gains, the fitted sc as weights and, with use_fit_lfm, the leadfield);
+        the histories of pruned models are dropped at the pruning epochs.
+        Parameters
+        ----------
+        learningrate : for machine learing speed
+        u: stimulus, array with node_size x steps_per_TR x time (or with a leading num_models dimension)
+        prune_epochs: sequence of int
+            epochs after which only the best ceil(keep_frac * num_models) models are kept
+        keep_frac: float
+            fraction of the models kept at every pruning epoch
+        prune_metric: 'loss' or 'fc_cor'
+            ranking of the models (lowest mean window loss or highest sensor FC correlation of the epoch)
+        epoch_min, r_lb: int, float
+            FC stop rule of Model_fitting.train
+        stop: 'all' or 'best'
+            models that must pass the stop rule: every model ('all': conditions or subjects, which must all be
+            fitted) or only the best one ('best': competing starts of one subject)
+        profiler: FitProfiler or None
+            optional per-phase timing of the training run (loss and fc_cor of the best model per epoch)
+        """
+        if profiler is None:
+            profiler = FitProfiler(enabled=False)
+        if prune_metric not in ['loss', 'fc_cor']:
+            raise ValueError("Invalid prune_metric. Choose 'loss' or 'fc_cor'.")
+        if stop not in ['all', 'best']:
+            raise ValueError("Invalid stop. Choose 'all' or 'best'.")
+        delays_max = 500
+        state_ub = 0.01
+        state_lb = -0.01
+        model = self.model
+        P = model.num_models
 
-                        setattr(self.output_sim, name + '_test', tmp_ls)
+        self.u = u
+        optimizer = optim.Adam(model.parameters(), lr=learningrate, eps=1e-7)
+        profiler.start('train', model)
 
-                # last update current state using next state...
-                # (no direct use X = X_next, since gradient calculation only depends on one batch no history)
-                X_np = next_window_np['current_state']
-            tmp_ls = getattr(self.output_sim, self.output_sim.output_name + '_test')
+        # initial states, independent for every model
+        X = torch.tensor(np.random.uniform(state_lb, state_ub, (P, model.node_size, model.state_size)),
+                         dtype=torch.float32)
+        hE = torch.tensor(np.random.uniform(state_lb, state_ub, (P, model.node_size, delays_max)),
+                          dtype=torch.float32)
 
-            for name in self.model.state_names + [self.output_sim.output_name]:
-                tmp_ls = getattr(self.output_sim, name + '_test')
-                setattr(self.output_sim, name + '_test', np.concatenate(tmp_ls, axis=1))
-        else:
-            print("only WWD model for the test_realtime function")
+        mask_e = np.tril_indices(model.output_size, -1)
 
-import numpy as np
-import scipy.io
-import pandas as pd
-import sys
-import warnings
-warnings.filterwarnings('ignore')
-sub = sys.argv[1]
-run = sys.argv[2]
-
-meg_file = data_path+ sub +'/' + run + '.npy'
-meg_data = np.load(meg_file)
-sc_file = data_path+ sub +'/shen_indiv.csv'
-dist_file = data_path + sub +'/distance.txt'
-sc_df = pd.read_csv(sc_file, header=None)
-sc =sc_df.values
-dist = np.loadtxt(dist_file)
-
-sc = np.log1p(sc) / np.linalg.norm(np.log1p(sc))
-
-meg_sub = meg_data/np.abs(meg_data).max()*1
-node_size = sc.shape[0]
-output_size = meg_sub.shape[0]
-batch_size = 250
-step_size = 0.0001
-input_size = 3
-num_epoches = 250
-tr = 0.001
-state_size = 6
-base_batch_num = 250
-time_dim = meg_sub.shape[1]
-hidden_size = int(tr/step_size)
-
-ki0 =np.zeros((node_size,1))
-ki0[2] =1
-ki0[183]=1
-ki0[5]=1
-
-from scipy.io import loadmat
-
-leadfield_file = data_path+ sub +'/'+ 'leadfield_3d.mat'
-leadfield= loadmat(leadfield_file)
-lm_3d = leadfield['M']
-lm = np.zeros_like(lm_3d)[:,:,0]
-for sources in range(lm_3d.shape[0]):
-    u, d, v = np.linalg.svd(lm_3d[sources])
-    lm[sources] = u[:,:3].dot(np.diag(d)).dot(v[0])
-lm = lm.T/1e-11*5
-
-data_mean = dataloader(meg_sub.T, num_epoches, batch_size)
-lm_n = 0.01*np.random.randn(output_size,node_size)
-lm_v = 0.01*np.random.randn(output_size,node_size)
-par = ParamsModel('JR', A = [3.25, 0.1], a= [100, 1], B = [22, 0.5], b = [50, 1], g=[400, 1], g_f=[10, 1], g_b=[10, 1],\
-                    c1 = [135, 1], c2 = [135*0.8, 1], c3 = [135*0.25, 1], c4 = [135*0.25, 1],\
-                    std_in=[0, 1], vmax= [5, 0], v0=[6,0], r=[0.56, 0], y0=[-0.5 , 0.05],\
-                    mu = [1., 0.1], k = [5, 0.2], kE = [0, 0], kI = [0, 0],
-                    cy0 = [5, 0], ki=[ki0, 0], lm=[lm+lm_n, .1 * np.ones((output_size, node_size))+lm_v])
-
-
-
-model = RNNJANSEN(node_size, batch_size, step_size, output_size, tr, sc, lm, dist, True, False, par)
-# initialize model parameters and set the fitted model parameter in Tensors
-model.setModelParameters()
-
-# call model fit
-F = Model_fitting(model, data_mean, num_epoches, 0)
-
-#fit data(train)
-u = np.zeros((node_size,hidden_size,time_dim))
-    #u[:,:,120:130,0]= 00
-u[:,:,100:140]= 5000
-output_train = F.train(u=u)
-output_test = F.test(base_batch_num, u=u)
-
-filename = output_path  + '/' + sub + '_' + run + '_fittingresults_stim_exp.pkl'
-with open(filename, 'wb') as f:
-        pickle.dump(F, f)
-
-meg_sub = np.zeros((meg_data.shape[0], 1500))
-meg_sub[:,:meg_data.shape[1]] = meg_data*1.0e13
-node_size = sc.shape[0]
-output_size = meg_sub.shape[0]
-batch_size = 250
-step_size = 0.0001
-input_size = 3
-num_epoches = 250
-tr = 0.001
-state_size = 6
-base_batch_num = 250
-time_dim = meg_sub.shape[1]
-hidden_size = int(tr/step_size)
-data_mean = dataloader((meg_sub-meg_sub.mean(0)).T, num_epoches, batch_size)
-F.ts = data_mean
-u = np.zeros((node_size,hidden_size,time_dim))
-u[:,:,100:140]= 5000
-output_test = F.test(base_batch_num, u=u)
-
-filename = output_path  + '/' + sub + '_' + run + '_pred1500.pkl'
-with open(filename, 'wb') as f:
-        pickle.dump(F.output_sim, f)
-source_file = output_path  + '/'   + sub + '_' +run+'_pred1500_source_ts.npy'
-sensor_file = output_path  + '/'+ sub + '_' +run+'_pred1500_sensor_ts.npy'
-np.save(source_file,F.output_sim.P_test)
-np.save(sensor_file,F.output_sim.eeg_test)
+        # history of the loss and of the parameters (per model, the initial values first as in Model_fitting.train)
+        mask = np.tril_indices(model.node_size, -1)
+        exclude_param = ['lm'] if model.use_fit_lfm else []
+        loss_his = []
+        fit_param = {key: [self.member_values(value, P)] for key, value in model.named_parameters()
+                     if key not in exclude_param}
+        fit_sc = [self.member_values(model.sc, P)[:, mask[0] * model.node_size + mask[1]]] \
+            if model.use_fit_gains else None
+        fit_lm = [self.member_values(model.lm, P)] if model.use_fit_lfm else None
+        fc_cache = {}
+
+        num_windows = self.ts.shape[-3]
+        for i_epoch in range(self.num_epoches):
+            outputs = {name: [] for name in model.state_names + ['eeg']}
+            external = torch.zeros((model.node_size, model.steps_per_TR, model.TRs_per_window))
+
+            for TR_i in range(num_windows):
+                optimizer.zero_grad()
+
+                if not isinstance(self.u, int):
+                    external = torch.tensor(
+                        self.u[..., TR_i * model.TRs_per_window:(TR_i + 1) * model.TRs_per_window],
+                        dtype=torch.float32)
+
+                with profiler.phase('forward'):
+                    next_window, hE_new = model(external, X, hE)
+
+                ts_window = torch.tensor(self.ts[..., i_epoch, TR_i, :, :], dtype=torch.float32)
+
+                # per-model loss; the models are independent, so the gradient of the sum is per model
+                with profiler.phase('cost'):
+                    loss = self.cost.cost_eff_batch(next_window['eeg_window'], ts_window, model)
+                    if TR_i in [5, 6]:
+                        loss = 5 * loss
+
+                with profiler.phase('window_output'):
+                    for name in outputs:
+                        outputs[name].append(next_window[name + '_window'].detach().numpy())
+                    loss_his.append(loss.detach().numpy())
+
+                with profiler.phase('backward'):
+                    loss.sum().backward()
+                with profiler.phase('optimizer_step'):
+                    optimizer.step()
+
+                with profiler.phase('param_history'):
+                    for key, value in model.named_parameters():
+                        if key in fit_param:
+                            fit_param[key].append(self.member_values(value, P))
+                    if fit_sc is not None:
+                        fit_sc.append(self.member_values(model.sc_fitted, P)[:, mask[0] * model.node_size + mask[1]])
+                    if fit_lm is not None:
+                        fit_lm.append(self.member_values(model.lm, P))
+
+                X = next_window['current_state'].detach().clone()
+                hE = hE_new.detach().clone()
+                profiler.step()
+
+            outputs = {name: np.concatenate(value, axis=2) for name, value in outputs.items()}
+            self.epoch_loss = np.mean(loss_his[-num_windows:], axis=0)
+
+            ts_emp = np.concatenate(list(self.ts[..., i_epoch, :, :, :].swapaxes(-3, 0)), -1)
+            fc_cor = np.zeros(P)
+            for i in range(P):
+                emp = ts_emp[i] if ts_emp.ndim == 3 else ts_emp
+                key = i if ts_emp.ndim == 3 else 0
+                if key not in fc_cache or not np.array_equal(emp, fc_cache[key][0]):
+                    fc_cache[key] = (emp, np.corrcoef(emp))
+                fc_cor[i], _ = fit_metrics(outputs['eeg'][i], emp, mask_e, 10, fc_cache[key][1])
+            self.fc_cor = fc_cor
+            print('epoch: ', i_epoch, 'loss: ', self.epoch_loss, 'fc_cor: ', fc_cor)
+
+            score = self.epoch_loss if prune_metric == 'loss' else -fc_cor
+            self.best = int(np.argmin(score))
+            profiler.epoch(i_epoch, loss=self.epoch_loss[self.best], fc_cor=fc_cor[self.best])
+            if stop == 'best' and i_epoch > epoch_min and fc_cor[self.best] > r_lb:
+                print('stop: fc_cor %.3f > %.3f (start %d)' % (fc_cor[self.best], r_lb, self.members[self.best]))
+                break
+            if stop == 'all' and i_epoch > epoch_min and (fc_cor > r_lb).all():
+                print('stop: fc_cor > %.3f for all models (min %.3f)' % (r_lb, fc_cor.min()))
+                break
+
+            if i_epoch in prune_epochs and P > 1:
+                keep = np.sort(np.argsort(score, kind='stable')[:int(np.ceil(P * keep_frac))])
+                self.pruned.append((i_epoch, np.setdiff1d(self.members, self.members[keep])))
+                optimizer = self.prune(keep, optimizer)
+                P = model.num_models
+                X, hE = X[keep], hE[keep]
+                if not isinstance(self.u, int) and self.u.ndim == 4:
+                    self.u = self.u[keep]
+                if self.ts.ndim == 5:
+                    self.ts = stack_epochs([self.ts[i] for i in keep])
+                loss_his = [value[keep] for value in loss_his]
+                fit_param = {key: [value[keep] for value in values] for key, values in fit_param.items()}
+                fit_sc = None if fit_sc is None else [value[keep] for value in fit_sc]
+                fit_lm = None if fit_lm is None else [value[keep] for value in fit_lm]
+                outputs = {name: value[keep] for name, value in outputs.items()}
+                self.epoch_loss, self.fc_cor = self.epoch_loss[keep], fc_cor[keep]
+                self.members = self.members[keep]
+                self.best = int(np.argmin(score[keep]))
+                print('prune: keep starts', self.members)
+
+        self.loss = np.array(loss_his)
+        self.outputs = outputs
+        self.fit_param = {key: np.array(value) for key, value in fit_param.items()}
+        self.fit_sc = None if fit_sc is None else np.array(fit_sc)
+        self.fit_lm = None if fit_lm is None else np.array(fit_lm)
+        profiler.stop()
+
+    @staticmethod
+    def member_values(value, P):
+        """
+        Flattened copy (P x size) of a parameter or tensor with a leading dimension of P or 1 (shared).
+        """
+        value = value.detach()
+        return value.expand(P, *value.shape[1:]).numpy().reshape(P, -1).copy()
+
+    def prune(self, keep, optimizer):
+        """
+        Keep the models with indices keep and return a new ADAM carrying over their moment estimates.
+        """
+        names = [key for key, value in self.model.named_parameters()]
+        state = [optimizer.state.get(value, {}) for value in self.model.parameters()]
+        self.model.select(keep)
+        new_optimizer = optim.Adam(self.model.parameters(), lr=optimizer.param_groups[0]['lr'], eps=1e-7)
+        index = torch.as_tensor(keep, dtype=torch.int64)
+        for key, st in zip(names, state):
+            if st:
+                new_optimizer.state[getattr(self.model, key)] = {
+                    name: value[index].clone() if value.dim() > 0 and value.shape[0] == len(self.members) else
+                    value.clone() for name, value in st.items()}
+        return new_optimizer
+
+    def best_fit(self, index=None):
+        """
+        Model_fitting of one model (default: the best) with its loss history, last-epoch outputs
+        and parameter, weights (and leadfield) histories, ready for test() and the usual pickles.
+        """
+        index = self.best if index is None else index
+        F = Model_fitting(self.model.member(index), self.member_ts(index), self.num_epoches, self.cost.method)
+        F.u = self.u[index] if not isinstance(self.u, int) and self.u.ndim == 4 else self.u
+        F.output_sim.loss = self.loss[:, index]
+        for name, value in self.outputs.items():
+            setattr(F.output_sim, name + '_train', value[index])
+        for key, value in self.fit_param.items():
+            setattr(F.output_sim, key, value[:, index])
+        if self.fit_sc is not None:
+            F.output_sim.weights = self.fit_sc[:, index]
+        if self.fit_lm is not None:
+            F.output_sim.leadfield = self.fit_lm[:, index]
+        return F
+
+
+def leadfield_from_3d(lm_3d):
+    """
+    Collapse a 3D leadfield (sources x sensors x orientations) to a sensors x sources matrix
+    by projecting each source on its dominant orientation (SVD), scaled as in the fits of the paper.
+    """
+    lm = np.zeros_like(lm_3d)[:,:,0]
+    for sources in range(lm_3d.shape[0]):
+        u, d, v = np.linalg.svd(lm_3d[sources])
+        lm[sources] = u[:,:3].dot(np.diag(d)).dot(v[0])
+    return lm.T/1e-11*5
+
+
+def default_jr_params(lm, ki0):
+    """
+    Priors of the JR fits in the paper
+    Parameters
+    ----------
+    lm: array with output_size x node_size
+        leadfield matrix (prior mean of lm, jittered)
+    ki0: array with node_size x 1
+        stimulus target nodes
+    """
+    output_size, node_size = lm.shape
+    lm_n = 0.01*np.random.randn(output_size,node_size)
+    lm_v = 0.01*np.random.randn(output_size,node_size)
+    return ParamsModel('JR', A = [3.25, 0.1], a= [100, 1], B = [22, 0.5], b = [50, 1], g=[400, 1], g_f=[10, 1], g_b=[10, 1],\
+                       c1 = [135, 1], c2 = [135*0.8, 1], c3 = [135*0.25, 1], c4 = [135*0.25, 1],\
+                       std_in=[0, 1], vmax= [5, 0], v0=[6,0], r=[0.56, 0], y0=[-0.5 , 0.05],\
+                       mu = [1., 0.1], k = [5, 0.2], kE = [0, 0], kI = [0, 0],
+                       cy0 = [5, 0], ki=[ki0, 0], lm=[lm+lm_n, .1 * np.ones((output_size, node_size))+lm_v])
+
+
+class FitUnpickler(pickle.Unpickler):
+    """
+    Unpickler for fitted checkpoints written by the driver below, where the classes live in __main__.
+    """
+
+    def find_class(self, module, name):
+        if module == '__main__' and name in globals():
+            return globals()[name]
+        return super().find_class(module, name)
+
+
+def load_fit(filename):
+    """
+    Load a fitted Model_fitting checkpoint ({sub}_{run}_fittingresults_stim_exp.pkl).
+    """
+    with open(filename, 'rb') as f:
+        return FitUnpickler(f).load()
+
+
+def fit_params(F):
+    """
+    Parameters of a fitted Model_fitting (or model) as a dict of numpy arrays.
+    """
+    model = F.model if isinstance(F, Model_fitting) else F
+    return {key: value.detach().numpy().copy() for key, value in model.state_dict().items()}
+
+
+SUBJECT_PARAMS = ('lm',)  # parameters seeded from the subject's own inputs (not warm-started by default)
+SUMMARY_PARAMS = ['a', 'b', 'g', 'g_f', 'g_b', 'c1', 'c2', 'c3', 'c4']  # scalar parameters of subject_data.pkl
+SUMMARY_COUPLINGS = ['sc_m_b', 'sc_m_f', 'sc_fitted']  # normalised P->I, P->E and P->P couplings
+
+
+def fit_fields(F):
+    """
+    Fields of a fitted Model_fitting (or model) summarised in subject_data.pkl: the scalar parameters and the
+    normalised couplings of the last forward pass.
+    """
+    model = F.model if isinstance(F, Model_fitting) else F
+    state = model.state_dict()
+    fields = {key: state[key].detach().numpy().copy() for key in SUMMARY_PARAMS if key in state}
+    for key in SUMMARY_COUPLINGS:
+        if getattr(model, key, None) is not None:
+            fields[key] = torch.as_tensor(getattr(model, key)).detach().numpy().copy()
+    return fields
+
+
+def fields_filename(fit_filename):
+    """
+    Small .npz of fit_fields saved next to a fitted checkpoint ({sub}_{run}_fields.npz).
+    """
+    return fit_filename.replace('_fittingresults_stim_exp.pkl', '_fields.npz')
+
+
+def save_params(params, filename):
+    np.savez(filename, **params)
+
+
+def load_params(filename):
+    """
+    Parameter dict from a .npz written by save_params or from a fitted checkpoint.
+    """
+    if filename.endswith('.npz'):
+        with np.load(filename) as data:
+            return {key: data[key] for key in data.files}
+    return fit_params(load_fit(filename))
+
+
+def subject_param(key):
+    """
+    Whether a parameter (or its prior hyper parameters *_m, *_v_inv) is seeded from the subject's own inputs
+    (SUBJECT_PARAMS).
+    """
+    for suffix in ('_m', '_v_inv'):
+        if key.endswith(suffix) and key[:-len(suffix)] in SUBJECT_PARAMS:
+            return True
+    return key in SUBJECT_PARAMS
+
+
+def group_average_params(filenames, include_subject=False):
+    """
+    Element-wise mean of the parameters over several fitted checkpoints or parameter files
+    (e.g. all verb fits of one age group), for warm-starting new subjects of that group.
+    The subject-specific parameters (SUBJECT_PARAMS, e.g. the leadfield) are left out unless include_subject is set.
+    """
+    total = {}
+    count = {}
+    for filename in filenames:
+        for key, value in load_params(filename).items():
+            if not include_subject and subject_param(key):
+                continue
+            if key in total and total[key].shape != value.shape:
+                continue
+            total[key] = total.get(key, 0) + value.astype(np.float64)
+            count[key] = count.get(key, 0) + 1
+    return {key: (total[key] / count[key]).astype(np.float32) for key in total}
+
+
+def warm_start_model(model, params, include_prior=False, jitter=0., include_subject=False):
+    """
+    Copy the values of params into the matching (same name and shape) parameters of model.
+    The prior hyper parameters (*_m, *_v_inv) are kept unless include_prior is set, and the parameters seeded
+    from the subject's own inputs (SUBJECT_PARAMS, e.g. the leadfield lm) unless include_subject is set.
+    """
+    copied = []
+    state = dict(model.named_parameters())
+    with torch.no_grad():
+        for key, value in params.items():
+            if key not in state or tuple(state[key].shape) != tuple(np.shape(value)):
+                continue
+            if not include_prior and (key.endswith('_m') or key.endswith('_v_inv')):
+                continue
+            if not include_subject and subject_param(key):
+                continue
+            value = torch.tensor(value, dtype=state[key].dtype)
+            if jitter > 0:
+                value = value + jitter * torch.abs(value) * torch.randn(value.shape)
+            state[key].copy_(value)
+            copied.append(key)
+    return copied
+
+
+
+def export_numpy_model(F, filename=None):
+    """
+    Values needed by the NumPy engine (JR_Numpy.JRNumpy) from a fitted JR Model_fitting (or model):
+    the scalar parameters after the transforms of integration_forward, the stimulus gain of every node,
+    the normalised couplings, the delays and the normalised leadfield; saved as .npz if filename is given.
+    """
+    model = F.model if isinstance(F, Model_fitting) else F
+    m = torch.nn.ReLU()
+    lb = 0.01  # lower bound of local gains
+    k_lb = 0.5  # lower bound of coefficient of external inputs
+    conduct_lb = 1.5  # lower bound for conduct velocity
+    with torch.no_grad():
+        sc = sc_tensor(model)
+        w_b = torch.exp(gain_matrix(model, 'w_bb')) * sc
+        w_f = torch.exp(gain_matrix(model, 'w_ff')) * sc
+        w = torch.exp(gain_matrix(model, 'w_ll')) * sc
+        w_s = 0.5 * (w + torch.transpose(w, 0, 1))
+        lm_t = (model.lm.T / torch.sqrt(model.lm ** 2).sum(1)).T
+        values = {
+            'std_in': 5 + torch.exp(model.std_in), 'g': lb + m(model.g), 'g_f': lb + m(model.g_f),
+            'g_b': lb + m(model.g_b), 'kE': m(model.kE), 'kI': m(model.kI),
+            'c1': lb + m(model.c1), 'c2': lb + m(model.c2), 'c3': lb + m(model.c3), 'c4': lb + m(model.c4),
+            'A': m(model.A), 'a': 1 + m(model.a), 'B': m(model.B), 'b': 1 + m(model.b),
+            'vmax': model.vmax, 'v0': model.v0, 'r': model.r, 'cy0': model.cy0, 'y0': model.y0,
+            'dt': model.step_size,
+            'ki': (k_lb + m(model.k)) * m(model.ki),
+            'w_n_b': w_b / torch.linalg.norm(w_b) if getattr(model, 'sc_m_b_fixed', None) is None
+            else model.sc_m_b_fixed,
+            'w_n_f': w_f / torch.linalg.norm(w_f),
+            'w_n_l': w_s / torch.linalg.norm(w_s),
+            'delays': (model.dist / (conduct_lb + m(model.mu))).type(torch.int64),
+            'lm_t': lm_t - torch.mean(lm_t, 0, keepdim=True)}
+        values = {key: torch.as_tensor(value).numpy().copy() for key, value in values.items()}
+    values.update(steps_per_TR=model.steps_per_TR, TRs_per_window=model.TRs_per_window, delays_max=500)
+    if filename is not None:
+        np.savez(filename, **values)
+    return values
+
+
+def check_numpy_model(model, u=None, seed=0):
+    """
+    Run one window of integration_forward and of the NumPy engine from the same states and input noise,
+    and return the largest absolute difference of every output.
+    """
+    import JR_Numpy
+    np_model = JR_Numpy.JRNumpy(export_numpy_model(model), model.steps_per_TR, model.TRs_per_window)
+    rng = np.random.RandomState(seed)
+    X = rng.uniform(-0.01, 0.01, (model.node_size, model.state_size))
+    hE = rng.uniform(-0.01, 0.01, (model.node_size, 500))
+    if u is None:
+        u = np.zeros((model.node_size, model.steps_per_TR, model.TRs_per_window))
+    # the noise of integration_forward: three node_size x 1 draws (M, E, I) per integration step,
+    # drawn one by one (torch draws large tensors with a different algorithm)
+    torch.manual_seed(seed)
+    noise = np.zeros((model.TRs_per_window, model.steps_per_TR, 3, model.node_size))
+    for i_window in range(model.TRs_per_window):
+        for step_i in range(model.steps_per_TR):
+            for i in range(3):
+                noise[i_window, step_i, i] = torch.randn(model.node_size, 1)[:, 0].numpy()
+    torch.manual_seed(seed)
+    with torch.no_grad():
+        next_torch, hE_torch = model(torch.tensor(u, dtype=torch.float32), torch.tensor(X, dtype=torch.float32),
+                                     torch.tensor(hE, dtype=torch.float32))
+    next_np, hE_np = np_model.forward(u, X, hE, noise)
+    diff = {key: float(np.max(np.abs(next_torch[key].numpy() - next_np[key]))) for key in next_np}
+    diff['hE'] = float(np.max(np.abs(hE_torch.numpy() - hE_np)))
+    return diff
+
+
+def load_subject_inputs(sub, runs):
+    """
+    Model inputs of one subject from data_path: log-normalised sc, dist, the collapsed leadfield and the
+    evoked M/EEG of every run (dictionary with sc, dist, lm and meg = {run: array}).
+    """
+    import pandas as pd
+    from scipy.io import loadmat
+
+    sc = pd.read_csv(data_path + sub + '/shen_indiv.csv', header=None).values
+    sc = np.log1p(sc) / np.linalg.norm(np.log1p(sc))
+    dist = np.loadtxt(data_path + sub + '/distance.txt')
+    lm = leadfield_from_3d(loadmat(data_path + sub + '/' + 'leadfield_3d.mat')['M'])
+    meg = {run: np.load(data_path + sub + '/' + run + '.npy') for run in runs}
+    return {'sc': sc, 'dist': dist, 'lm': lm, 'meg': meg}
+
+
+def save_fit_outputs(F, sub, run, meg_data, u_train, profiler=None, base_batch_num=250):
+    """
+    Test a fitted model on the training stimulus and save it ({sub}_{run}_fittingresults_stim_exp.pkl and
+    _fields.npz), then simulate the 1500-sample stimulus response and save it (_pred1500.pkl and the
+    _pred1500_source_ts.npy / _pred1500_sensor_ts.npy time series) to output_path.
+    Parameters
+    ----------
+    F: Model_fitting
+        fitted model
+    sub, run: str
+        subject and run of the output files
+    meg_data: array with output_size x time
+        evoked data of the run (unnormalised)
+    u_train: array with node_size x steps_per_TR x time
+        stimulus of the training
+    profiler: FitProfiler or None
+        optional timing of the test runs
+    base_batch_num: int
+        burn-in windows of the test runs
+    """
+    output_test = F.test(base_batch_num, u=u_train, profiler=profiler)
+
+    filename = output_path  + '/' + sub + '_' + run + '_fittingresults_stim_exp.pkl'
+    with open(filename, 'wb') as f:
+            pickle.dump(F, f)
+    save_params(fit_fields(F), fields_filename(filename))
+
+    meg_sub = np.zeros((meg_data.shape[0], 1500))
+    meg_sub[:,:meg_data.shape[1]] = meg_data*1.0e13
+    node_size = F.model.node_size
+    batch_size = 250
+    step_size = 0.0001
+    num_epoches = 250
+    tr = 0.001
+    time_dim = meg_sub.shape[1]
+    hidden_size = int(tr/step_size)
+    data_mean = dataloader((meg_sub-meg_sub.mean(0)).T, num_epoches, batch_size)
+    F.ts = data_mean
+    u = np.zeros((node_size,hidden_size,time_dim))
+    u[:,:,100:140]= 5000
+    output_test = F.test(base_batch_num, u=u, profiler=profiler)
+
+    filename = output_path  + '/' + sub + '_' + run + '_pred1500.pkl'
+    with open(filename, 'wb') as f:
+            pickle.dump(F.output_sim, f)
+    source_file = output_path  + '/'   + sub + '_' +run+'_pred1500_source_ts.npy'
+    sensor_file = output_path  + '/'+ sub + '_' +run+'_pred1500_sensor_ts.npy'
+    np.save(source_file,F.output_sim.P_test)
+    np.save(sensor_file,F.output_sim.eeg_test)
+
+
+def fit_subject(sub, run, profile=False, warm=None, starts=None, joint=None, inputs=None, checkpoint_every=None,
+                warm_subject=False):
+    """
+    Fit the evoked M/EEG of one subject and save the fitted model, the 1500-sample predictions
+    and their source/sensor time series to output_path.
+    Parameters
+    ----------
+    sub, run: str
+        subject (e.g. CTL_01_16) and run (e.g. verb_evoked)
+    profile: bool
+        also write a FitProfiler report
+    warm: str or None
+        fitted checkpoint or parameter .npz to warm-start from (single-start fits only)
+    starts: int or None
+        number of starts of a multi-start fit
+    joint: str or None
+        second run fitted jointly (JOINT_SHARED parameters shared)
+    inputs: dict or None
+        model inputs as load_subject_inputs (e.g. attached from shared memory with
+        JR_SharedInputs.attach_subject); loaded from data_path if None
+    checkpoint_every: int or None
+        checkpoint the single-start training every checkpoint_every epochs to
+        output_path/{sub}_{run}_checkpoint.pt and resume from it when it exists (and was written with the
+        same settings); the checkpoint is removed once the fit is saved
+    warm_subject: bool
+        also warm-start the subject-specific parameters (the leadfield), for a warm fit of the same subject
+    Returns
+    -------
+    list of Model_fitting, one per run
+    """
+    # optional timing report
+    if warm is not None and (starts or joint):
+        raise ValueError('warm= is only supported by single-start fits (not with starts= or joint=)')
+    if checkpoint_every and (starts or joint):
+        raise ValueError('checkpoint_every is only supported by single-start fits (not with starts= or joint=)')
+    profiler = FitProfiler(label=sub + '_' + run) if profile else None
+    runs = [run] + ([joint] if joint else [])
+
+    if inputs is None:
+        inputs = load_subject_inputs(sub, runs)
+    meg_runs = [inputs['meg'][r] for r in runs]
+    meg_data = meg_runs[0]
+    sc = inputs['sc']
+    dist = inputs['dist']
+
+    meg_sub = meg_data/np.abs(meg_data).max()*1
+    node_size = sc.shape[0]
+    output_size = meg_sub.shape[0]
+    batch_size = 250
+    step_size = 0.0001
+    input_size = 3
+    num_epoches = 250
+    tr = 0.001
+    state_size = 6
+    base_batch_num = 250
+    time_dim = meg_sub.shape[1]
+    hidden_size = int(tr/step_size)
+
+    ki0 = atlas(node_size).stimulus_input()
+
+    lm = inputs['lm']
+
+    data_mean = dataloader(meg_sub.T, num_epoches, batch_size)
+    par = default_jr_params(lm, ki0)
+
+
+    #fit data(train)
+    u = np.zeros((node_size,hidden_size,time_dim))
+        #u[:,:,120:130,0]= 00
+    u[:,:,100:140]= 5000
+
+    if len(runs) > 1:
+        data_runs = stack_epochs([dataloader((m_d/np.abs(m_d).max()).T, num_epoches, batch_size) for m_d in meg_runs])
+        model = RNNJANSENBatch(len(runs), node_size, batch_size, step_size, output_size, tr, sc, lm, dist, True, False,
+                               par, shared=JOINT_SHARED)
+        model.setModelParameters()
+        B = BatchFitting(model, data_runs, num_epoches, 0)
+        B.train(u=u, profiler=profiler)
+        fits = [B.best_fit(i) for i in range(len(runs))]
+    elif starts:
+        model = RNNJANSENBatch(starts, node_size, batch_size, step_size, output_size, tr, sc, lm, dist, True, False, par)
+        model.setModelParameters()
+        B = BatchFitting(model, data_mean, num_epoches, 0)
+        B.train(u=u, prune_epochs=(10, 20, 40, 80), stop='best', profiler=profiler)
+        print('best start', B.members[B.best], 'pruned', B.pruned)
+        fits = [B.best_fit()]
+    else:
+        model = RNNJANSEN(node_size, batch_size, step_size, output_size, tr, sc, lm, dist, True, False, par)
+        # initialize model parameters and set the fitted model parameter in Tensors
+        model.setModelParameters()
+
+        # call model fit
+        F = Model_fitting(model, data_mean, num_epoches, 0)
+        if warm is not None:
+            print('warm start from', warm, F.warm_start(warm, include_subject=warm_subject))
+
+        checkpoint = output_path + '/' + sub + '_' + run + '_checkpoint.pt' if checkpoint_every else None
+        output_train = F.train(u=u, profiler=profiler, checkpoint=checkpoint, checkpoint_every=checkpoint_every or 10)
+        fits = [F]
+
+    for run, F, meg_data in zip(runs, fits, meg_runs):
+        save_fit_outputs(F, sub, run, meg_data, u, profiler)
+    if checkpoint_every and os.path.exists(checkpoint):
+        os.remove(checkpoint)  # the fit is saved, a rerun starts a new fit
+    if profiler is not None:
+        profiler.save(output_path + '/' + sub + '_' + runs[0] + '_profile.json')
+    return fits
+
+
+def transplant_p2i(model, avg_source_p2i, L_idx, R_idx):
+    """
+    Replace the fitted P->I coupling (sc_m_b) between the left and right ROIs L_idx and R_idx
+    (both directions) by the values of avg_source_p2i; later forward calls use the transplanted matrix.
+    """
+    with torch.no_grad():
+        w_b = torch.exp(gain_matrix(model, 'w_bb')) * sc_tensor(model)
+        new_sc_m_b = (w_b / torch.linalg.norm(w_b)).clone()
+    avg_source_p2i = torch.as_tensor(avg_source_p2i, dtype=new_sc_m_b.dtype)
+    new_sc_m_b[np.ix_(L_idx, R_idx)] = avg_source_p2i[np.ix_(L_idx, R_idx)]
+    new_sc_m_b[np.ix_(R_idx, L_idx)] = avg_source_p2i[np.ix_(R_idx, L_idx)]
+    model.sc_m_b_fixed = new_sc_m_b
+    model.sc_m_b = new_sc_m_b
+    return new_sc_m_b
+
+
+def simulate_fit(F, meg_data=None, length=1500, base_window_num=250):
+    """
+    Stimulus-driven simulation of a fitted model (as the _pred1500 outputs of fit_subject).
+    Parameters
+    ----------
+    F: Model_fitting
+        fitted model
+    meg_data: array with output_size x time or None
+        evoked data of the run (only used for the FC/cosine report; zeros if None)
+    length: int
+        number of simulated samples (whole windows of TRs_per_window)
+    base_window_num: int
+        burn-in windows
+    Returns
+    -------
+    F (with the simulated states and M/EEG in F.output_sim.*_test)
+    """
+    model = F.model
+    meg_sub = np.zeros((model.output_size, length))
+    if meg_data is not None:
+        meg_sub[:, :meg_data.shape[1]] = meg_data * 1.0e13
+    F.ts = dataloader((meg_sub - meg_sub.mean(0)).T, 1, model.TRs_per_window)
+    u = np.zeros((model.node_size, model.steps_per_TR, length))
+    u[:, :, 100:140] = 5000
+    F.test(base_window_num, u=u)
+    return F
+
+
+def transplant_fit(sub, run, source_group='YC', fits_path=None, out_path=None):
+    """
+    Simulate the fit of sub/run with the frontal interhemispheric P->I coupling of a source group
+    (data_path/avg_{source_group}_sc_p2i.npy) and save the _{source_group}p2i_pred1500 source/sensor time series.
+    """
+    fits_path = output_path if fits_path is None else fits_path
+    out_path = output_path if out_path is None else out_path
+    meg_data = np.load(data_path + sub + '/' + run + '.npy')
+    F = load_fit(os.path.join(fits_path, sub + '_' + run + '_fittingresults_stim_exp.pkl'))
+    avg_source_p2i = np.load(data_path + 'avg_' + source_group + '_sc_p2i.npy')
+
+    shen = atlas(F.model.node_size)
+    transplant_p2i(F.model, avg_source_p2i, shen.frontal_left, shen.frontal_right)
+    simulate_fit(F, meg_data)
+
+    prefix = os.path.join(out_path, sub + '_' + run + '_' + source_group + 'p2i_pred1500')
+    np.save(prefix + '_source_ts.npy', F.output_sim.P_test)
+    np.save(prefix + '_sensor_ts.npy', F.output_sim.eeg_test)
+    print('Saved results to:\n  ' + prefix + '_source_ts.npy\n  ' + prefix + '_sensor_ts.npy')
+    return F
+
+
+C4_MEAN_DIFF = 0.6442991186  # mean difference of c4 between the groups
+
+
+def c4_fit(sub, run, manipulation, delta=C4_MEAN_DIFF, fits_path=None, out_path=None):
+    """
+    Simulate the fit of sub/run with its local inhibition c4 increased ('increase') or decreased ('decrease')
+    by delta and save the _c4inc/_c4dec_pred1500 source/sensor time series (as Analysis/local_inhibition_change.py).
+    """
+    if manipulation not in ['increase', 'decrease']:
+        raise ValueError("Invalid manipulation_type. Choose 'increase' or 'decrease'.")
+    fits_path = output_path if fits_path is None else fits_path
+    out_path = output_path if out_path is None else out_path
+    meg_data = np.load(data_path + sub + '/' + run + '.npy')
+    F = load_fit(os.path.join(fits_path, sub + '_' + run + '_fittingresults_stim_exp.pkl'))
+
+    sign = 1 if manipulation == 'increase' else -1
+    F.model.c4 = Parameter(F.model.c4.detach() + sign * delta)
+    simulate_fit(F, meg_data)
+
+    label = 'c4inc' if manipulation == 'increase' else 'c4dec'
+    prefix = os.path.join(out_path, sub + '_' + run + '_' + label + '_pred1500')
+    np.save(prefix + '_source_ts.npy', F.output_sim.P_test)
+    np.save(prefix + '_sensor_ts.npy', F.output_sim.eeg_test)
+    print('Saved results to:\n  ' + prefix + '_source_ts.npy\n  ' + prefix + '_sensor_ts.npy')
+    return F
+
+
+if __name__ == "__main__":
+    import warnings
+    warnings.filterwarnings('ignore')
+    # python JR_Model_Fitting.py <sub> <run> [profile] [warm=<fit .pkl or params .npz>] [warm_subject]
+    #                           [starts=<P>] [joint=<run2>] [checkpoint=<epochs>]
+    # (JR_CLI.py offers the same as "fit" together with "simulate" and "transplant")
+    opts = sys.argv[3:]
+    values = dict(opt.split('=', 1) for opt in opts if '=' in opt)
+    fit_subject(sys.argv[1], sys.argv[2], profile='profile' in opts, warm=values.get('warm'),
+                starts=int(values['starts']) if 'starts' in values else None, joint=values.get('joint'),
+                checkpoint_every=int(values['checkpoint']) if 'checkpoint' in values else None,
+                warm_subject='warm_subject' in opts)
@@ -0,0 +1,230 @@
+"""
+NumPy inference engine for fitted JansenRit models (no torch, no autograd).
+
+A fitted model is exported once with JR_Model_Fitting.export_numpy_model (relu-transformed parameters,
+normalised effective couplings, delays and the normalised leadfield) to an .npz, which this module
+simulates with the same equations as the JR branch of integration_forward. If numba is installed the
+per-window kernel is JIT compiled.
+
+    from JR_Numpy import load_numpy_model
+    model = load_numpy_model('CTL_01_16_verb_evoked_np.npz')
+    out = model.simulate(u, base_window_num=250, seed=0)    # out['P'], out['eeg'], ...
+"""
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+state_names = ['E', 'Ev', 'I', 'Iv', 'P', 'Pv']
+scalar_names = ['std_in', 'g', 'g_f', 'g_b', 'kE', 'kI', 'c1', 'c2', 'c3', 'c4', 'A', 'a', 'B', 'b',
+                'vmax', 'v0', 'r', 'cy0', 'y0', 'dt']
+
+
+def _sigmoid(x, vmax, v0, r):
+    return vmax / (1 + np.exp(r * (v0 - x)))
+
+
+def _sys2nd(A, a, u, x, v):
+    return A * a * u - 2 * a * v - a ** 2 * x
+
+
+def _jr_window(state, hE, external, noise, ki, w_n_b, w_n_f, w_n_l, flat_delays, lm_t, par):
+    """
+    One window of TRs_per_window samples (the JR branch of integration_forward).
+    Parameters
+    ----------
+    state: array with 6 x node_size
+        M, E, I, Mv, Ev, Iv
+    hE: array with node_size x delays_max
+        history of M (updated in place)
+    external: array with node_size x steps_per_TR x TRs_per_window
+        stimulus
+    noise: array with TRs_per_window x steps_per_TR x 3 x node_size
+        standard normal input noise of the M, E and I populations
+    flat_delays: int array with node_size * node_size
+        flat indices into hE of the delayed input of node i from node j (row i)
+    par: array
+        the values of scalar_names
+    Outputs
+    -------
+    state, hE, states (6 x node_size x TRs_per_window) and eeg (output_size x TRs_per_window)
+    """
+    # explicit indexing keeps the kernel compilable by numba
+    std_in, g, g_f, g_b, kE, kI = par[0], par[1], par[2], par[3], par[4], par[5]
+    c1, c2, c3, c4, A, a, B, b = par[6], par[7], par[8], par[9], par[10], par[11], par[12], par[13]
+    vmax, v0, r, cy0, y0, dt = par[14], par[15], par[16], par[17], par[18], par[19]
+    u_2ndsys_ub = 500.
+    node_size = hE.shape[0]
+    steps_per_TR = external.shape[1]
+    TRs_per_window = external.shape[2]
+    M, E, I, Mv, Ev, Iv = state[0].copy(), state[1].copy(), state[2].copy(), state[3].copy(), state[4].copy(), \
+        state[5].copy()
+    dg_b = -w_n_b.sum(axis=1)
+    dg_f = -w_n_f.sum(axis=1)
+    dg_l = -w_n_l.sum(axis=1)
+    states = np.zeros((6, node_size, TRs_per_window))
+    eeg = np.zeros((lm_t.shape[0], TRs_per_window))
+
+    for i_window in range(TRs_per_window):
+        for step_i in range(steps_per_TR):
+            Ed = hE.ravel()[flat_delays].reshape((node_size, node_size))  # delayed M, Ed[i, j] from node j
+            LEd_b = (w_n_b * Ed).sum(axis=1)
+            LEd_f = (w_n_f * Ed).sum(axis=1)
+            LEd_l = (w_n_l * Ed).sum(axis=1)
+            u_tms = external[:, step_i, i_window]
+
+            rM = ki * u_tms + std_in * noise[i_window, step_i, 0] + g * (LEd_l + dg_l * M) + \
+                _sigmoid(E - I, vmax, v0, r)
+            rE = kE + std_in * noise[i_window, step_i, 1] + g_f * (LEd_f + dg_f * (E - I)) + \
+                c2 * _sigmoid(c1 * M, vmax, v0, r)
+            rI = kI + std_in * noise[i_window, step_i, 2] + g_b * (-LEd_b - dg_b * (E - I)) + \
+                c4 * _sigmoid(c3 * M, vmax, v0, r)
+
+            ddM = M + dt * Mv
+            ddE = E + dt * Ev
+            ddI = I + dt * Iv
+            ddMv = Mv + dt * _sys2nd(A, a, u_2ndsys_ub * np.tanh(rM / u_2ndsys_ub), M, Mv)
+            ddEv = Ev + dt * _sys2nd(A, a, u_2ndsys_ub * np.tanh(rE / u_2ndsys_ub), E, Ev)
+            ddIv = Iv + dt * _sys2nd(B, b, u_2ndsys_ub * np.tanh(rI / u_2ndsys_ub), I, Iv)
+
+            E = 1000 * np.tanh(ddE / 1000)
+            I = 1000 * np.tanh(ddI / 1000)
+            M = 1000 * np.tanh(ddM / 1000)
+            Ev = 1000 * np.tanh(ddEv / 1000)
+            Iv = 1000 * np.tanh(ddIv / 1000)
+            Mv = 1000 * np.tanh(ddMv / 1000)
+
+            hE[:, 0] = M
+
+        states[0, :, i_window] = E
+        states[1, :, i_window] = Ev
+        states[2, :, i_window] = I
+        states[3, :, i_window] = Iv
+        states[4, :, i_window] = M
+        states[5, :, i_window] = Mv
+        hE[:, 1:] = hE[:, :-1].copy()
+        hE[:, 0] = M
+        eeg[:, i_window] = cy0 * np.dot(lm_t, E - I) - y0
+
+    state_next = np.zeros_like(state)
+    state_next[0], state_next[1], state_next[2], state_next[3], state_next[4], state_next[5] = M, E, I, Mv, Ev, Iv
+    return state_next, hE, states, eeg
+
+
+if numba is not None:
+    _sigmoid = numba.njit(cache=True)(_sigmoid)
+    _sys2nd = numba.njit(cache=True)(_sys2nd)
+    _jr_window = numba.njit(cache=True)(_jr_window)
+
+
+class JRNumpy:
+    """
+    Fitted JansenRit model simulated with NumPy
+    Attributes
+    ----------
+    node_size, output_size, steps_per_TR, TRs_per_window, delays_max: int
+    ki: array with node_size
+        (k_lb + relu(k)) * relu(ki), gain of the stimulus on every node
+    w_n_b, w_n_f, w_n_l: arrays with node_size x node_size
+        normalised effective couplings (sc_m_b, sc_m_f, sc_fitted of the torch model)
+    delays: int array with node_size x node_size
+        conduction delays in integration steps
+    lm_t: array with output_size x node_size
+        normalised leadfield
+    par: array
+        scalar parameters in the order of scalar_names (after the relu/exp transforms of integration_forward)
+    Methods
+    -------
+    forward(external, hx, hE, noise=None)
+        one window, with the same inputs and output keys as integration_forward
+    simulate(u, base_window_num=0, seed=None)
+        stimulus-driven simulation after base_window_num burn-in windows, as Model_fitting.test
+    """
+
+    def __init__(self, values, steps_per_TR, TRs_per_window):
+        self.steps_per_TR = int(steps_per_TR)
+        self.TRs_per_window = int(TRs_per_window)
+        self.delays_max = int(values.get('delays_max', 500))
+        self.par = np.array([float(values[name]) for name in scalar_names])
+        self.ki = np.asarray(values['ki'], dtype=np.float64).reshape(-1)
+        self.w_n_b = np.ascontiguousarray(values['w_n_b'], dtype=np.float64)
+        self.w_n_f = np.ascontiguousarray(values['w_n_f'], dtype=np.float64)
+        self.w_n_l = np.ascontiguousarray(values['w_n_l'], dtype=np.float64)
+        self.delays = np.asarray(values['delays'], dtype=np.int64)
+        self.lm_t = np.ascontiguousarray(values['lm_t'], dtype=np.float64)
+        self.node_size = self.w_n_l.shape[0]
+        self.output_size = self.lm_t.shape[0]
+        self.ki = np.broadcast_to(self.ki, (self.node_size,)).copy()
+        # Ed[i, j] = hE[j, delays[j, i]]: flat index j * delays_max + delays[j, i]
+        self.flat_delays = (np.arange(self.node_size)[None, :] * self.delays_max + self.delays.T).ravel()
+
+    def forward(self, external, hx, hE, noise=None):
+        """
+        Parameters
+        ----------
+        external: array with node_size x steps_per_TR x TRs_per_window
+            stimulus
+        hx: array with node_size x 6
+            states M, E, I, Mv, Ev, Iv
+        hE: array with node_size x delays_max
+            history of M
+        noise: array with TRs_per_window x steps_per_TR x 3 x node_size or None
+            standard normal input noise (drawn with np.random if None)
+        Outputs
+        -------
+        next_state: dictionary with the keys of integration_forward (arrays with node_size x TRs_per_window)
+        hE: updated history
+        """
+        if noise is None:
+            noise = np.random.randn(external.shape[2], external.shape[1], 3, self.node_size)
+        state, hE, states, eeg = _jr_window(np.ascontiguousarray(np.asarray(hx, dtype=np.float64).T),
+                                            np.array(hE, dtype=np.float64), np.asarray(external, dtype=np.float64),
+                                            noise, self.ki, self.w_n_b, self.w_n_f, self.w_n_l, self.flat_delays,
+                                            self.lm_t, self.par)
+        next_state = {'current_state': state.T.copy(), 'eeg_window': eeg}
+        for i, name in enumerate(['E', 'Ev', 'I', 'Iv', 'P', 'Pv']):
+            next_state[name + '_window'] = states[i]
+        return next_state, hE
+
+    def simulate(self, u, base_window_num=0, seed=None):
+        """
+        Parameters
+        ----------
+        u: array with node_size x steps_per_TR x time
+            stimulus (the length is cut to whole windows)
+        base_window_num: int
+            burn-in windows without stimulus before u
+        seed: int or None
+            seed of the initial states and noise
+        Outputs
+        -------
+        dictionary with E, Ev, I, Iv, P, Pv (node_size x time) and eeg (output_size x time)
+        """
+        rng = np.random.default_rng(seed)
+        num_windows = u.shape[2] // self.TRs_per_window
+        hx = rng.uniform(-0.01, 0.01, (self.node_size, 6))
+        hE = rng.uniform(-0.01, 0.01, (self.node_size, self.delays_max))
+        u_hat = np.zeros((self.node_size, self.steps_per_TR, (base_window_num + num_windows) * self.TRs_per_window))
+        u_hat[:, :, base_window_num * self.TRs_per_window:] = u[:, :, :num_windows * self.TRs_per_window]
+
+        out = {name: [] for name in state_names + ['eeg']}
+        for TR_i in range(base_window_num + num_windows):
+            external = u_hat[:, :, TR_i * self.TRs_per_window:(TR_i + 1) * self.TRs_per_window]
+            noise = rng.standard_normal((self.TRs_per_window, self.steps_per_TR, 3, self.node_size))
+            next_state, hE = self.forward(external, hx, hE, noise)
+            hx = next_state['current_state']
+            if TR_i >= base_window_num:
+                for name in out:
+                    out[name].append(next_state[name + '_window'])
+        return {name: np.concatenate(value, axis=1) for name, value in out.items()}
+
+
+def load_numpy_model(filename):
+    """
+    JRNumpy from an .npz written by JR_Model_Fitting.export_numpy_model.
+    """
+    with np.load(filename) as data:
+        values = {key: data[key] for key in data.files}
+    return JRNumpy(values, values['steps_per_TR'], values['TRs_per_window'])
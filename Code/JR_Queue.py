@@ -0,0 +1,372 @@
+"""
+Work queue for fits and simulations on several nodes, backed by one SQLite file (local or on a shared filesystem).
+
+Jobs are (kind, spec) pairs, e.g. ('fit', {'sub': 'CTL_01_16', 'run': 'verb_evoked'}); submitting the same pair
+twice does nothing. A worker claims one job at a time in a single write transaction, holds it under a lease that
+a background thread renews (heartbeat), and records the result or the error. Jobs whose worker died are claimed
+again once their lease expires, and failed jobs are retried up to max_attempts times.
+
+A lease is only lost if the heartbeat stalls for longer than lease_s (e.g. a suspended process or an unreachable
+shared filesystem); lease_s must exceed the longest such stall. A worker that lost its lease records it (status
+lists these jobs) and does not record the outcome of the job, which belongs to the worker that claimed it again;
+the outputs of the two runs are written to the same files, so the job should be checked.
+
+    python JR_Queue.py jobs.db submit fit CTL_01_16 CTL_02_09 --run verb_evoked --starts 8
+    python JR_Queue.py jobs.db submit c4 CTL_01_16 --run verb_evoked --manipulation decrease
+    python JR_Queue.py jobs.db worker              # on every node, as many as fit
+    python JR_Queue.py jobs.db status
+    python JR_Queue.py jobs.db retry               # failed jobs back to pending
+
+Job kinds (JOB_KINDS): fit (fit_subject), test (1500-sample simulation of a saved fit), transplant
+(transplant_fit) and c4 (c4_fit).
+"""
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    spec TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 3,
+    worker TEXT,
+    lease_until REAL,
+    created REAL,
+    started REAL,
+    finished REAL,
+    result TEXT,
+    error TEXT,
+    UNIQUE (kind, spec)
+);
+CREATE TABLE IF NOT EXISTS lost (
+    job_id INTEGER NOT NULL,
+    worker TEXT NOT NULL,
+    time REAL,
+    note TEXT
+)
+"""
+
+
+class JobQueue:
+    """
+    SQLite job queue
+    Attributes
+    ----------
+    path: str
+        database file (created with the jobs table if missing)
+    lease_s: float
+        seconds a claimed job stays with its worker without a heartbeat
+    Methods
+    -------
+    submit(kind, spec, max_attempts=3)
+        add a job (ignored if the same kind and spec exist), returns its id
+    claim(worker)
+        take the next pending job or a running job with an expired lease; (id, kind, spec) or None
+    heartbeat(job_id, worker)
+        renew the lease, False if the job was lost to another worker
+    record_lost(job_id, worker, note)
+        log a job that ran on after its worker lost the lease (duplicate run)
+    complete(job_id, worker, result) / fail(job_id, worker, error)
+        record the outcome; failed jobs go back to pending until max_attempts
+    """
+
+    def __init__(self, path, lease_s=600.):
+        self.path = path
+        self.lease_s = lease_s
+        con = sqlite3.connect(self.path, timeout=60)
+        try:
+            con.executescript(SCHEMA)
+        finally:
+            con.close()
+
+    def connect(self):
+        # one connection per operation: usable from the heartbeat thread and safe across fork
+        con = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        return _Transaction(con)
+
+    def submit(self, kind, spec, max_attempts=3):
+        check_spec(kind, spec)
+        spec = json.dumps(spec, sort_keys=True)
+        with self.connect() as con:
+            con.execute('INSERT OR IGNORE INTO jobs (kind, spec, max_attempts, created) VALUES (?, ?, ?, ?)',
+                        (kind, spec, max_attempts, time.time()))
+            return con.execute('SELECT id FROM jobs WHERE kind = ? AND spec = ?', (kind, spec)).fetchone()[0]
+
+    def claim(self, worker):
+        now = time.time()
+        with self.connect() as con:
+            # jobs lost by their worker on the last attempt
+            con.execute("UPDATE jobs SET status = 'failed', error = 'lease expired' WHERE status = 'running' "
+                        "AND lease_until < ? AND attempts >= max_attempts", (now,))
+            row = con.execute("SELECT id, kind, spec FROM jobs WHERE attempts < max_attempts AND "
+                              "(status = 'pending' OR (status = 'running' AND lease_until < ?)) "
+                              "ORDER BY attempts, id LIMIT 1", (now,)).fetchone()
+            if row is None:
+                return None
+            con.execute("UPDATE jobs SET status = 'running', worker = ?, lease_until = ?, started = ?, "
+                        "attempts = attempts + 1 WHERE id = ?", (worker, now + self.lease_s, now, row[0]))
+        return row[0], row[1], json.loads(row[2])
+
+    def heartbeat(self, job_id, worker):
+        with self.connect() as con:
+            cur = con.execute("UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                              (time.time() + self.lease_s, job_id, worker))
+            return cur.rowcount == 1
+
+    def record_lost(self, job_id, worker, note):
+        with self.connect() as con:
+            con.execute('INSERT INTO lost (job_id, worker, time, note) VALUES (?, ?, ?, ?)',
+                        (job_id, worker, time.time(), note))
+
+    def lost_jobs(self):
+        """
+        Jobs that ran on after their worker lost the lease, with that worker and note.
+        """
+        with self.connect() as con:
+            cur = con.execute('SELECT lost.job_id, jobs.kind, jobs.spec, lost.worker, lost.note FROM lost '
+                              'JOIN jobs ON jobs.id = lost.job_id ORDER BY lost.time')
+            names = ['id', 'kind', 'spec', 'worker', 'note']
+            return [dict(zip(names, row)) for row in cur.fetchall()]
+
+    def complete(self, job_id, worker, result=None):
+        with self.connect() as con:
+            con.execute("UPDATE jobs SET status = 'done', finished = ?, result = ?, error = NULL "
+                        "WHERE id = ? AND worker = ?", (time.time(), json.dumps(result), job_id, worker))
+
+    def fail(self, job_id, worker, error):
+        with self.connect() as con:
+            con.execute("UPDATE jobs SET status = CASE WHEN attempts < max_attempts THEN 'pending' ELSE 'failed' END, "
+                        "finished = ?, error = ?, lease_until = NULL WHERE id = ? AND worker = ?",
+                        (time.time(), error, job_id, worker))
+
+    def retry(self, kind=None):
+        """
+        Failed jobs (of kind) back to pending with a fresh attempt budget; returns their number.
+        """
+        with self.connect() as con:
+            cur = con.execute("UPDATE jobs SET status = 'pending', attempts = 0 WHERE status = 'failed' "
+                              "AND (? IS NULL OR kind = ?)", (kind, kind))
+            return cur.rowcount
+
+    def status(self):
+        """
+        Number of jobs per kind and status.
+        """
+        with self.connect() as con:
+            rows = con.execute('SELECT kind, status, COUNT(*) FROM jobs GROUP BY kind, status').fetchall()
+        counts = {}
+        for kind, status, n in rows:
+            counts.setdefault(kind, {})[status] = n
+        return counts
+
+    def jobs(self, status=None):
+        """
+        All jobs (with status) as dictionaries.
+        """
+        with self.connect() as con:
+            cur = con.execute('SELECT * FROM jobs WHERE ? IS NULL OR status = ? ORDER BY id', (status, status))
+            names = [d[0] for d in cur.description]
+            return [dict(zip(names, row)) for row in cur.fetchall()]
+
+
+class _Transaction:
+    """
+    Connection context taking the write lock up front (BEGIN IMMEDIATE), so a claim is atomic across processes.
+    """
+
+    def __init__(self, con):
+        self.con = con
+
+    def __enter__(self):
+        self.con.execute('BEGIN IMMEDIATE')
+        return self.con
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.con.execute('ROLLBACK' if exc_type is not None else 'COMMIT')
+        finally:
+            self.con.close()
+
+
+# -----------------------------
+#  Job kinds
+# -----------------------------
+def run_fit_job(spec):
+    import JR_Model_Fitting as jr
+    options = {key: spec[key] for key in ['profile', 'warm', 'warm_subject', 'starts', 'joint', 'checkpoint_every']
+               if key in spec}
+    jr.fit_subject(spec['sub'], spec['run'], **options)
+    return {'fit': jr.output_path + '/' + spec['sub'] + '_' + spec['run'] + '_fittingresults_stim_exp.pkl'}
+
+
+def run_test_job(spec):
+    import numpy as np
+    import JR_Model_Fitting as jr
+    prefix = jr.output_path + '/' + spec['sub'] + '_' + spec['run']
+    F = jr.load_fit(prefix + '_fittingresults_stim_exp.pkl')
+    jr.simulate_fit(F, np.load(jr.data_path + spec['sub'] + '/' + spec['run'] + '.npy'))
+    np.save(prefix + '_pred1500_source_ts.npy', F.output_sim.P_test)
+    np.save(prefix + '_pred1500_sensor_ts.npy', F.output_sim.eeg_test)
+    return {'source': prefix + '_pred1500_source_ts.npy', 'sensor': prefix + '_pred1500_sensor_ts.npy'}
+
+
+def run_transplant_job(spec):
+    import JR_Model_Fitting as jr
+    jr.transplant_fit(spec['sub'], spec['run'], spec.get('group', 'YC'), spec.get('fits'), spec.get('out'))
+    return {'group': spec.get('group', 'YC')}
+
+
+def run_c4_job(spec):
+    import JR_Model_Fitting as jr
+    jr.c4_fit(spec['sub'], spec['run'], spec['manipulation'], spec.get('delta', jr.C4_MEAN_DIFF),
+              spec.get('fits'), spec.get('out'))
+    return {'manipulation': spec['manipulation']}
+
+
+JOB_KINDS = {'fit': run_fit_job, 'test': run_test_job, 'transplant': run_transplant_job, 'c4': run_c4_job}
+# spec keys every job of a kind needs
+JOB_SPEC = {'fit': ('sub', 'run'), 'test': ('sub', 'run'), 'transplant': ('sub', 'run'),
+            'c4': ('sub', 'run', 'manipulation')}
+
+
+def check_spec(kind, spec):
+    """
+    Raise ValueError for an unknown job kind or a spec without the keys of its kind (JOB_SPEC).
+    """
+    if kind not in JOB_KINDS:
+        raise ValueError('Invalid job kind. Choose one of ' + ', '.join(JOB_KINDS) + '.')
+    missing = [key for key in JOB_SPEC[kind] if spec.get(key) is None]
+    if missing:
+        raise ValueError('%s jobs need %s in their spec.' % (kind, ', '.join(missing)))
+
+
+def run_job(queue, job_id, kind, spec, worker):
+    """
+    Execute one claimed job while a background thread renews its lease. If the lease is lost, the outcome is not
+    recorded (the job belongs to the worker that claimed it again) and the duplicate run is logged.
+    """
+    stop = threading.Event()
+    lost = threading.Event()
+
+    def beat():
+        while not stop.wait(queue.lease_s / 3):
+            if not queue.heartbeat(job_id, worker):
+                lost.set()
+                print('job', job_id, 'lease lost', flush=True)
+                queue.record_lost(job_id, worker, 'lease lost while running')
+                return
+
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    try:
+        result = JOB_KINDS[kind](spec)
+    except Exception:
+        stop.set()
+        thread.join()
+        if lost.is_set():
+            queue.record_lost(job_id, worker, 'failed after the lease was lost (not recorded)')
+            print('job', job_id, kind, spec, 'failed after its lease was lost', flush=True)
+            return False
+        queue.fail(job_id, worker, traceback.format_exc())
+        print('job', job_id, kind, spec, 'failed', flush=True)
+        return False
+    stop.set()
+    thread.join()
+    if lost.is_set():
+        queue.record_lost(job_id, worker, 'finished after the lease was lost (not recorded)')
+        print('job', job_id, kind, spec, 'finished after its lease was lost', flush=True)
+        return False
+    queue.complete(job_id, worker, result)
+    print('job', job_id, kind, spec, 'done', flush=True)
+    return True
+
+
+def run_worker(queue, worker=None, poll_s=30., wait=False, max_jobs=None):
+    """
+    Claim and run jobs until the queue is empty (or keep polling every poll_s seconds with wait).
+    """
+    worker = worker or socket.gethostname() + ':' + str(os.getpid())
+    done = 0
+    while max_jobs is None or done < max_jobs:
+        job = queue.claim(worker)
+        if job is None:
+            if not wait:
+                break
+            time.sleep(poll_s)
+            continue
+        run_job(queue, *job, worker)
+        done += 1
+    return done
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('db', help='SQLite file of the queue')
+    parser.add_argument('--lease', type=float, default=600., help='lease of a claimed job in seconds')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('submit', help='add one job per subject')
+    p.add_argument('kind', choices=list(JOB_KINDS))
+    p.add_argument('subs', nargs='+')
+    p.add_argument('--run', required=True)
+    p.add_argument('--starts', type=int, default=None)
+    p.add_argument('--joint', default=None)
+    p.add_argument('--warm', default=None)
+    p.add_argument('--warm-subject', action='store_true', default=None, help='fit: also warm-start the leadfield')
+    p.add_argument('--checkpoint-every', type=int, default=None, help='fit: checkpoint/resume every N epochs (single start)')
+    p.add_argument('--group', default=None, help='transplant: source group')
+    p.add_argument('--manipulation', default=None, choices=['increase', 'decrease'], help='c4: direction')
+    p.add_argument('--max-attempts', type=int, default=3)
+
+    p = sub.add_parser('worker', help='run jobs')
+    p.add_argument('--wait', action='store_true', help='keep polling when the queue is empty')
+    p.add_argument('--poll', type=float, default=30.)
+    p.add_argument('--max-jobs', type=int, default=None)
+
+    sub.add_parser('status', help='jobs per kind and status, the errors of failed jobs and duplicate runs')
+    p = sub.add_parser('retry', help='failed jobs back to pending')
+    p.add_argument('--kind', default=None)
+
+    args = parser.parse_args(argv)
+    queue = JobQueue(args.db, lease_s=args.lease)
+    if args.command == 'submit':
+        if args.kind == 'fit' and (args.starts or args.joint) and (args.checkpoint_every or args.warm):
+            parser.error('--checkpoint-every and --warm are only supported by single-start fits')
+        options = {key: getattr(args, key) for key in ['starts', 'joint', 'warm', 'warm_subject', 'checkpoint_every',
+                                                        'group', 'manipulation']
+                   if getattr(args, key) is not None}
+        try:
+            check_spec(args.kind, dict(sub=args.subs[0], run=args.run, **options))
+        except ValueError as e:
+            parser.error(str(e))
+        for s in args.subs:
+            print(args.kind, s, 'job', queue.submit(args.kind, dict(sub=s, run=args.run, **options),
+                                                    args.max_attempts))
+    elif args.command == 'worker':
+        import warnings
+        warnings.filterwarnings('ignore')
+        print(run_worker(queue, poll_s=args.poll, wait=args.wait, max_jobs=args.max_jobs), 'jobs run')
+    elif args.command == 'status':
+        for kind, counts in queue.status().items():
+            print(kind, counts)
+        for job in queue.jobs('failed'):
+            print('failed', job['id'], job['kind'], job['spec'], job['error'].strip().splitlines()[-1])
+        for job in queue.lost_jobs():
+            print('lease lost', job['id'], job['kind'], job['spec'], job['worker'], job['note'])
+    else:
+        print(queue.retry(args.kind), 'jobs back to pending')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""
+Node-local shared copies of the subject inputs for parallel fits and sweeps.
+
+publish_subject writes the model inputs of a subject (log-normalised sc, dist, the collapsed leadfield and the
+evoked M/EEG of every run) once per node as .npy files under a shared-memory directory (/dev/shm when present);
+every worker then attaches them with attach_subject as read-only memory maps, so all workers of the node read the
+same physical pages instead of each loading and holding its own copies. sc and dist are stored as float32, the
+dtype the model uses, so RNNJANSEN wraps dist (and as_tensor any of them) without a copy.
+
+    from JR_SharedInputs import publish_subject, attach_subject
+    publish_subject('CTL_01_16', ['verb_evoked', 'noise_evoked'])         # parent, once per node
+    inputs = attach_subject('CTL_01_16', ['verb_evoked'])                  # every worker, zero-copy
+    fit_subject('CTL_01_16', 'verb_evoked', inputs=inputs)
+
+Publishing is atomic (written to a temporary directory and renamed), so concurrent workers may all call
+publish_subject; the first one writes and the others reuse its files, adding the runs it does not have.
+
+The training windows (dataloader) are a broadcast view of one copy of the windowed data, so a worker holds the
+evoked data once rather than once per epoch, and the model builds its sc tensor once (sc_tensor).
+"""
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+default_root = os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), 'jr_inputs')
+shared_dtypes = {'sc': np.float32, 'dist': np.float32}
+
+_attached = {}  # (directory, runs) -> inputs of this process
+
+
+def subject_dir(sub, root=None):
+    return os.path.join(default_root if root is None else root, sub)
+
+
+def publish_subject(sub, runs, root=None, inputs=None):
+    """
+    Write the inputs of sub (and the runs not published yet) to root/sub.
+    Parameters
+    ----------
+    sub: str
+        subject (e.g. CTL_01_16)
+    runs: list of str
+        runs whose evoked data are published
+    root: str or None
+        shared directory (default_root if None)
+    inputs: dict or None
+        inputs as JR_Model_Fitting.load_subject_inputs (loaded from data_path if None)
+    Returns
+    -------
+    directory of the published files
+    """
+    directory = subject_dir(sub, root)
+    missing = [run for run in runs if not os.path.exists(os.path.join(directory, 'meg_' + run + '.npy'))]
+    if os.path.isdir(directory) and not missing:
+        return directory
+    if inputs is None:
+        from JR_Model_Fitting import load_subject_inputs
+        inputs = load_subject_inputs(sub, missing if os.path.isdir(directory) else runs)
+
+    os.makedirs(os.path.dirname(directory), exist_ok=True)
+    tmp = tempfile.mkdtemp(prefix='.' + sub + '_', dir=os.path.dirname(directory))
+    try:
+        if not os.path.isdir(directory):
+            for name in ['sc', 'dist', 'lm']:
+                np.save(os.path.join(tmp, name + '.npy'), np.asarray(inputs[name], dtype=shared_dtypes.get(name)))
+        for run in missing:
+            np.save(os.path.join(tmp, 'meg_' + run + '.npy'), inputs['meg'][run])
+        published = False
+        if not os.path.isdir(directory):
+            try:
+                os.rename(tmp, directory)
+                published = True
+            except OSError:
+                pass  # published concurrently by another worker (possibly with other runs)
+        if not published:
+            # add the runs of this call to the existing directory (each file replaced atomically)
+            for name in os.listdir(tmp):
+                if name.startswith('meg_'):
+                    os.replace(os.path.join(tmp, name), os.path.join(directory, name))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return directory
+
+
+def attach_subject(sub, runs, root=None):
+    """
+    Read-only memory maps of the inputs published for sub (same keys as load_subject_inputs); repeated calls in
+    one process return the same arrays.
+    """
+    directory = subject_dir(sub, root)
+    key = (directory, tuple(runs))
+    if key not in _attached:
+        inputs = {name: np.load(os.path.join(directory, name + '.npy'), mmap_mode='r') for name in ['sc', 'dist', 'lm']}
+        inputs['meg'] = {run: np.load(os.path.join(directory, 'meg_' + run + '.npy'), mmap_mode='r') for run in runs}
+        _attached[key] = inputs
+    return _attached[key]
+
+
+def as_tensor(x):
+    """
+    torch tensor sharing the memory of an attached input.
+    """
+    from JR_Model_Fitting import as_shared_tensor
+    return as_shared_tensor(x)
+
+
+def release_subject(sub, root=None):
+    """
+    Remove the published inputs of sub (once all workers are done).
+    """
+    directory = subject_dir(sub, root)
+    for key in [key for key in _attached if key[0] == directory]:
+        del _attached[key]
+    shutil.rmtree(directory, ignore_errors=True)
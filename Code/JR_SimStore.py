@@ -0,0 +1,245 @@
+"""
+Cohort store of simulated time series: one memory-mapped array per space instead of one .npy per subject and run.
+
+    <store>/source.npy    float32 (subject, condition, node, time)
+    <store>/sensor.npy    float32 (subject, condition, channel, time)
+    <store>/index.csv     subject, age, condition, manipulation, subject_idx, condition_idx
+    <store>/meta.json     subjects (with ages), conditions and array sizes
+
+A condition slot is a (condition, manipulation) pair, e.g. ('verb', '') for the fitted model and ('verb', 'YCp2i')
+or ('verb', 'c4dec') for the virtual transplants and local inhibition changes. Slots that were never written are NaN.
+
+    store = SimStore.import_directory('Data/Model_Outputs/Simulations', 'sim_store')
+    store.append('sub-01', 16, 'verb', source=P, sensor=eeg, manipulation='c4dec')
+    beta = store.get('source', conditions=['verb', 'noise'], nodes=frontal_idx, window=(800, 1300))
+
+Arrays grow by doubling their subject/condition capacity. The store has a single writer; any number of readers can
+open it at the same time.
+"""
+import csv
+import glob
+import json
+import os
+import re
+
+import numpy as np
+
+SPACES = ('source', 'sensor')
+file_pattern = re.compile(r'(sub-[^_]+)-(\d+)Y_([^_]+)_(source|sensor)_timeseries\.npy$')
+
+
+def parse_subject(name):
+    """
+    Subject ID (sub-XX) and age from sub-XX-YYY or CTL_XX_YY names.
+    """
+    match = re.match(r'sub-(\w+?)-(\d+)Y', name) or re.match(r'CTL_(\w+?)_(\d+)$', name)
+    if match is None:
+        raise ValueError('Unknown subject name %s (expected sub-XX-YYY or CTL_XX_YY).' % name)
+    return 'sub-' + match.group(1), int(match.group(2))
+
+
+class SimStore:
+    """
+    Memory-mapped store of simulated source and sensor time series
+    Attributes
+    ----------
+    path: str
+        directory of the store
+    subjects: list of str
+        subject IDs in the order of the subject axis (ages in self.ages)
+    conditions: list of (condition, manipulation)
+        condition slots in the order of the condition axis
+    sizes: dict
+        number of nodes/channels of each space and time points
+    Methods
+    -------
+    append(subject, age, condition, source=None, sensor=None, manipulation='')
+        write the time series of one subject and condition slot
+    get(space, subjects=None, conditions=None, nodes=None, window=None, manipulation='')
+        slice of the array of a space (subject, condition, node/channel, time)
+    index()
+        index table as a pandas DataFrame
+    """
+
+    def __init__(self, path, mode='r'):
+        self.path = path
+        self.mode = mode
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.subjects = meta['subjects']
+        self.ages = meta['ages']
+        self.conditions = [tuple(c) for c in meta['conditions']]
+        self.sizes = meta['sizes']
+        self.rows = []
+        if os.path.exists(os.path.join(path, 'index.csv')):
+            with open(os.path.join(path, 'index.csv')) as f:
+                self.rows = [row for row in csv.DictReader(f)]
+        self._arrays = {}
+        self.capacity = (8, 2)  # initial subject x condition slots of a new array
+
+    @classmethod
+    def create(cls, path, sizes=None, capacity=(8, 2)):
+        """
+        Empty store; sizes (source/sensor/time) are taken from the first append if None.
+        """
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'subjects': [], 'ages': [], 'conditions': [], 'sizes': sizes or {}}, f, indent=1)
+        store = cls(path, mode='r+')
+        store.capacity = capacity
+        return store
+
+    @classmethod
+    def open(cls, path, mode='r'):
+        return cls(path, mode)
+
+    @classmethod
+    def import_directory(cls, sim_dir, path):
+        """
+        Store of the Source_Space/Sensor_Space sub-XX-YYY_{condition}_{space}_timeseries.npy files of sim_dir.
+        """
+        files = [(filename, file_pattern.search(os.path.basename(filename)))
+                 for filename in sorted(glob.glob(os.path.join(sim_dir, '*_Space', '*_timeseries.npy')))]
+        files = [(filename, match.groups()) for filename, match in files if match is not None]
+        # exact capacity for the imported files
+        store = cls.create(path, capacity=(len({f[1][0] for f in files}), len({f[1][2] for f in files})))
+        for filename, (subject, age, condition, space) in files:
+            store.append(subject, int(age), condition, **{space: np.load(filename)})
+        store.flush()
+        return store
+
+    # -----------------------------
+    #  Arrays
+    # -----------------------------
+    def array(self, space):
+        """
+        Memory map of a space (subject capacity x condition capacity x nodes x time).
+        """
+        if space not in SPACES:
+            raise ValueError("Invalid space. Choose 'source' or 'sensor'.")
+        if space not in self._arrays:
+            filename = os.path.join(self.path, space + '.npy')
+            if not os.path.exists(filename):
+                return None
+            self._arrays[space] = np.load(filename, mmap_mode=self.mode)
+        return self._arrays[space]
+
+    def _reserve(self, space, n_subjects, n_conditions):
+        arr = self.array(space)
+        if arr is not None and arr.shape[0] >= n_subjects and arr.shape[1] >= n_conditions:
+            return arr
+        if arr is None:
+            shape = (max(n_subjects, self.capacity[0]), max(n_conditions, self.capacity[1]))
+        else:
+            # double only the axis that is full
+            shape = (arr.shape[0] if arr.shape[0] >= n_subjects else max(n_subjects, 2 * arr.shape[0]),
+                     arr.shape[1] if arr.shape[1] >= n_conditions else max(n_conditions, 2 * arr.shape[1]))
+        shape = shape + (self.sizes[space], self.sizes['time'])
+        filename = os.path.join(self.path, space + '.npy')
+        new = np.lib.format.open_memmap(filename + '.tmp', mode='w+', dtype=np.float32, shape=shape)
+        new[:] = np.nan
+        if arr is not None:
+            new[:arr.shape[0], :arr.shape[1]] = arr
+        new.flush()
+        del new
+        self._arrays.pop(space, None)
+        os.replace(filename + '.tmp', filename)
+        return self.array(space)
+
+    def append(self, subject, age, condition, source=None, sensor=None, manipulation=''):
+        """
+        Write the simulated time series (node x time / channel x time) of one subject and condition slot;
+        an existing entry of the same slot is overwritten.
+        """
+        if self.mode == 'r':
+            raise ValueError('Store opened read-only (mode="r").')
+        subject, age = str(subject), int(age)
+        for space, ts in (('source', source), ('sensor', sensor)):
+            if ts is not None:
+                self.sizes.setdefault(space, ts.shape[0])
+                self.sizes.setdefault('time', ts.shape[1])
+                if ts.shape != (self.sizes[space], self.sizes['time']):
+                    raise ValueError('%s time series of shape %s, the store holds %s.'
+                                     % (space, ts.shape, (self.sizes[space], self.sizes['time'])))
+        if subject not in self.subjects:
+            self.subjects.append(subject)
+            self.ages.append(age)
+        key = (condition, manipulation)
+        if key not in self.conditions:
+            self.conditions.append(key)
+        i, j = self.subjects.index(subject), self.conditions.index(key)
+
+        for space, ts in (('source', source), ('sensor', sensor)):
+            # both spaces keep the same subject and condition axes
+            if ts is not None or self.array(space) is not None:
+                arr = self._reserve(space, len(self.subjects), len(self.conditions))
+            if ts is not None:
+                arr[i, j] = ts
+        row = {'subject': subject, 'age': str(age), 'condition': condition, 'manipulation': manipulation,
+               'subject_idx': str(i), 'condition_idx': str(j)}
+        if row not in self.rows:
+            self.rows.append(row)
+        self.flush()
+
+    def flush(self):
+        for arr in self._arrays.values():
+            arr.flush()
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump({'subjects': self.subjects, 'ages': self.ages, 'conditions': self.conditions,
+                       'sizes': self.sizes}, f, indent=1)
+        with open(os.path.join(self.path, 'index.csv'), 'w', newline='') as f:
+            writer = csv.DictWriter(f, ['subject', 'age', 'condition', 'manipulation', 'subject_idx',
+                                        'condition_idx'])
+            writer.writeheader()
+            writer.writerows(self.rows)
+
+    # -----------------------------
+    #  Reading
+    # -----------------------------
+    def subject_idx(self, subjects=None):
+        if subjects is None:
+            return np.arange(len(self.subjects))
+        return np.array([self.subjects.index(parse_subject(s)[0] if s not in self.subjects else s)
+                         for s in subjects])
+
+    def condition_idx(self, conditions=None, manipulation=''):
+        if conditions is None:
+            return np.array([j for j, (_, m) in enumerate(self.conditions) if m == manipulation])
+        return np.array([self.conditions.index(c if isinstance(c, tuple) else (c, manipulation))
+                         for c in conditions])
+
+    def get(self, space, subjects=None, conditions=None, nodes=None, window=None, manipulation=''):
+        """
+        Parameters
+        ----------
+        space: 'source' or 'sensor'
+        subjects: list of str or None
+            subject IDs (sub-XX or CTL_XX_YY names), all if None
+        conditions: list or None
+            condition names (with the given manipulation) or (condition, manipulation) pairs; all conditions of
+            the manipulation if None
+        nodes: int array or None
+            nodes/channels, all if None
+        window: (start, stop) or None
+            time samples, all if None
+        Returns
+        -------
+        array with subject x condition x node x time (only the selected part is read from disk)
+        """
+        arr = self.array(space)
+        if arr is None:
+            raise ValueError('No %s time series in the store.' % space)
+        i = self.subject_idx(subjects)
+        j = self.condition_idx(conditions, manipulation)
+        k = np.arange(self.sizes[space]) if nodes is None else np.asarray(nodes)
+        t = slice(None) if window is None else slice(*window)
+        return arr[:, :, :, t][np.ix_(i, j, k)]
+
+    def index(self):
+        """
+        Index table (subject, age, condition, manipulation, subject_idx, condition_idx) as a pandas DataFrame.
+        """
+        import pandas as pd
+        df = pd.DataFrame(self.rows, columns=['subject', 'age', 'condition', 'manipulation', 'subject_idx',
+                                              'condition_idx'])
+        return df.astype({'age': int, 'subject_idx': int, 'condition_idx': int})